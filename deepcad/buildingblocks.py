@@ -1,6 +1,27 @@
+import inspect
+
 import torch
 from torch import nn as nn
 from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
+
+# pytorch >= 1.11 has the non-reentrant checkpoint, which also works when no input requires gradients
+NON_REENTRANT_CHECKPOINT = 'use_reentrant' in inspect.signature(checkpoint).parameters
+
+
+def checkpoint_forward(function, *inputs):
+    """
+    Run function with activation checkpointing: the intermediate tensors of function are not kept for the backward
+    pass but recomputed from the inputs during the backward pass. Only applied when gradients are computed.
+    """
+    if not torch.is_grad_enabled():
+        return function(*inputs)
+    if NON_REENTRANT_CHECKPOINT:
+        return checkpoint(function, *inputs, use_reentrant=False)
+    if not any(input.requires_grad for input in inputs):
+        # the reentrant checkpoint would not compute the gradients of the parameters (the first encoder)
+        return function(*inputs)
+    return checkpoint(function, *inputs)
 
 
 def conv3d(in_channels, out_channels, kernel_size, bias, padding=1):
@@ -194,12 +215,15 @@ class Encoder(nn.Module):
         conv_layer_order (string): determines the order of layers
             in `DoubleConv` module. See `DoubleConv` for more info.
         num_groups (int): number of groups for the GroupNorm
+        checkpoint (bool): if True the activations of the module are recomputed in the backward pass instead of
+            being kept (activation checkpointing), which saves memory at the cost of a second forward pass
     """
 
     def __init__(self, in_channels, out_channels, conv_kernel_size=3, apply_pooling=True,
                  pool_kernel_size=(2, 2, 2), pool_type='max', basic_module=DoubleConv, conv_layer_order='cr',
-                 num_groups=8):
+                 num_groups=8, checkpoint=False):
         super(Encoder, self).__init__()
+        self.checkpoint = checkpoint
         assert pool_type in ['max', 'avg']
         if apply_pooling:
             if pool_type == 'max':
@@ -216,6 +240,11 @@ class Encoder(nn.Module):
                                          num_groups=num_groups)
 
     def forward(self, x):
+        if self.checkpoint:
+            return checkpoint_forward(self._forward, x)
+        return self._forward(x)
+
+    def _forward(self, x):
         if self.pooling is not None:
             x = self.pooling(x)
         x = self.basic_module(x)
@@ -238,11 +267,15 @@ class Decoder(nn.Module):
         conv_layer_order (string): determines the order of layers
             in `DoubleConv` module. See `DoubleConv` for more info.
         num_groups (int): number of groups for the GroupNorm
+        checkpoint (bool): if True the activations of the module are recomputed in the backward pass instead of
+            being kept (activation checkpointing), which saves memory at the cost of a second forward pass
     """
 
     def __init__(self, in_channels, out_channels, kernel_size=3,
-                 scale_factor=(2, 2, 2), basic_module=DoubleConv, conv_layer_order='cr', num_groups=8):
+                 scale_factor=(2, 2, 2), basic_module=DoubleConv, conv_layer_order='cr', num_groups=8,
+                 checkpoint=False):
         super(Decoder, self).__init__()
+        self.checkpoint = checkpoint
         if basic_module == DoubleConv:
             # if DoubleConv is the basic_module use nearest neighbor interpolation for upsampling
             self.upsample = None
@@ -268,6 +301,11 @@ class Decoder(nn.Module):
                                          num_groups=num_groups)
 
     def forward(self, encoder_features, x):
+        if self.checkpoint:
+            return checkpoint_forward(self._forward, encoder_features, x)
+        return self._forward(encoder_features, x)
+
+    def _forward(self, encoder_features, x):
         if self.upsample is None:
             # use nearest neighbor interpolation and concatenation joining
             output_size = encoder_features.size()[2:]
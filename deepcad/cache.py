@@ -0,0 +1,158 @@
+"""
+On-disk cache of preprocessed stacks and patch tables.
+
+The entries are keyed by the content hash of the tif file and the preprocessing parameters (scale_factor, the
+number of frames, the patch geometry...), so a cached stack is reused by every run on the same recording with the
+same parameters, whatever the file is called. Hashing a recording reads it once, the hash is then remembered in the
+index of the cache for the path, modification time and size of the file. The arrays are stored as .npy files and
+loaded as copy-on-write memory maps. When the cache grows beyond its size limit, the least recently used entries
+are removed.
+"""
+import os
+import json
+import time
+import hashlib
+
+import numpy as np
+
+INDEX_NAME = 'index.json'
+
+
+class preprocess_cache():
+    """
+    On-disk cache of preprocessed arrays (stacks, patch tables) and their metadata.
+
+    Args:
+        cache_dir : the folder of the cache
+        max_size : the size limit of the cache in GB
+        dtype : 'float32' or 'float16', the dtype the floating point stacks are stored in (float16 halves the size
+                of the cache but rounds the preprocessed values)
+    """
+
+    def __init__(self, cache_dir, max_size=20, dtype='float32'):
+        if dtype not in ('float32', 'float16'):
+            raise ValueError("dtype must be 'float32' or 'float16', got '{}'".format(dtype))
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size * 1024 ** 3)
+        self.dtype = dtype
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+        self.index = self.read_index()
+
+    def read_index(self):
+        index_name = os.path.join(self.cache_dir, INDEX_NAME)
+        if os.path.exists(index_name):
+            try:
+                with open(index_name) as f:
+                    index = json.load(f)
+                return {'files': index.get('files', {}), 'entries': index.get('entries', {})}
+            except ValueError:
+                pass  # a damaged index, the cache is rebuilt
+        return {'files': {}, 'entries': {}}
+
+    def write_index(self):
+        index_name = os.path.join(self.cache_dir, INDEX_NAME)
+        temp_name = index_name + '.{}.tmp'.format(os.getpid())
+        with open(temp_name, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(temp_name, index_name)
+
+    def file_hash(self, path, chunk_size=16 * 1024 ** 2):
+        """
+        The content hash of a file. The hash is only computed when the path, modification time or size of the
+        file is not in the index.
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        record = self.index['files'].get(path)
+        if record is not None and record['mtime'] == stat.st_mtime and record['size'] == stat.st_size:
+            return record['hash']
+        digest = hashlib.blake2b(digest_size=20)
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                digest.update(chunk)
+        self.index['files'][path] = {'mtime': stat.st_mtime, 'size': stat.st_size, 'hash': digest.hexdigest()}
+        self.write_index()
+        return digest.hexdigest()
+
+    def key(self, path, **params):
+        """
+        The key of an entry, made of the content hash of the file and the preprocessing parameters.
+        """
+        params['content'] = self.file_hash(path)
+        params['cache_dtype'] = self.dtype
+        return hashlib.blake2b(json.dumps(params, sort_keys=True).encode(), digest_size=16).hexdigest()
+
+    def get(self, key):
+        """
+        Load an entry.
+        Return:
+            arrays, meta : the dict of arrays (copy-on-write memory maps, float16 stacks are converted to float32) and
+                           the dict of metadata of the entry, or None if the key is not in the cache
+        """
+        entry = self.index['entries'].get(key)
+        if entry is None:
+            return None
+        arrays = {}
+        try:
+            for name, file_name in entry['arrays'].items():
+                array = np.load(os.path.join(self.cache_dir, file_name), mmap_mode='c')
+                if array.dtype == np.float16:
+                    array = array.astype(np.float32)
+                arrays[name] = array
+        except (OSError, ValueError):
+            # the files of the entry were removed (by another run evicting it), the entry is computed again
+            self.index['entries'].pop(key)
+            self.write_index()
+            return None
+        entry['last_used'] = time.time()
+        self.write_index()
+        return arrays, entry['meta']
+
+    def put(self, key, arrays, meta):
+        """
+        Store an entry and evict the least recently used entries beyond the size limit. Floating point arrays are
+        stored in the dtype of the cache.
+        Args:
+            key : the key of the entry (see key)
+            arrays : the dict of arrays of the entry
+            meta : the dict of metadata of the entry (json serializable)
+        """
+        files = {}
+        size = 0
+        for name, array in arrays.items():
+            array = np.asarray(array)
+            itemsize = np.dtype(self.dtype).itemsize if array.dtype.kind == 'f' else array.itemsize
+            size += array.size * itemsize
+            files[name] = '{}.{}.npy'.format(key, name)
+        if size > self.max_size:
+            return
+        for name, array in arrays.items():
+            array = np.asarray(array)
+            if array.dtype.kind == 'f':
+                array = array.astype(self.dtype, copy=False)
+            file_name = os.path.join(self.cache_dir, files[name])
+            temp_name = file_name + '.{}.tmp'.format(os.getpid())
+            with open(temp_name, 'wb') as f:
+                np.save(f, array)
+            os.replace(temp_name, file_name)
+        self.index = self.read_index()  # entries added by other runs in the meantime
+        self.index['entries'][key] = {'arrays': files, 'meta': meta, 'bytes': size, 'last_used': time.time()}
+        self.evict()
+        self.write_index()
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits in its size limit.
+        """
+        entries = self.index['entries']
+        total = sum(entry['bytes'] for entry in entries.values())
+        for key in sorted(entries, key=lambda key: entries[key]['last_used']):
+            if total <= self.max_size:
+                break
+            entry = entries.pop(key)
+            total -= entry['bytes']
+            for file_name in entry['arrays'].values():
+                file_name = os.path.join(self.cache_dir, file_name)
+                if os.path.exists(file_name):
+                    os.remove(file_name)
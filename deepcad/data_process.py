@@ -1,10 +1,19 @@
 import numpy as np
 import os
+import tempfile
+import weakref
+import queue
+import threading
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None  # python < 3.8, only the 'file' backend of stack_store is available
 import tifffile as tiff
 import random
 import math
 import torch
 from torch.utils.data import Dataset
+from torch.utils.data.distributed import DistributedSampler
 from skimage import io
 
 
@@ -54,17 +63,263 @@ def random_transform(input, target):
     return input, target
 
 
+def random_transform_batch(input, target):
+    """
+    The batched version of the data augmentation, applied on the training device after the transfer. For every
+    sample of the batch, the input and the target are swapped with a probability of 0.5 and one of the eight
+    rotation/flip transforms of random_transform is applied to both. Patches which are not square in x and y only
+    use the transforms keeping their shape (no rotation, 180 degree rotation and their horizontal flips).
+
+    Args:
+        input, target : the input and target batches (batch, channel, t, y, x) before data augmentation
+    Return:
+        input, target : the input and target batches after data augmentation
+    """
+    batch_size = input.shape[0]
+    swap = (torch.rand(batch_size, device=input.device) < 0.5).view(-1, 1, 1, 1, 1)
+    input, target = torch.where(swap, target, input), torch.where(swap, input, target)
+
+    square = input.shape[3] == input.shape[4]
+    p_trans = torch.randint(8, (batch_size,))
+    if not square:
+        p_trans = p_trans // 2 * 2  # rotations by 0 or 180 degrees, with or without horizontal flip
+    for trans in p_trans.unique().tolist():
+        if trans == 0:
+            continue
+        index = (p_trans == trans).nonzero().view(-1).to(input.device)
+        patches = torch.cat((input[index], target[index]))
+        if trans >= 4:  # horizontal flip
+            patches = patches.flip(4)
+        patches = torch.rot90(patches, k=trans % 4, dims=(3, 4))  # left rotate 90 * k
+        input[index], target[index] = patches.chunk(2)
+    return input, target
+
+
+class memmap_stack():
+    """
+    Out-of-core noisy stack. The tif file is opened as a memory map (or read page by page if the data
+    are compressed or not contiguous) and only the frames requested by a slice are read from disk,
+    converted to float32, scaled and mean-subtracted. Slicing it behaves like slicing the preprocessed
+    in-memory stack, so it can be used anywhere a float32 stack is expected.
+
+    Args:
+        im_dir : the path of the tif file
+        frame_num : only the first frame_num frames are used (use all frames by default)
+        scale_factor : the factor for image intensity scaling
+        mean : the value subtracted from every scaled frame. If None, the mean of the scaled stack is used
+    """
+
+    def __init__(self, im_dir, frame_num=None, scale_factor=1, mean=None):
+        self.im_dir = im_dir
+        self.scale_factor = scale_factor
+        self._raw = None
+        self._tif = None
+        self.raw_shape = tuple(self.open())
+        whole_t = self.raw_shape[0]
+        if frame_num is not None:
+            whole_t = min(whole_t, frame_num)
+        self.shape = (whole_t,) + self.raw_shape[1:]
+        self.ndim = len(self.shape)
+        if mean is None:
+            mean = self.raw_mean(self.shape[0]) / self.scale_factor
+        self.mean = np.float32(mean)
+
+    def open(self):
+        """
+        Open the tif file. The memory map is used if possible, otherwise the pages are read one by one.
+
+        Return:
+            raw_shape : the shape of the whole stack in the file
+        """
+        try:
+            self._raw = tiff.memmap(self.im_dir, mode='r')
+            self.dtype = self._raw.dtype
+            return self._raw.shape
+        except ValueError:
+            self._raw = None
+            self._tif = tiff.TiffFile(self.im_dir)
+            self.dtype = self._tif.series[0].dtype
+            return self._tif.series[0].shape
+
+    def raw_mean(self, frame_num=None, chunk_t=64):
+        """
+        Calculate the mean of the raw (unscaled) frames chunk by chunk so that the stack is never loaded at once.
+
+        Args:
+            frame_num : the number of frames from the start of the file taken into account (up to raw_shape[0])
+            chunk_t : the number of frames read at a time
+        Return:
+            mean : the mean intensity of the raw frames
+        """
+        if frame_num is None:
+            frame_num = self.shape[0]
+        total = 0.0
+        for init_s in range(0, frame_num, chunk_t):
+            total += self.read_raw(slice(init_s, min(init_s + chunk_t, frame_num))).sum(dtype=np.float64)
+        return total / (frame_num * int(np.prod(self.shape[1:])))
+
+    def read_raw(self, index_s, index_h=slice(None), index_w=slice(None)):
+        """
+        Read the raw frames selected by the slices from the file.
+        """
+        if self._raw is None and self._tif is None:
+            self.open()
+        if self._raw is not None:
+            return np.asarray(self._raw[index_s, index_h, index_w])
+        frames = [self._tif.pages[s].asarray()[index_h, index_w] for s in range(*index_s.indices(self.raw_shape[0]))]
+        return np.stack(frames, axis=0)
+
+    def __getitem__(self, index):
+        if not isinstance(index, tuple):
+            index = (index,)
+        index = index + (slice(None),) * (3 - len(index))
+        index_s = index[0]
+        if not isinstance(index_s, slice):
+            index_s = slice(index_s, index_s + 1)
+        index_s = slice(*index_s.indices(self.shape[0]))
+        patch = self.read_raw(index_s, index[1], index[2])
+        patch = patch.astype(np.float32) / self.scale_factor
+        patch = patch - self.mean
+        if not isinstance(index[0], slice):
+            patch = patch[0]
+        return patch
+
+    def __getstate__(self):
+        # file handles are not shared between DataLoader workers, each worker reopens the file
+        state = self.__dict__.copy()
+        state['_raw'] = None
+        state['_tif'] = None
+        return state
+
+
+class stack_store():
+    """
+    Shared store of preprocessed stacks for multi-worker data loading. Every stack is copied once into a POSIX
+    shared memory block (backend 'shm') or into a memory-mapped cache file (backend 'file'), and indexing the store
+    with a stack id returns a zero-copy array view of it. Pickling the store (DataLoader workers started with spawn,
+    or distributed training processes) only sends the names of the blocks, the workers attach to them lazily (and
+    must not write to them), so raising num_workers does not multiply the memory used by the stacks. The blocks are
+    released by the process which created the store when it is closed or garbage collected.
+
+    Args:
+        backend : 'shm' (multiprocessing.shared_memory) or 'file' (np.memmap of a file in cache_dir)
+        cache_dir : the folder of the cache files of the 'file' backend (the temporary folder by default)
+    """
+
+    def __init__(self, backend='shm', cache_dir=None):
+        if backend not in ('shm', 'file'):
+            raise ValueError("backend must be 'shm' or 'file', got '{}'".format(backend))
+        if backend == 'shm' and shared_memory is None:
+            raise RuntimeError("the 'shm' backend requires python >= 3.8, use the 'file' backend")
+        self.backend = backend
+        self.cache_dir = cache_dir
+        self.specs = {}  # stack id -> (block name, shape, dtype)
+        self._blocks = {}  # stack id -> (shared memory block or None, array view), not pickled
+        self._finalizer = weakref.finalize(self, stack_store._release, self.backend, self.specs, self._blocks)
+
+    def append(self, stack):
+        """
+        Copy a stack into the store.
+        Args:
+            stack : the stack (any array-like)
+        Return:
+            stack_id : the index of the stack in the store
+        """
+        stack = np.asarray(stack)
+        stack_id = len(self.specs)
+        if self.backend == 'shm':
+            block = shared_memory.SharedMemory(create=True, size=max(stack.nbytes, 1))
+            name = block.name
+            view = np.ndarray(stack.shape, dtype=stack.dtype, buffer=block.buf)
+        else:
+            fd, name = tempfile.mkstemp(prefix='deepcad_stack_', suffix='.dat', dir=self.cache_dir)
+            os.close(fd)
+            block = None
+            view = np.memmap(name, dtype=stack.dtype, mode='w+', shape=stack.shape)
+        view[...] = stack
+        self.specs[stack_id] = (name, stack.shape, stack.dtype.str)
+        self._blocks[stack_id] = (block, view)
+        return stack_id
+
+    def __getitem__(self, stack_id):
+        stack_id = int(stack_id)
+        if stack_id not in self._blocks:
+            self._blocks[stack_id] = self._attach(*self.specs[stack_id])
+        return self._blocks[stack_id][1]
+
+    def __len__(self):
+        return len(self.specs)
+
+    def _attach(self, name, shape, dtype):
+        if self.backend == 'shm':
+            # the workers share the resource tracker of the process which created the block, which unlinks it
+            block = shared_memory.SharedMemory(name=name)
+            view = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        else:
+            block = None
+            # copy-on-write, a worker cannot modify the cache file
+            view = np.memmap(name, dtype=dtype, mode='c', shape=shape)
+        return block, view
+
+    def remove(self, stack_id):
+        """
+        Release a stack of the store (created by this process).
+        """
+        stack_store._release(self.backend, {stack_id: self.specs.pop(stack_id)}, {stack_id: self._blocks.pop(stack_id)})
+
+    def close(self):
+        """
+        Release all stacks of the store (created by this process).
+        """
+        if self._finalizer is not None:
+            self._finalizer()
+
+    @staticmethod
+    def _release(backend, specs, blocks):
+        for stack_id in list(blocks):
+            block, view = blocks.pop(stack_id)
+            del view
+            if block is not None:
+                try:
+                    block.close()
+                except BufferError:
+                    pass  # a view of the stack is still alive, the memory is freed with it
+                block.unlink()
+        if backend == 'file':
+            for name, _, _ in specs.values():
+                if os.path.exists(name):
+                    os.remove(name)
+        specs.clear()
+
+    def __getstate__(self):
+        # only the names of the blocks are sent, the copies attach to them and do not release them
+        return {'backend': self.backend, 'cache_dir': self.cache_dir, 'specs': self.specs}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._blocks = {}
+        self._finalizer = None
+
+
+# Columns of the patch coordinate tables. Every patch is one row of an int32 array, so the tables are built with
+# array arithmetic and the DataLoader collates plain integer tensors.
+TRAIN_COLUMNS = ('stack', 'init_s', 'end_s', 'init_h', 'end_h', 'init_w', 'end_w')
+TEST_COLUMNS = ('init_s', 'end_s', 'init_h', 'end_h', 'init_w', 'end_w',
+                'stack_start_s', 'stack_end_s', 'patch_start_s', 'patch_end_s',
+                'stack_start_h', 'stack_end_h', 'patch_start_h', 'patch_end_h',
+                'stack_start_w', 'stack_end_w', 'patch_start_w', 'patch_end_w')
+
+
 class trainset(Dataset):
     """
     Train set generator for pytorch training
 
     """
 
-    def __init__(self, name_list, coordinate_list, noise_img_all, stack_index):
-        self.name_list = name_list
-        self.coordinate_list = coordinate_list
+    def __init__(self, coordinate_table, noise_img_all, augment=True):
+        self.coordinate_table = coordinate_table
         self.noise_img_all = noise_img_all
-        self.stack_index = stack_index
+        self.augment = augment  # if False, the patches are augmented by random_transform_batch on the device
 
     def __getitem__(self, index):
         """
@@ -77,17 +332,15 @@ class trainset(Dataset):
         Return:
             input, target : the consecutive frames of the 3D noisy patch serve as the input and target of the network
         """
-        stack_index = self.stack_index[index]
+        stack_index, init_s, end_s, init_h, end_h, init_w, end_w = self.coordinate_table[index]
         noise_img = self.noise_img_all[stack_index]
-        single_coordinate = self.coordinate_list[self.name_list[index]]
-        init_h = single_coordinate['init_h']
-        end_h = single_coordinate['end_h']
-        init_w = single_coordinate['init_w']
-        end_w = single_coordinate['end_w']
-        init_s = single_coordinate['init_s']
-        end_s = single_coordinate['end_s']
-        input = noise_img[init_s:end_s:2, init_h:end_h, init_w:end_w]
-        target = noise_img[init_s + 1:end_s:2, init_h:end_h, init_w:end_w]
+        # read the whole sub-stack at once (a single disk read for memory-mapped stacks)
+        noise_patch = np.asarray(noise_img[init_s:end_s, init_h:end_h, init_w:end_w])
+        input = noise_patch[0::2]
+        target = noise_patch[1::2]
+        if not self.augment:
+            # strided views of the sub-stack, the only copy is the collation of the batch
+            return torch.from_numpy(np.expand_dims(input, 0)), torch.from_numpy(np.expand_dims(target, 0))
         p_exc = random.random()  # generate a random number determinate whether swap input and target
         if p_exc < 0.5:
             input, target = random_transform(input, target)
@@ -102,7 +355,32 @@ class trainset(Dataset):
         return input, target
 
     def __len__(self):
-        return len(self.name_list)
+        return len(self.coordinate_table)
+
+
+class resumable_sampler(DistributedSampler):
+    """
+    Sampler of the training patches whose order only depends on the seed and the epoch (the same as
+    DistributedSampler), and which can start an epoch after the patches already trained on, so that an
+    interrupted training is resumed with the same patch order. Without distributed training, the sampler is
+    created with num_replicas=1 and rank=0.
+    """
+
+    def __init__(self, dataset, num_replicas=1, rank=0, shuffle=True, seed=0):
+        super().__init__(dataset, num_replicas=num_replicas, rank=rank, shuffle=shuffle, seed=seed)
+        self.start = 0
+
+    def set_start(self, start):
+        """
+        Skip the first start patches (of this process) in the next epochs.
+        """
+        self.start = start
+
+    def __iter__(self):
+        return iter(list(super().__iter__())[self.start:])
+
+    def __len__(self):
+        return self.num_samples - self.start
 
 
 class testset(Dataset):
@@ -111,10 +389,10 @@ class testset(Dataset):
 
     """
 
-    def __init__(self, name_list, coordinate_list, noise_img):
-        self.name_list = name_list
-        self.coordinate_list = coordinate_list
+    def __init__(self, coordinate_table, noise_img, stack_id=None):
+        self.coordinate_table = coordinate_table
         self.noise_img = noise_img
+        self.stack_id = stack_id  # if set, noise_img is a stack_store and the stack is read from it
 
     def __getitem__(self, index):
         """
@@ -123,21 +401,18 @@ class testset(Dataset):
             index : the index of 3D patch used for testing
         Return:
             noise_patch : the sub-stacks of the noisy image
-            single_coordinate : the specific coordinate of sub-stacks in the noisy image for stitching all sub-stacks
+            single_coordinate : the row of the coordinate table (see TEST_COLUMNS) of the sub-stack in the noisy
+                                image for stitching all sub-stacks
         """
-        single_coordinate = self.coordinate_list[self.name_list[index]]
-        init_h = single_coordinate['init_h']
-        end_h = single_coordinate['end_h']
-        init_w = single_coordinate['init_w']
-        end_w = single_coordinate['end_w']
-        init_s = single_coordinate['init_s']
-        end_s = single_coordinate['end_s']
-        noise_patch = self.noise_img[init_s:end_s, init_h:end_h, init_w:end_w]
+        single_coordinate = self.coordinate_table[index]
+        init_s, end_s, init_h, end_h, init_w, end_w = single_coordinate[0:6]
+        noise_img = self.noise_img if self.stack_id is None else self.noise_img[self.stack_id]
+        noise_patch = noise_img[init_s:end_s, init_h:end_h, init_w:end_w]
         noise_patch = torch.from_numpy(np.expand_dims(noise_patch, 0))
-        return noise_patch, single_coordinate
+        return noise_patch, torch.from_numpy(single_coordinate)
 
     def __len__(self):
-        return len(self.name_list)
+        return len(self.coordinate_table)
 
 
 def get_gap_t(args, img, stack_num):
@@ -158,6 +433,29 @@ def get_gap_t(args, img, stack_num):
     return gap_t
 
 
+def train_partition(stack_index, whole_t, whole_y, whole_x, patch_t2, patch_y, patch_x, gap_t, gap_y, gap_x):
+    """
+    Partition a noisy stack into 3D sub-stacks (patch) for training. The patches are ordered with the temporal
+    index changing fastest, followed by the width index and the height index.
+
+    Args:
+        stack_index : the index of the noisy stack the patches belong to
+        whole_t, whole_y, whole_x : the size of the noisy stack
+        patch_t2 : the number of frames of a training sub-stack (two interlaced patches)
+        patch_y, patch_x : the lateral size of the patches
+        gap_t, gap_y, gap_x : the patch gap in each dimension
+    Returns:
+        coordinate_table : int32 array with one row (see TRAIN_COLUMNS) per patch
+    """
+    init_h = gap_y * np.arange(int((whole_y - patch_y + gap_y) / gap_y))
+    init_w = gap_x * np.arange(int((whole_x - patch_x + gap_x) / gap_x))
+    init_s = gap_t * np.arange(int((whole_t - patch_t2 + gap_t) / gap_t))
+    init_h, init_w, init_s = np.meshgrid(init_h, init_w, init_s, indexing='ij')
+    coordinate_table = np.stack([np.full(init_s.shape, stack_index), init_s, init_s + patch_t2,
+                                 init_h, init_h + patch_y, init_w, init_w + patch_x], axis=-1)
+    return coordinate_table.reshape(-1, len(TRAIN_COLUMNS)).astype(np.int32)
+
+
 def train_preprocess_lessMemoryMulStacks(args):
     patch_y = args.patch_y
     patch_x = args.patch_x
@@ -166,9 +464,7 @@ def train_preprocess_lessMemoryMulStacks(args):
     gap_x = args.gap_x
     im_folder = args.datasets_path + '//' + args.datasets_folder
 
-    name_list = []
-    coordinate_list = {}
-    stack_index = []
+    coordinate_table = []
     noise_im_all = []
     ind = 0;
     print('\033[1;31mImage list for training -----> \033[0m')
@@ -183,10 +479,6 @@ def train_preprocess_lessMemoryMulStacks(args):
             noise_im = noise_im[0:args.select_img_num, :, :]
         gap_t2 = get_gap_t(args, noise_im, stack_num)
         args.gap_t = gap_t2
-        # print('gap_t2 -----> ',gap_t2)
-        # print('noise_im shape -----> ',noise_im.shape)
-        # print('noise_im max -----> ',noise_im.max())
-        # print('noise_im min -----> ',noise_im.min())
         noise_im = noise_im.astype(np.float32) / args.scale_factor  # no preprocessing
         # noise_im = (noise_im-noise_im.min()).astype(np.float32)/args.scale_factor 
         noise_im_all.append(noise_im)
@@ -194,135 +486,276 @@ def train_preprocess_lessMemoryMulStacks(args):
         whole_x = noise_im.shape[2]
         whole_y = noise_im.shape[1]
         whole_t = noise_im.shape[0]
-        # print('int((whole_y-patch_y+gap_y)/gap_y) -----> ',int((whole_y-patch_y+gap_y)/gap_y))
-        # print('int((whole_x-patch_x+gap_x)/gap_x) -----> ',int((whole_x-patch_x+gap_x)/gap_x))
-        # print('int((whole_t-patch_t2+gap_t2)/gap_t2) -----> ',int((whole_t-patch_t2+gap_t2)/gap_t2))
-        for x in range(0, int((whole_y - patch_y + gap_y) / gap_y)):
-            for y in range(0, int((whole_x - patch_x + gap_x) / gap_x)):
-                for z in range(0, int((whole_t - patch_t2 + gap_t2) / gap_t2)):
-                    single_coordinate = {'init_h': 0, 'end_h': 0, 'init_w': 0, 'end_w': 0, 'init_s': 0, 'end_s': 0}
-                    init_h = gap_y * x
-                    end_h = gap_y * x + patch_y
-                    init_w = gap_x * y
-                    end_w = gap_x * y + patch_x
-                    init_s = gap_t2 * z
-                    end_s = gap_t2 * z + patch_t2
-                    single_coordinate['init_h'] = init_h
-                    single_coordinate['end_h'] = end_h
-                    single_coordinate['init_w'] = init_w
-                    single_coordinate['end_w'] = end_w
-                    single_coordinate['init_s'] = init_s
-                    single_coordinate['end_s'] = end_s
-                    # noise_patch1 = noise_im[init_s:end_s,init_h:end_h,init_w:end_w]
-                    patch_name = args.datasets_folder + '_' + im_name.replace('.tif', '') + '_x' + str(x) + '_y' + str(
-                        y) + '_z' + str(z)
-                    # train_raw.append(noise_patch1.transpose(1,2,0))
-                    name_list.append(patch_name)
-                    # print(' single_coordinate -----> ',single_coordinate)
-                    coordinate_list[patch_name] = single_coordinate
-                    stack_index.append(ind)
+        coordinate_table.append(train_partition(ind, whole_t, whole_y, whole_x, patch_t2, patch_y, patch_x,
+                                                gap_t2, gap_y, gap_x))
         ind = ind + 1;
-    return name_list, noise_im_all, coordinate_list, stack_index
+    return np.concatenate(coordinate_table), noise_im_all
 
 
-def singlebatch_test_save(single_coordinate, output_image, raw_image):
+def crop_sum(image, coordinate_batch):
     """
-    Subtract overlapping regions (both the lateral and temporal overlaps) from the output sub-stacks (if the batch size equal to 1).
+    Sum every patch of a batch over its non-overlapping region (the part which is stitched into the whole stack).
+    The region is a box, so the masks are applied one dimension at a time without building a full 3D mask.
 
     Args:
-        single_coordinate : the coordinate dict of the image
-        output_image : the output sub-stack of the network
-        raw_image : the noisy sub-stack
+        image : the batch of sub-stacks with the shape (batch, t, h, w)
+        coordinate_batch : the rows of the coordinate table (see TEST_COLUMNS) of the batch
     Returns:
-        output_patch : the output patch after subtract the overlapping regions
-        raw_patch :  the raw patch after subtract the overlapping regions
-        stack_start_ : the start coordinate of the patch in whole stack
-        stack_end_ : the end coordinate of the patch in whole stack
+        patch_sum : the sum of every patch in float64
     """
-    stack_start_w = int(single_coordinate['stack_start_w'])
-    stack_end_w = int(single_coordinate['stack_end_w'])
-    patch_start_w = int(single_coordinate['patch_start_w'])
-    patch_end_w = int(single_coordinate['patch_end_w'])
+    masks = []
+    for i, size in zip((8, 12, 16), image.shape[1:]):
+        position = torch.arange(size, device=image.device)
+        masks.append(((position >= coordinate_batch[:, i, None]) & (position < coordinate_batch[:, i + 1, None])).to(image.dtype))
+    mask_s, mask_h, mask_w = masks
+    patch_sum = (image * mask_w[:, None, None, :]).sum(3)
+    patch_sum = (patch_sum * mask_h[:, None, :]).sum(2)
+    return (patch_sum.double() * mask_s.double()).sum(1)
 
-    stack_start_h = int(single_coordinate['stack_start_h'])
-    stack_end_h = int(single_coordinate['stack_end_h'])
-    patch_start_h = int(single_coordinate['patch_start_h'])
-    patch_end_h = int(single_coordinate['patch_end_h'])
 
-    stack_start_s = int(single_coordinate['stack_start_s'])
-    stack_end_s = int(single_coordinate['stack_end_s'])
-    patch_start_s = int(single_coordinate['patch_start_s'])
-    patch_end_s = int(single_coordinate['patch_end_s'])
+def stitch_batch(denoise_img, fake_B, real_A, coordinate_batch, img_mean):
+    """
+    Subtract the overlapping regions (both the lateral and temporal overlaps) from a batch of output sub-stacks
+    and stitch them into the denoised stack. The intensity of every output patch is rescaled to the intensity of
+    the corresponding noisy patch. The rescaling factors are computed for the whole batch on the device of the
+    network output, then the batch is copied to the host once, in the precision of the network (fp32, fp16 or
+    bf16), and each patch is rescaled in float32 while it is written with a single block copy.
 
-    output_patch = output_image[patch_start_s:patch_end_s, patch_start_h:patch_end_h, patch_start_w:patch_end_w]
-    raw_patch = raw_image[patch_start_s:patch_end_s, patch_start_h:patch_end_h, patch_start_w:patch_end_w]
-    return output_patch, raw_patch, stack_start_w, stack_end_w, stack_start_h, stack_end_h, stack_start_s, stack_end_s
+    Args:
+        denoise_img : the denoised stack (or temporal slab) the sub-stacks are written into
+        fake_B : the batch of output sub-stacks of the network
+        real_A : the batch of noisy sub-stacks
+        coordinate_batch : the rows of the coordinate table (see TEST_COLUMNS) of the batch
+        img_mean : the mean of the raw noisy stack
+    """
+    output_image, scale, coordinate_batch = rescale_batch(fake_B, real_A, coordinate_batch, img_mean)
+    write_batch(denoise_img, output_image.cpu(), scale.cpu(), coordinate_batch.cpu(), img_mean)
 
 
-def multibatch_test_save(single_coordinate, id, output_image, raw_image):
+def rescale_batch(fake_B, real_A, coordinate_batch, img_mean):
+    """
+    Compute the rescaling factors of a batch of output sub-stacks on the device of the network output.
+    Return:
+        output_image : the output sub-stacks (batch, t, h, w) in the precision of the network
+        scale : the float32 rescaling factor of every sub-stack
+        coordinate_batch : the rows of the coordinate table of the batch, on the device of the output
     """
-    Subtract overlapping regions (both the lateral and temporal overlaps) from the output sub-stacks. (if the batch size larger than 1).
+    output_image = fake_B.detach()[:, 0]
+    raw_image = real_A.detach()[:, 0].float() + float(img_mean)
+    coordinate_batch = torch.as_tensor(coordinate_batch).to(output_image.device)
+    scale = (crop_sum(raw_image, coordinate_batch) / crop_sum(output_image.float() + float(img_mean), coordinate_batch)) ** 0.5
+    return output_image, scale.float(), coordinate_batch
+
+
+def write_batch(denoise_img, output_image, scale, coordinate_batch, img_mean):
+    """
+    Rescale the output sub-stacks of a batch (on the host) and write their non-overlapping regions into the
+    denoised stack, one block copy per sub-stack.
+    """
+    if output_image.dtype == torch.bfloat16:
+        # numpy has no bfloat16, the cast is done after the (half size) device to host copy
+        output_image = output_image.float()
+    output_image = output_image.numpy()
+    scale = scale.numpy()
+    img_mean = np.float32(img_mean)
+
+    for id, single_coordinate in enumerate(coordinate_batch.tolist()):
+        stack_start_s, stack_end_s, patch_start_s, patch_end_s, \
+        stack_start_h, stack_end_h, patch_start_h, patch_end_h, \
+        stack_start_w, stack_end_w, patch_start_w, patch_end_w = single_coordinate[6:18]
+        output_patch = output_image[id, patch_start_s:patch_end_s, patch_start_h:patch_end_h, patch_start_w:patch_end_w]
+        denoise_img[stack_start_s:stack_end_s, stack_start_h:stack_end_h, stack_start_w:stack_end_w] \
+            = (output_patch.astype(np.float32) + img_mean) * scale[id]
+
+
+class batch_stitcher():
+    """
+    Stitch the output batches of the network into the denoised stack with the device to host copies overlapped
+    with the computation. On CUDA, the rescaling factors are computed on the device and the batch is copied to
+    pinned host memory on a side stream. The batch is written into the stack when the next batch is submitted (or
+    at flush), so the copy of batch N runs while batch N+1 is computed. On CPU, every batch is stitched at once
+    (stitch_batch).
 
     Args:
-        single_coordinate : the coordinate dict of the image
-        output_image : the output sub-stack of the network
-        raw_image : the noisy sub-stack
-    Returns:
-        output_patch : the output patch after subtract the overlapping regions
-        raw_patch :  the raw patch after subtract the overlapping regions
-        stack_start_ : the start coordinate of the patch in whole stack
-        stack_end_ : the end coordinate of the patch in whole stack
-    """
-    stack_start_w_id = single_coordinate['stack_start_w'].numpy()
-    stack_start_w = int(stack_start_w_id[id])
-    stack_end_w_id = single_coordinate['stack_end_w'].numpy()
-    stack_end_w = int(stack_end_w_id[id])
-    patch_start_w_id = single_coordinate['patch_start_w'].numpy()
-    patch_start_w = int(patch_start_w_id[id])
-    patch_end_w_id = single_coordinate['patch_end_w'].numpy()
-    patch_end_w = int(patch_end_w_id[id])
-
-    stack_start_h_id = single_coordinate['stack_start_h'].numpy()
-    stack_start_h = int(stack_start_h_id[id])
-    stack_end_h_id = single_coordinate['stack_end_h'].numpy()
-    stack_end_h = int(stack_end_h_id[id])
-    patch_start_h_id = single_coordinate['patch_start_h'].numpy()
-    patch_start_h = int(patch_start_h_id[id])
-    patch_end_h_id = single_coordinate['patch_end_h'].numpy()
-    patch_end_h = int(patch_end_h_id[id])
-
-    stack_start_s_id = single_coordinate['stack_start_s'].numpy()
-    stack_start_s = int(stack_start_s_id[id])
-    stack_end_s_id = single_coordinate['stack_end_s'].numpy()
-    stack_end_s = int(stack_end_s_id[id])
-    patch_start_s_id = single_coordinate['patch_start_s'].numpy()
-    patch_start_s = int(patch_start_s_id[id])
-    patch_end_s_id = single_coordinate['patch_end_s'].numpy()
-    patch_end_s = int(patch_end_s_id[id])
-
-    output_image_id = output_image[id]
-    raw_image_id = raw_image[id]
-    output_patch = output_image_id[patch_start_s:patch_end_s, patch_start_h:patch_end_h, patch_start_w:patch_end_w]
-    raw_patch = raw_image_id[patch_start_s:patch_end_s, patch_start_h:patch_end_h, patch_start_w:patch_end_w]
-
-    return output_patch, raw_patch, stack_start_w, stack_end_w, stack_start_h, stack_end_h, stack_start_s, stack_end_s
+        denoise_img : the denoised stack (or temporal slab) the sub-stacks are written into
+        img_mean : the mean of the raw noisy stack
+    """
+
+    def __init__(self, denoise_img, img_mean):
+        self.denoise_img = denoise_img
+        self.img_mean = img_mean
+        self.stream = None
+        self.pending = None
+
+    def submit(self, fake_B, real_A, coordinate_batch):
+        """
+        Rescale a batch and start its copy to the host (see stitch_batch for the arguments).
+        """
+        output_image, scale, coordinate_batch = rescale_batch(fake_B, real_A, coordinate_batch, self.img_mean)
+        if output_image.device.type != 'cuda':
+            write_batch(self.denoise_img, output_image, scale, coordinate_batch, self.img_mean)
+            return
+        if self.stream is None:
+            self.stream = torch.cuda.Stream()
+        self.stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(self.stream):
+            host_batch = [torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True).copy_(tensor, non_blocking=True)
+                          for tensor in (output_image, scale, coordinate_batch)]
+            copied = torch.cuda.Event()
+            copied.record(self.stream)
+        # the previous batch is written while this one is copied, the device tensors are kept until then
+        self.flush()
+        self.pending = (copied, host_batch, (output_image, scale, coordinate_batch))
+
+    def flush(self):
+        """
+        Write the batch whose copy is pending into the denoised stack.
+        """
+        if self.pending is None:
+            return
+        copied, host_batch, _ = self.pending
+        copied.synchronize()
+        write_batch(self.denoise_img, *host_batch, self.img_mean)
+        self.pending = None
+
+
+class device_prefetcher():
+    """
+    Iterate over a DataLoader and upload the next batch to the device while the current one is processed. On
+    CUDA, the batches are copied from pinned host memory (pin_memory of the DataLoader, or pinned here) with
+    non-blocking copies on a side stream, and the compute stream waits for the copy of a batch only when the batch
+    is used. On CPU, the batches are returned as they are (optionally cast to dtype).
+
+    Args:
+        loader : the DataLoader
+        device : 'cuda' or 'cpu'
+        dtype : the dtype the floating point tensors of the batches are cast to (None to keep it)
+    """
+
+    def __init__(self, loader, device, dtype=None):
+        self.loader = loader
+        self.device = device
+        self.dtype = dtype
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        stream = torch.cuda.Stream() if self.device == 'cuda' else None
+        iterator = iter(self.loader)
+        next_batch = self._load(iterator, stream)
+        while next_batch is not None:
+            batch = next_batch
+            if stream is not None:
+                torch.cuda.current_stream().wait_stream(stream)
+                for tensor in batch:
+                    # the memory was allocated on the side stream but is used (and freed) on the compute stream
+                    tensor.record_stream(torch.cuda.current_stream())
+            next_batch = self._load(iterator, stream)
+            yield batch
+
+    def _load(self, iterator, stream):
+        try:
+            batch = next(iterator)
+        except StopIteration:
+            return None
+        if stream is None:
+            return [self._cast(tensor.to(self.device)) for tensor in batch]
+        with torch.cuda.stream(stream):
+            batch = [tensor if tensor.is_pinned() else tensor.pin_memory() for tensor in batch]
+            return [self._cast(tensor.to(self.device, non_blocking=True)) for tensor in batch]
+
+    def _cast(self, tensor):
+        if self.dtype is not None and tensor.is_floating_point():
+            return tensor.to(self.dtype)
+        return tensor
+
+
+class stack_scheduler():
+    """
+    Read and partition the stacks in a background thread and pack their patches into batches in another one, so
+    that the device is kept busy across a folder of (short) recordings: the next stacks are read while the current
+    one is denoised, and the last batch of a stack is filled up with the first patches of the next one.
+    Iterating over the scheduler yields two kinds of items, in order:
+        ('stack', img_id, shape, img_mean, input_data_type, patch_num) : before the first patch of a stack
+        ('batch', noise_patch, coordinate_batch, stack_index) : a batch of patches (see testset), stack_index is
+                                                                  the img_id of every patch of the batch
+
+    Args:
+        read_stack : the function reading a stack, read_stack(img_id) returns the same as test_preprocess_chooseOne
+        img_ids : the ids of the stacks
+        batch_size : the number of patches of a batch
+        prefetch_stacks : the number of stacks read ahead of the batches
+        pin_memory : pin the batches for asynchronous copies to the GPU
+    """
+
+    def __init__(self, read_stack, img_ids, batch_size, prefetch_stacks=2, pin_memory=False):
+        self.read_stack = read_stack
+        self.img_ids = list(img_ids)
+        self.batch_size = batch_size
+        self.prefetch_stacks = max(prefetch_stacks, 1)
+        self.pin_memory = pin_memory
+
+    def __iter__(self):
+        stack_queue = queue.Queue(maxsize=self.prefetch_stacks)
+        batch_queue = queue.Queue(maxsize=2)
+        threading.Thread(target=self._read, args=(stack_queue,), daemon=True).start()
+        threading.Thread(target=self._pack, args=(stack_queue, batch_queue), daemon=True).start()
+        for item in iter(batch_queue.get, None):
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+    def _read(self, stack_queue):
+        try:
+            for img_id in self.img_ids:
+                coordinate_table, noise_im, _, img_mean, input_data_type = self.read_stack(img_id)
+                stack_queue.put((img_id, coordinate_table, noise_im, img_mean, input_data_type))
+            stack_queue.put(None)
+        except BaseException as error:
+            stack_queue.put(error)
+
+    def _pack(self, stack_queue, batch_queue):
+        try:
+            batch = None
+            for stack in iter(stack_queue.get, None):
+                if isinstance(stack, BaseException):
+                    raise stack
+                img_id, coordinate_table, noise_im, img_mean, input_data_type = stack
+                batch_queue.put(('stack', img_id, noise_im.shape, img_mean, input_data_type, len(coordinate_table)))
+                for single_coordinate in coordinate_table:
+                    if batch is None:
+                        init_s, end_s, init_h, end_h, init_w, end_w = single_coordinate[0:6]
+                        batch_shape = (self.batch_size, 1, end_s - init_s, end_h - init_h, end_w - init_w)
+                        batch = [np.empty(batch_shape, dtype=np.float32),
+                                 np.empty((self.batch_size, len(single_coordinate)), dtype=single_coordinate.dtype),
+                                 np.empty(self.batch_size, dtype=np.int64), 0]
+                    noise_patch, coordinate_batch, stack_index, size = batch
+                    init_s, end_s, init_h, end_h, init_w, end_w = single_coordinate[0:6]
+                    noise_patch[size, 0] = noise_im[init_s:end_s, init_h:end_h, init_w:end_w]
+                    coordinate_batch[size] = single_coordinate
+                    stack_index[size] = img_id
+                    batch[3] = size + 1
+                    if batch[3] == self.batch_size:
+                        batch_queue.put(self._batch(*batch))
+                        batch = None
+                del noise_im
+            if batch is not None:
+                batch_queue.put(self._batch(*batch))
+            batch_queue.put(None)
+        except BaseException as error:
+            batch_queue.put(error)
+
+    def _batch(self, noise_patch, coordinate_batch, stack_index, size):
+        tensors = [torch.from_numpy(array[:size]) for array in (noise_patch, coordinate_batch, stack_index)]
+        if self.pin_memory:
+            tensors = [tensor.pin_memory() for tensor in tensors]
+        return ('batch',) + tuple(tensors)
 
 
 def test_preprocess_lessMemoryNoTail_chooseOne(args, N):
-    patch_y = args.patch_y
-    patch_x = args.patch_x
-    patch_t2 = args.patch_t
-    gap_y = args.gap_y
-    gap_x = args.gap_x
-    gap_t2 = args.gap_t
-    cut_w = (patch_x - gap_x) / 2
-    cut_h = (patch_y - gap_y) / 2
-    cut_s = (patch_t2 - gap_t2) / 2
     im_folder = args.datasets_path + '//' + args.datasets_folder
 
-    name_list = []
-    # train_raw = []
-    coordinate_list = {}
     img_list = list(os.walk(im_folder, topdown=False))[-1][-1]
     img_list.sort()
     # print(img_list)
@@ -331,9 +764,6 @@ def test_preprocess_lessMemoryNoTail_chooseOne(args, N):
 
     im_dir = im_folder + '//' + im_name
     noise_im = tiff.imread(im_dir)
-    # print('noise_im shape -----> ',noise_im.shape)
-    # print('noise_im max -----> ',noise_im.max())
-    # print('noise_im min -----> ',noise_im.min())
     if noise_im.shape[0] > args.test_datasize:
         noise_im = noise_im[0:args.test_datasize, :, :]
     noise_im = noise_im.astype(np.float32) / args.scale_factor
@@ -342,131 +772,144 @@ def test_preprocess_lessMemoryNoTail_chooseOne(args, N):
     whole_x = noise_im.shape[2]
     whole_y = noise_im.shape[1]
     whole_t = noise_im.shape[0]
+    coordinate_table = test_partition(whole_t, whole_y, whole_x, args.patch_t, args.patch_y, args.patch_x,
+                                      args.gap_t, args.gap_y, args.gap_x)
+    return coordinate_table, noise_im
+
+
+def axis_partition(whole, patch, gap):
+    """
+    Calculate the patch positions along one dimension of the stack for inference. The last patch is aligned
+    with the end of the stack and half of the overlap is cut off on both sides of every patch (except at the
+    borders of the stack) when stitching.
+
+    Args:
+        whole : the size of the stack in this dimension
+        patch : the patch size in this dimension
+        gap : the patch gap in this dimension
+    Returns:
+        columns : the init, end, stack_start, stack_end, patch_start and patch_end arrays of the patches
+    """
+    cut = (patch - gap) / 2
+    num = math.ceil((whole - patch + gap) / gap)
+    index = np.arange(num)
+    first = index == 0
+    last = (index == num - 1) & ~first
+
+    init = np.where(index == num - 1, whole - patch, gap * index)
+    stack_start = np.where(first, 0, np.where(last, whole - patch + cut, index * gap + cut))
+    stack_end = np.where(last, whole, index * gap + patch - cut)
+    patch_start = np.where(first, 0, cut)
+    patch_end = np.where(last, patch, patch - cut)
+    # the coordinates are truncated to integers when stitching
+    return [init, init + patch] + [np.floor(i).astype(np.int64) for i in (stack_start, stack_end, patch_start, patch_end)]
+
+
+def test_partition(whole_t, whole_y, whole_x, patch_t, patch_y, patch_x, gap_t, gap_y, gap_x):
+    """
+    Partition a noisy stack of the given size into 3D sub-stacks (patch) with the setting patch gap in each
+    dimension and record where the non-overlapping part of every patch is placed when stitching. The patches
+    are ordered with the temporal index changing fastest, followed by the width index and the height index.
+
+    Args:
+        whole_t, whole_y, whole_x : the size of the noisy stack
+        patch_t, patch_y, patch_x : the patch size in each dimension
+        gap_t, gap_y, gap_x : the patch gap in each dimension
+    Returns:
+        coordinate_table : int32 array with one row (see TEST_COLUMNS) per patch
+    """
+    columns_s = axis_partition(whole_t, patch_t, gap_t)
+    columns_h = axis_partition(whole_y, patch_y, gap_y)
+    columns_w = axis_partition(whole_x, patch_x, gap_x)
+    index_h, index_w, index_s = np.meshgrid(np.arange(len(columns_h[0])), np.arange(len(columns_w[0])),
+                                            np.arange(len(columns_s[0])), indexing='ij')
+    index_h, index_w, index_s = index_h.ravel(), index_w.ravel(), index_s.ravel()
+
+    coordinate_table = np.empty((len(index_s), len(TEST_COLUMNS)), dtype=np.int32)
+    for i in range(2):
+        coordinate_table[:, i] = columns_s[i][index_s]
+        coordinate_table[:, 2 + i] = columns_h[i][index_h]
+        coordinate_table[:, 4 + i] = columns_w[i][index_w]
+    for i in range(4):
+        coordinate_table[:, 6 + i] = columns_s[2 + i][index_s]
+        coordinate_table[:, 10 + i] = columns_h[2 + i][index_h]
+        coordinate_table[:, 14 + i] = columns_w[2 + i][index_w]
+    return coordinate_table
+
+
+def test_table(cache, im_dir, whole_t, whole_y, whole_x, patch_t, patch_y, patch_x, gap_t, gap_y, gap_x):
+    """
+    test_partition with an on-disk cache. The patch table is read from the cache if it is there, and stored in
+    it otherwise.
+
+    Args:
+        cache : the preprocess_cache, or None to partition the stack without cache
+        im_dir : the path of the noisy stack
+        others : see test_partition
+    Returns:
+        coordinate_table : int32 array with one row (see TEST_COLUMNS) per patch
+    """
+    if cache is not None:
+        key = cache.key(im_dir, table='test', whole=[whole_t, whole_y, whole_x], patch=[patch_t, patch_y, patch_x],
+                        gap=[gap_t, gap_y, gap_x])
+        entry = cache.get(key)
+        if entry is not None:
+            return np.array(entry[0]['table'])
+    coordinate_table = test_partition(whole_t, whole_y, whole_x, patch_t, patch_y, patch_x, gap_t, gap_y, gap_x)
+    if cache is not None:
+        cache.put(key, {'table': coordinate_table}, {})
+    return coordinate_table
+
+
+def stack_raw_mean(cache, noise_im, frame_num=None):
+    """
+    The mean of the raw frames of a memmap_stack with an on-disk cache. The mean is read from the cache if it is
+    there, and computed (a pass over the frames, see memmap_stack.raw_mean) and stored in it otherwise.
 
-    num_w = math.ceil((whole_x - patch_x + gap_x) / gap_x)
-    num_h = math.ceil((whole_y - patch_y + gap_y) / gap_y)
-    num_s = math.ceil((whole_t - patch_t2 + gap_t2) / gap_t2)
-    # print('int((whole_y-patch_y+gap_y)/gap_y) -----> ',int((whole_y-patch_y+gap_y)/gap_y))
-    # print('int((whole_x-patch_x+gap_x)/gap_x) -----> ',int((whole_x-patch_x+gap_x)/gap_x))
-    # print('int((whole_t-patch_t2+gap_t2)/gap_t2) -----> ',int((whole_t-patch_t2+gap_t2)/gap_t2))
-    for x in range(0, num_h):
-        for y in range(0, num_w):
-            for z in range(0, num_s):
-                single_coordinate = {'init_h': 0, 'end_h': 0, 'init_w': 0, 'end_w': 0, 'init_s': 0, 'end_s': 0}
-                if x != (num_h - 1):
-                    init_h = gap_y * x
-                    end_h = gap_y * x + patch_y
-                elif x == (num_h - 1):
-                    init_h = whole_y - patch_y
-                    end_h = whole_y
-
-                if y != (num_w - 1):
-                    init_w = gap_x * y
-                    end_w = gap_x * y + patch_x
-                elif y == (num_w - 1):
-                    init_w = whole_x - patch_x
-                    end_w = whole_x
-
-                if z != (num_s - 1):
-                    init_s = gap_t2 * z
-                    end_s = gap_t2 * z + patch_t2
-                elif z == (num_s - 1):
-                    init_s = whole_t - patch_t2
-                    end_s = whole_t
-                single_coordinate['init_h'] = init_h
-                single_coordinate['end_h'] = end_h
-                single_coordinate['init_w'] = init_w
-                single_coordinate['end_w'] = end_w
-                single_coordinate['init_s'] = init_s
-                single_coordinate['end_s'] = end_s
-
-                if y == 0:
-                    single_coordinate['stack_start_w'] = y * gap_x
-                    single_coordinate['stack_end_w'] = y * gap_x + patch_x - cut_w
-                    single_coordinate['patch_start_w'] = 0
-                    single_coordinate['patch_end_w'] = patch_x - cut_w
-                elif y == num_w - 1:
-                    single_coordinate['stack_start_w'] = whole_x - patch_x + cut_w
-                    single_coordinate['stack_end_w'] = whole_x
-                    single_coordinate['patch_start_w'] = cut_w
-                    single_coordinate['patch_end_w'] = patch_x
-                else:
-                    single_coordinate['stack_start_w'] = y * gap_x + cut_w
-                    single_coordinate['stack_end_w'] = y * gap_x + patch_x - cut_w
-                    single_coordinate['patch_start_w'] = cut_w
-                    single_coordinate['patch_end_w'] = patch_x - cut_w
-
-                if x == 0:
-                    single_coordinate['stack_start_h'] = x * gap_y
-                    single_coordinate['stack_end_h'] = x * gap_y + patch_y - cut_h
-                    single_coordinate['patch_start_h'] = 0
-                    single_coordinate['patch_end_h'] = patch_y - cut_h
-                elif x == num_h - 1:
-                    single_coordinate['stack_start_h'] = whole_y - patch_y + cut_h
-                    single_coordinate['stack_end_h'] = whole_y
-                    single_coordinate['patch_start_h'] = cut_h
-                    single_coordinate['patch_end_h'] = patch_y
-                else:
-                    single_coordinate['stack_start_h'] = x * gap_y + cut_h
-                    single_coordinate['stack_end_h'] = x * gap_y + patch_y - cut_h
-                    single_coordinate['patch_start_h'] = cut_h
-                    single_coordinate['patch_end_h'] = patch_y - cut_h
-
-                if z == 0:
-                    single_coordinate['stack_start_s'] = z * gap_t2
-                    single_coordinate['stack_end_s'] = z * gap_t2 + patch_t2 - cut_s
-                    single_coordinate['patch_start_s'] = 0
-                    single_coordinate['patch_end_s'] = patch_t2 - cut_s
-                elif z == num_s - 1:
-                    single_coordinate['stack_start_s'] = whole_t - patch_t2 + cut_s
-                    single_coordinate['stack_end_s'] = whole_t
-                    single_coordinate['patch_start_s'] = cut_s
-                    single_coordinate['patch_end_s'] = patch_t2
-                else:
-                    single_coordinate['stack_start_s'] = z * gap_t2 + cut_s
-                    single_coordinate['stack_end_s'] = z * gap_t2 + patch_t2 - cut_s
-                    single_coordinate['patch_start_s'] = cut_s
-                    single_coordinate['patch_end_s'] = patch_t2 - cut_s
-
-                # noise_patch1 = noise_im[init_s:end_s,init_h:end_h,init_w:end_w]
-                patch_name = args.datasets_folder + '_x' + str(x) + '_y' + str(y) + '_z' + str(z)
-                # train_raw.append(noise_patch1.transpose(1,2,0))
-                name_list.append(patch_name)
-                # print(' single_coordinate -----> ',single_coordinate)
-                coordinate_list[patch_name] = single_coordinate
-
-    return name_list, noise_im, coordinate_list
+    Args:
+        cache : the preprocess_cache, or None to compute the mean without cache
+        noise_im : the memmap_stack
+        frame_num : the number of frames from the start of the file taken into account (all frames by default)
+    Returns:
+        mean : the mean intensity of the raw frames
+    """
+    params = {'mean': 'raw'}
+    if frame_num is None or frame_num >= noise_im.raw_shape[0]:
+        # the key of the whole stack is shared by training and testing
+        frame_num = noise_im.raw_shape[0]
+    else:
+        params['frame_num'] = frame_num
+    if cache is not None:
+        key = cache.key(noise_im.im_dir, **params)
+        entry = cache.get(key)
+        if entry is not None:
+            return np.float64(entry[1]['img_mean'])
+    mean = noise_im.raw_mean(frame_num)
+    if cache is not None:
+        cache.put(key, {}, {'img_mean': float(mean)})
+    return mean
 
 
 def test_preprocess_chooseOne(args, img_id):
     """
     Choose one original noisy stack and partition it into thousands of 3D sub-stacks (patch) with the setting
-    overlap factor in each dimension.
+    overlap factor in each dimension. If args.cache is set, the preprocessed stack and the patch table are read
+    from the on-disk cache when they are there.
 
     Args:
         args : the train object containing input params for partition
         img_id : the id of the test image
     Returns:
-        name_list : the coordinates of 3D patch are indexed by the patch name in name_list
+        coordinate_table : record the coordinate of 3D patch (one row per patch, see TEST_COLUMNS) preparing for
+                           partition in whole stack
         noise_im : the original noisy stacks
-        coordinate_list : record the coordinate of 3D patch preparing for partition in whole stack
         im_name : the file name of the noisy stacks
+        img_mean : the mean of the raw noisy stack
+        input_data_type : the data type of the raw noisy stack
 
     """
 
-    patch_y = args.patch_y
-    patch_x = args.patch_x
-    patch_t2 = args.patch_t
-    gap_y = args.gap_y
-    gap_x = args.gap_x
-    gap_t2 = int(args.patch_t * (1 - args.overlap_factor))
-    cut_w = (patch_x - gap_x) / 2
-    cut_h = (patch_y - gap_y) / 2
-    cut_s = (patch_t2 - gap_t2) / 2
     im_folder = args.datasets_path
-
-    name_list = []
-    coordinate_list = {}
     img_list = list(os.walk(im_folder, topdown=False))[-1][-1]
     img_list.sort()
 
@@ -474,117 +917,86 @@ def test_preprocess_chooseOne(args, img_id):
 
 
     im_dir = im_folder + '//' + im_name
-    noise_im = tiff.imread(im_dir)
+    cache = getattr(args, 'cache', None)
+    entry = None
+    if cache is not None:
+        key = cache.key(im_dir, stack='test', scale_factor=args.scale_factor, test_datasize=args.test_datasize)
+        entry = cache.get(key)
+    if entry is not None:
+        noise_im = entry[0]['stack']
+        img_mean = np.float64(entry[1]['img_mean'])
+        input_data_type = np.dtype(entry[1]['input_data_type'])
+        if args.print_img_name:
+            print('Testing image name -----> ', im_name)
+            print('Testing image shape -----> ', noise_im.shape)
+    else:
+        noise_im = tiff.imread(im_dir)
+        input_data_type = noise_im.dtype
+        img_mean = noise_im.mean()
+        # print('noise_im max -----> ',noise_im.max())
+        # print('noise_im min -----> ',noise_im.min())
+        if noise_im.shape[0] > args.test_datasize:
+            noise_im = noise_im[0:args.test_datasize, :, :]
+        if args.print_img_name:
+           print('Testing image name -----> ', im_name)
+           print('Testing image shape -----> ', noise_im.shape)
+        # Minus mean before training
+        noise_im = noise_im.astype(np.float32)/args.scale_factor
+        noise_im = noise_im-img_mean
+        # No preprocessing
+        # noise_im = noise_im.astype(np.float32) / args.scale_factor
+        # noise_im = (noise_im-noise_im.min()).astype(np.float32)/args.scale_factor
+        if cache is not None:
+            cache.put(key, {'stack': noise_im}, {'img_mean': float(img_mean), 'input_data_type': input_data_type.str})
+
+    whole_x = noise_im.shape[2]
+    whole_y = noise_im.shape[1]
+    whole_t = noise_im.shape[0]
+    gap_t = int(args.patch_t * (1 - args.overlap_factor))
+    coordinate_table = test_table(cache, im_dir, whole_t, whole_y, whole_x, args.patch_t, args.patch_y, args.patch_x,
+                                  gap_t, args.gap_y, args.gap_x)
+
+    return coordinate_table, noise_im, im_name, img_mean, input_data_type
+
+
+def test_preprocess_stream(args, img_id):
+    """
+    Streaming counterpart of test_preprocess_chooseOne. The noisy stack is opened as a memmap_stack so that
+    frames are only read when a temporal slab of patches is processed, and the patches are ordered by their
+    temporal position so that the stack can be processed slab by slab.
+
+    Args:
+        args : the test object containing input params for partition
+        img_id : the id of the test image
+    Returns:
+        coordinate_table : record the coordinate of 3D patch (one row per patch, see TEST_COLUMNS), sorted by time
+        noise_im : the memmap_stack of the noisy stack
+        im_name : the file name of the noisy stacks
+        img_mean : the mean of the raw noisy stack
+        input_data_type : the data type of the raw noisy stack
+    """
+    im_folder = args.datasets_path
+    img_list = list(os.walk(im_folder, topdown=False))[-1][-1]
+    img_list.sort()
+    im_name = img_list[img_id]
+
+    im_dir = im_folder + '//' + im_name
+    noise_im = memmap_stack(im_dir, frame_num=args.test_datasize, scale_factor=args.scale_factor, mean=0)
     input_data_type = noise_im.dtype
-    img_mean = noise_im.mean()
-    # print('noise_im max -----> ',noise_im.max())
-    # print('noise_im min -----> ',noise_im.min())
-    if noise_im.shape[0] > args.test_datasize:
-        noise_im = noise_im[0:args.test_datasize, :, :]
+    # the mean of the whole raw stack is subtracted, the same as test_preprocess_chooseOne
+    cache = getattr(args, 'cache', None)
+    img_mean = stack_raw_mean(cache, noise_im)
+    noise_im.mean = np.float32(img_mean)
     if args.print_img_name:
        print('Testing image name -----> ', im_name)
        print('Testing image shape -----> ', noise_im.shape)
-    # Minus mean before training
-    noise_im = noise_im.astype(np.float32)/args.scale_factor
-    noise_im = noise_im-img_mean
-    # No preprocessing
-    # noise_im = noise_im.astype(np.float32) / args.scale_factor
-    # noise_im = (noise_im-noise_im.min()).astype(np.float32)/args.scale_factor
 
     whole_x = noise_im.shape[2]
     whole_y = noise_im.shape[1]
     whole_t = noise_im.shape[0]
+    gap_t = int(args.patch_t * (1 - args.overlap_factor))
+    coordinate_table = test_table(cache, im_dir, whole_t, whole_y, whole_x, args.patch_t, args.patch_y, args.patch_x,
+                                  gap_t, args.gap_y, args.gap_x)
+    coordinate_table = coordinate_table[np.argsort(coordinate_table[:, 0], kind='stable')]
 
-    num_w = math.ceil((whole_x - patch_x + gap_x) / gap_x)
-    num_h = math.ceil((whole_y - patch_y + gap_y) / gap_y)
-    num_s = math.ceil((whole_t - patch_t2 + gap_t2) / gap_t2)
-    # print('int((whole_y-patch_y+gap_y)/gap_y) -----> ',int((whole_y-patch_y+gap_y)/gap_y))
-    # print('int((whole_x-patch_x+gap_x)/gap_x) -----> ',int((whole_x-patch_x+gap_x)/gap_x))
-    # print('int((whole_t-patch_t2+gap_t2)/gap_t2) -----> ',int((whole_t-patch_t2+gap_t2)/gap_t2))
-    for x in range(0, num_h):
-        for y in range(0, num_w):
-            for z in range(0, num_s):
-                single_coordinate = {'init_h': 0, 'end_h': 0, 'init_w': 0, 'end_w': 0, 'init_s': 0, 'end_s': 0}
-                if x != (num_h - 1):
-                    init_h = gap_y * x
-                    end_h = gap_y * x + patch_y
-                elif x == (num_h - 1):
-                    init_h = whole_y - patch_y
-                    end_h = whole_y
-
-                if y != (num_w - 1):
-                    init_w = gap_x * y
-                    end_w = gap_x * y + patch_x
-                elif y == (num_w - 1):
-                    init_w = whole_x - patch_x
-                    end_w = whole_x
-
-                if z != (num_s - 1):
-                    init_s = gap_t2 * z
-                    end_s = gap_t2 * z + patch_t2
-                elif z == (num_s - 1):
-                    init_s = whole_t - patch_t2
-                    end_s = whole_t
-                single_coordinate['init_h'] = init_h
-                single_coordinate['end_h'] = end_h
-                single_coordinate['init_w'] = init_w
-                single_coordinate['end_w'] = end_w
-                single_coordinate['init_s'] = init_s
-                single_coordinate['end_s'] = end_s
-
-                if y == 0:
-                    single_coordinate['stack_start_w'] = y * gap_x
-                    single_coordinate['stack_end_w'] = y * gap_x + patch_x - cut_w
-                    single_coordinate['patch_start_w'] = 0
-                    single_coordinate['patch_end_w'] = patch_x - cut_w
-                elif y == num_w - 1:
-                    single_coordinate['stack_start_w'] = whole_x - patch_x + cut_w
-                    single_coordinate['stack_end_w'] = whole_x
-                    single_coordinate['patch_start_w'] = cut_w
-                    single_coordinate['patch_end_w'] = patch_x
-                else:
-                    single_coordinate['stack_start_w'] = y * gap_x + cut_w
-                    single_coordinate['stack_end_w'] = y * gap_x + patch_x - cut_w
-                    single_coordinate['patch_start_w'] = cut_w
-                    single_coordinate['patch_end_w'] = patch_x - cut_w
-
-                if x == 0:
-                    single_coordinate['stack_start_h'] = x * gap_y
-                    single_coordinate['stack_end_h'] = x * gap_y + patch_y - cut_h
-                    single_coordinate['patch_start_h'] = 0
-                    single_coordinate['patch_end_h'] = patch_y - cut_h
-                elif x == num_h - 1:
-                    single_coordinate['stack_start_h'] = whole_y - patch_y + cut_h
-                    single_coordinate['stack_end_h'] = whole_y
-                    single_coordinate['patch_start_h'] = cut_h
-                    single_coordinate['patch_end_h'] = patch_y
-                else:
-                    single_coordinate['stack_start_h'] = x * gap_y + cut_h
-                    single_coordinate['stack_end_h'] = x * gap_y + patch_y - cut_h
-                    single_coordinate['patch_start_h'] = cut_h
-                    single_coordinate['patch_end_h'] = patch_y - cut_h
-
-                if z == 0:
-                    single_coordinate['stack_start_s'] = z * gap_t2
-                    single_coordinate['stack_end_s'] = z * gap_t2 + patch_t2 - cut_s
-                    single_coordinate['patch_start_s'] = 0
-                    single_coordinate['patch_end_s'] = patch_t2 - cut_s
-                elif z == num_s - 1:
-                    single_coordinate['stack_start_s'] = whole_t - patch_t2 + cut_s
-                    single_coordinate['stack_end_s'] = whole_t
-                    single_coordinate['patch_start_s'] = cut_s
-                    single_coordinate['patch_end_s'] = patch_t2
-                else:
-                    single_coordinate['stack_start_s'] = z * gap_t2 + cut_s
-                    single_coordinate['stack_end_s'] = z * gap_t2 + patch_t2 - cut_s
-                    single_coordinate['patch_start_s'] = cut_s
-                    single_coordinate['patch_end_s'] = patch_t2 - cut_s
-
-                # noise_patch1 = noise_im[init_s:end_s,init_h:end_h,init_w:end_w]
-                patch_name = args.datasets_name + '_x' + str(x) + '_y' + str(y) + '_z' + str(z)
-                # train_raw.append(noise_patch1.transpose(1,2,0))
-                name_list.append(patch_name)
-                # print(' single_coordinate -----> ',single_coordinate)
-                coordinate_list[patch_name] = single_coordinate
-
-    return name_list, noise_im, coordinate_list, im_name, img_mean, input_data_type
+    return coordinate_table, noise_im, im_name, img_mean, input_data_type
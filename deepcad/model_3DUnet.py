@@ -31,15 +31,21 @@ class UNet3D(nn.Module):
             See `SingleConv` for more info
         init_channel_number (int): number of feature maps in the first conv layer of the encoder; default: 64
         num_groups (int): number of groups for the GroupNorm
+        num_levels (int): number of levels of the encoder when f_maps is an integer; default: 4
+        checkpoint_levels (list or 'all'): the levels (0 for the full resolution level) whose encoder and decoder
+            recompute their activations in the backward pass instead of keeping them (activation checkpointing)
     """
 
     def __init__(self, in_channels, out_channels, final_sigmoid, f_maps=64, layer_order='cr', num_groups=8,
-                 **kwargs):
+                 num_levels=4, checkpoint_levels=(), **kwargs):
         super(UNet3D, self).__init__()
 
         if isinstance(f_maps, int):
-            # use 4 levels in the encoder path as suggested in the paper
-            f_maps = create_feature_maps(f_maps, number_of_fmaps=4)
+            # use num_levels levels in the encoder path (4 as suggested in the paper)
+            f_maps = create_feature_maps(f_maps, number_of_fmaps=num_levels)
+        if checkpoint_levels == 'all':
+            checkpoint_levels = range(len(f_maps))
+        checkpoint_levels = set(checkpoint_levels)
 
         # create encoder path consisting of Encoder modules. The length of the encoder is equal to `len(f_maps)`
         # uses DoubleConv as a basic_module for the Encoder
@@ -47,10 +53,12 @@ class UNet3D(nn.Module):
         for i, out_feature_num in enumerate(f_maps):
             if i == 0:
                 encoder = Encoder(in_channels, out_feature_num, apply_pooling=False, basic_module=DoubleConv,
-                                  conv_layer_order=layer_order, num_groups=num_groups)
+                                  conv_layer_order=layer_order, num_groups=num_groups,
+                                  checkpoint=i in checkpoint_levels)
             else:
                 encoder = Encoder(f_maps[i - 1], out_feature_num, basic_module=DoubleConv,
-                                  conv_layer_order=layer_order, num_groups=num_groups)
+                                  conv_layer_order=layer_order, num_groups=num_groups,
+                                  checkpoint=i in checkpoint_levels)
             encoders.append(encoder)
 
         self.encoders = nn.ModuleList(encoders)
@@ -62,8 +70,10 @@ class UNet3D(nn.Module):
         for i in range(len(reversed_f_maps) - 1):
             in_feature_num = reversed_f_maps[i] + reversed_f_maps[i + 1]
             out_feature_num = reversed_f_maps[i + 1]
+            # the decoder outputs the feature maps of level len(f_maps) - 2 - i
             decoder = Decoder(in_feature_num, out_feature_num, basic_module=DoubleConv,
-                              conv_layer_order=layer_order, num_groups=num_groups)
+                              conv_layer_order=layer_order, num_groups=num_groups,
+                              checkpoint=len(f_maps) - 2 - i in checkpoint_levels)
             decoders.append(decoder)
 
         self.decoders = nn.ModuleList(decoders)
@@ -82,15 +92,12 @@ class UNet3D(nn.Module):
         encoders_features = []
         for encoder in self.encoders:
             x = encoder(x)
-            # reverse the encoder outputs to be aligned with the decoder
-            encoders_features.insert(0, x)
-
-        # remove the last encoder's output from the list
-        # !!remember: it's the 1st in the list
-        encoders_features = encoders_features[1:]
+            encoders_features.append(x)
 
         # decoder part
-        for decoder, encoder_features in zip(self.decoders, encoders_features):
+        # the decoders take the encoder outputs in reverse order, without the last encoder's output (the input of
+        # the first decoder)
+        for decoder, encoder_features in zip(self.decoders, encoders_features[-2::-1]):
             # pass the output from the corresponding encoder and the output
             # of the previous decoder
             x = decoder(encoder_features, x)
@@ -2,7 +2,8 @@ from .model_3DUnet import UNet3D
 import torch.nn as nn
 
 class Network_3D_Unet(nn.Module):
-    def __init__(self, UNet_type = '3DUNet', in_channels=1, out_channels=1, f_maps=64, final_sigmoid = True):
+    def __init__(self, UNet_type = '3DUNet', in_channels=1, out_channels=1, f_maps=64, final_sigmoid = True,
+                 num_levels=4, checkpoint_levels=()):
         super(Network_3D_Unet, self).__init__()
 
         self.in_channels = in_channels
@@ -13,7 +14,9 @@ class Network_3D_Unet(nn.Module):
             self.Generator = UNet3D( in_channels = in_channels,
                                      out_channels = out_channels,
                                      f_maps = f_maps, 
-                                     final_sigmoid = final_sigmoid)
+                                     final_sigmoid = final_sigmoid,
+                                     num_levels = num_levels,
+                                     checkpoint_levels = checkpoint_levels)
 
     def forward(self, x):
         fake_x = self.Generator(x)
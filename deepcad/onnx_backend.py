@@ -0,0 +1,80 @@
+"""
+ONNX Runtime backend of testing_class.
+
+The ONNX models exported by training_class (one per epoch in onnx_dir) have dynamic batch and patch axes, so any
+batch size and any patch shape divisible by 2 ** 3 (the poolings of UNet3D) can be denoised with them. Only the
+onnxruntime package is needed to run them, pytorch is used by the data pipeline of testing_class but not for the
+network. onnxruntime is imported when the backend is selected, the package works without it otherwise.
+"""
+import os
+
+import torch
+
+
+def onnx_providers(device):
+    """
+    The execution providers of ONNX Runtime for the device option of testing_class.
+    Args:
+        device : 'auto' (CUDA if the CUDA execution provider is installed, otherwise CPU), 'cuda' or 'cpu'
+    Return:
+        providers : the execution providers, in order of preference
+    """
+    import onnxruntime
+    available = onnxruntime.get_available_providers()
+    if device == 'cpu' or (device == 'auto' and 'CUDAExecutionProvider' not in available):
+        return ['CPUExecutionProvider']
+    if 'CUDAExecutionProvider' not in available:
+        raise RuntimeError('device is set to cuda but the CUDA execution provider of onnxruntime is not available '
+                           '(install onnxruntime-gpu), set device to cpu or auto')
+    return ['CUDAExecutionProvider', 'CPUExecutionProvider']
+
+
+class onnx_network():
+    """
+    A network run by ONNX Runtime, used by testing_class in place of Network_3D_Unet: it is called with a batch
+    of patches (a float32 tensor on the host) and returns the denoised batch as a tensor.
+
+    Args:
+        device : 'auto', 'cuda' or 'cpu' (see onnx_providers)
+        num_threads : the intra-op threads of the CPU execution provider (0 for the default of ONNX Runtime, one
+                      per physical core)
+    """
+
+    def __init__(self, device='auto', num_threads=0):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError("backend 'onnxruntime' requires the onnxruntime package (pip install onnxruntime, "
+                              "or onnxruntime-gpu for CUDA)")
+        self.device = device
+        self.num_threads = num_threads
+        self.providers = onnx_providers(device)
+        self.session = None
+        self.model_name = None
+
+    def load(self, model_name):
+        """
+        Create the inference session of an ONNX model (the external weight file written next to the model by the
+        exporter is read as well).
+        """
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if self.num_threads > 0:
+            options.intra_op_num_threads = self.num_threads
+        self.session = onnxruntime.InferenceSession(model_name, sess_options=options, providers=self.providers)
+        self.input_name = self.session.get_inputs()[0].name
+        self.model_name = model_name
+
+    def __call__(self, x):
+        if self.session is None:
+            raise RuntimeError('no ONNX model is loaded, see onnx_network.load')
+        output, = self.session.run(None, {self.input_name: x.detach().cpu().float().numpy()})
+        return torch.from_numpy(output)
+
+    def __deepcopy__(self, memo):
+        # an inference session cannot be copied, a copy loads its own model (see testing_class.test)
+        return onnx_network(self.device, self.num_threads)
+
+    def __repr__(self):
+        return 'onnx_network({}, {})'.format(os.path.basename(self.model_name or ''), ','.join(self.providers))
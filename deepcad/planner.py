@@ -0,0 +1,375 @@
+"""
+Patch size / batch size planner for the UNet3D of DeepCAD.
+
+The peak memory of a patch is predicted from the layer configuration of UNet3D (the feature maps of every level,
+the channels of the DoubleConv blocks and the 2x2x2 max pooling between levels), and the time of a step is
+predicted from the number of floating point operations with a cost model calibrated on the device. Candidate
+patch shapes are multiples of 2 ** (num_levels - 1) so that every pooling level halves the patch exactly.
+
+Example:
+    from deepcad.planner import plan_patch_size
+    plans = plan_patch_size(fmap=16, device='cuda', train=False, overlap_factor=0.5)
+    best = plans[0]  # {'patch_t': ..., 'patch_xy': ..., 'batch_size': ..., 'memory': ..., 'voxels_per_second': ...}
+"""
+import os
+import time
+
+import numpy as np
+import torch
+
+from .utils import create_feature_maps, get_device, autocast, PRECISION_DTYPES
+
+BYTES_PER_ELEMENT = {'fp32': 4, 'fp16': 2, 'bf16': 2}
+INDEX_BYTES = 8  # max pooling keeps int64 indices for the backward pass
+DEFAULT_MEMORY_FRACTION = 0.9  # the rest is left for the allocator fragmentation and the convolution workspaces
+# on CPU, the oneDNN convolutions copy their inputs and outputs to a blocked layout with the channels padded,
+# the factors were measured (peak RSS) with fmap 16 and 32
+CPU_MEMORY_FACTOR = {True: 1.1, False: 1.5}
+
+
+def unet_layers(patch_shape, fmap, num_levels=4, in_channels=1, out_channels=1):
+    """
+    List the tensors computed in the forward pass of UNet3D (layer_order 'cr', the ReLU is in place).
+    Args:
+        patch_shape : the shape of a patch (t, y, x)
+        fmap : the number of feature maps of the first level
+        num_levels : the number of levels of the encoder
+    Return:
+        layers : one (kind, in_channels, out_channels, voxels) tuple per tensor, kind is 'input', 'conv', 'pool',
+                 'upsample' or 'concat'. The voxels of a level are the voxels of the patch after the poolings.
+    """
+    f_maps = create_feature_maps(fmap, num_levels)
+    level_voxels = []
+    shape = np.array(patch_shape)
+    for level in range(num_levels):
+        level_voxels.append(int(np.prod(shape)))
+        shape = shape // 2
+
+    layers = [('input', 0, in_channels, level_voxels[0])]
+    channels = in_channels
+    for level, out_feature_num in enumerate(f_maps):
+        voxels = level_voxels[level]
+        if level > 0:
+            layers.append(('pool', channels, channels, voxels))
+        # the first convolution of an encoder DoubleConv halves the output feature maps (see DoubleConv)
+        conv1_out = max(out_feature_num // 2, channels)
+        layers.append(('conv', channels, conv1_out, voxels))
+        layers.append(('conv', conv1_out, out_feature_num, voxels))
+        channels = out_feature_num
+    for level in reversed(range(num_levels - 1)):
+        voxels = level_voxels[level]
+        layers.append(('upsample', channels, channels, voxels))
+        layers.append(('concat', channels + f_maps[level], channels + f_maps[level], voxels))
+        layers.append(('conv', channels + f_maps[level], f_maps[level], voxels))
+        layers.append(('conv', f_maps[level], f_maps[level], voxels))
+        channels = f_maps[level]
+    layers.append(('final', channels, out_channels, level_voxels[0]))
+    return layers
+
+
+def layer_blocks(num_levels=4):
+    """
+    The block of UNet3D computing every tensor of unet_layers, aligned with the list of unet_layers.
+    Return:
+        blocks : one ('encoder', level) or ('decoder', level) tuple per tensor (the decoder of a level outputs the
+                 feature maps of the level), None for the input and the final convolution
+    """
+    blocks = [None]
+    for level in range(num_levels):
+        blocks += [('encoder', level)] * (3 if level > 0 else 2)
+    for level in reversed(range(num_levels - 1)):
+        blocks += [('decoder', level)] * 4
+    blocks.append(None)
+    return blocks
+
+
+def _checkpoint_levels(checkpoint_levels, num_levels):
+    if checkpoint_levels == 'all':
+        return set(range(num_levels))
+    return set(checkpoint_levels)
+
+
+def parameter_number(fmap, num_levels=4, in_channels=1, out_channels=1):
+    """
+    The number of parameters of UNet3D (3x3x3 convolutions with bias and the final 1x1 convolution).
+    """
+    number = 0
+    for kind, in_c, out_c, _ in unet_layers((1, 1, 1), fmap, num_levels, in_channels, out_channels):
+        if kind == 'conv':
+            number += in_c * out_c * 27 + out_c
+        elif kind == 'final':
+            number += in_c * out_c + out_c
+    return number
+
+
+def network_flops(patch_shape, fmap, num_levels=4, levels=None):
+    """
+    The floating point operations of the forward pass of one patch (two per multiply-add of the convolutions).
+    levels restricts the count to the encoders and decoders of the given levels (None for the whole network).
+    """
+    flops = 0
+    blocks = layer_blocks(num_levels)
+    for (kind, in_c, out_c, voxels), block in zip(unet_layers(patch_shape, fmap, num_levels), blocks):
+        if levels is not None and (block is None or block[1] not in levels):
+            continue
+        if kind == 'conv':
+            flops += 2 * 27 * in_c * out_c * voxels
+        elif kind == 'final':
+            flops += 2 * in_c * out_c * voxels
+    return flops
+
+
+def activation_memory(patch_shape, fmap, train=True, precision='fp32', num_levels=4, device='cuda',
+                      checkpoint_levels=()):
+    """
+    Predict the peak activation memory of one patch.
+    For training, all the tensors kept for the backward pass (the convolution outputs, the pooling outputs and
+    indices and the concatenated decoder inputs) are alive at the end of the forward pass, and the backward pass of
+    the first level adds the gradients of two full resolution tensors. The checkpointed encoders and decoders only
+    keep their output, and the backward pass adds the tensors of the largest block recomputed. For inference, the
+    tensors are freed as soon as they are consumed, so the peak is reached in the decoder, where the skip
+    connections are still alive.
+    Args:
+        patch_shape : the shape of a patch (t, y, x)
+        fmap : the number of feature maps of the first level
+        train : training (forward and backward) or inference (forward without gradients)
+        precision : 'fp32', 'fp16' or 'bf16' (autocast for training, the network dtype for inference)
+        num_levels : the number of levels of the encoder
+        device : 'cuda' or 'cpu' (see CPU_MEMORY_FACTOR)
+        checkpoint_levels : the levels whose encoder and decoder use activation checkpointing (list or 'all')
+    Return:
+        the peak activation memory of one patch in bytes
+    """
+    peak = _activation_peak(patch_shape, fmap, train, precision, num_levels,
+                            _checkpoint_levels(checkpoint_levels, num_levels))
+    if device == 'cpu':
+        peak = int(peak * CPU_MEMORY_FACTOR[train])
+    return peak
+
+
+def _activation_peak(patch_shape, fmap, train, precision, num_levels, checkpoint_levels=()):
+    element_bytes = BYTES_PER_ELEMENT[precision]
+    layers = unet_layers(patch_shape, fmap, num_levels)
+    if train:
+        saved = 0
+        largest = 0
+        recomputed = {}
+        peaks = []
+        blocks = layer_blocks(num_levels)
+        for index, ((kind, _, out_c, voxels), block) in enumerate(zip(layers, blocks)):
+            if kind == 'upsample':
+                continue  # only consumed by the concatenation
+            size = out_c * voxels * (element_bytes if kind != 'input' else 4)
+            if kind == 'pool':
+                size += out_c * voxels * INDEX_BYTES
+            largest = max(largest, out_c * voxels * element_bytes)
+            if block is not None and block[1] in checkpoint_levels:
+                # the tensors of a checkpointed block are only kept while the block is recomputed in the backward
+                # pass, when the tensors saved after the block have already been freed
+                if block not in recomputed:
+                    recomputed[block] = saved
+                recomputed[block] += size
+                if blocks[index + 1] == block:
+                    continue
+                peaks.append(recomputed[block])
+            saved += size
+        return max([saved] + peaks) + 2 * largest
+
+    # inference: follow the tensors alive during the forward pass
+    f_maps = create_feature_maps(fmap, num_levels)
+    voxels = [voxels for kind, _, _, voxels in layers if kind == 'conv'][::2]  # the voxels of every level
+    state = {'live': voxels[0] * element_bytes, 'current': voxels[0] * element_bytes, 'peak': 0}
+
+    def step(size, freed):
+        # the output is allocated while the inputs are alive, then the inputs which are not used anymore are freed
+        state['peak'] = max(state['peak'], state['live'] + size)
+        state['live'] = state['live'] + size - freed
+        state['current'] = size
+
+    skips = []
+    channels = 1
+    for level, out_feature_num in enumerate(f_maps):
+        if level > 0:
+            # the encoder output of the previous level is kept for the skip connection
+            step(channels * voxels[level] * element_bytes, 0)
+        conv1_out = max(out_feature_num // 2, channels)
+        # the input patch is kept by the caller for the stitching
+        step(conv1_out * voxels[level] * element_bytes, state['current'] if level > 0 else 0)
+        step(out_feature_num * voxels[level] * element_bytes, state['current'])
+        skips.append(state['current'])
+        channels = out_feature_num
+    skips.pop()  # the output of the last level is the input of the decoder
+    for level in reversed(range(num_levels - 1)):
+        step(channels * voxels[level] * element_bytes, state['current'])  # upsampling
+        step((channels + f_maps[level]) * voxels[level] * element_bytes, state['current'] + skips.pop())  # concatenation
+        step(f_maps[level] * voxels[level] * element_bytes, state['current'])
+        step(f_maps[level] * voxels[level] * element_bytes, state['current'])
+        channels = f_maps[level]
+    step(voxels[0] * element_bytes, state['current'])
+    return state['peak']
+
+
+def parameter_memory(fmap, train=True, precision='fp32', num_levels=4):
+    """
+    The memory of the network parameters in bytes. Training keeps the fp32 weights, their gradients and the two
+    moments of Adam, inference keeps the weights in the precision of the network.
+    """
+    if train:
+        return parameter_number(fmap, num_levels) * 4 * 4
+    return parameter_number(fmap, num_levels) * BYTES_PER_ELEMENT[precision]
+
+
+def memory_budget(device, budget=None):
+    """
+    The memory available for the network.
+    Args:
+        device : 'cuda' or 'cpu'
+        budget : the memory budget in GB (None for DEFAULT_MEMORY_FRACTION of the free GPU memory, or of the
+                 available RAM on CPU)
+    Return:
+        the memory budget in bytes
+    """
+    if budget is not None:
+        return int(budget * 1024 ** 3)
+    if device == 'cuda':
+        if hasattr(torch.cuda, 'mem_get_info'):
+            free = torch.cuda.mem_get_info()[0]
+        else:
+            free = torch.cuda.get_device_properties(torch.cuda.current_device()).total_memory - \
+                   torch.cuda.memory_allocated()
+    else:
+        free = _available_ram()
+    return int(free * DEFAULT_MEMORY_FRACTION)
+
+
+def _available_ram():
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # no /proc/meminfo (not linux), fall back to the free physical pages
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+def max_batch_size(patch_shape, fmap, budget, train=True, precision='fp32', num_levels=4, device='cuda',
+                   checkpoint_levels=()):
+    """
+    The largest batch of patches whose predicted memory fits in the budget (0 if a single patch does not fit).
+    Args:
+        patch_shape : the shape of a patch (t, y, x)
+        fmap : the number of feature maps of the first level
+        budget : the memory budget in bytes (see memory_budget)
+        checkpoint_levels : the levels using activation checkpointing (see activation_memory)
+    """
+    free = budget - parameter_memory(fmap, train, precision, num_levels)
+    return max(0, int(free // activation_memory(patch_shape, fmap, train, precision, num_levels, device,
+                                                checkpoint_levels)))
+
+
+def calibrate(fmap, device, train=False, precision='fp32', num_levels=4):
+    """
+    Fit the cost model of a step, time = overhead + seconds_per_flop * flops, by timing the network on two
+    small patches on the device.
+    Return:
+        overhead, seconds_per_flop : the fixed time of a step (kernel launches, python) and the time per flop
+    """
+    from .network import Network_3D_Unet
+    model = Network_3D_Unet(in_channels=1, out_channels=1, f_maps=fmap, final_sigmoid=True,
+                            num_levels=num_levels).to(device)
+    if not train:
+        model = model.to(PRECISION_DTYPES[precision])
+    step = 2 ** (num_levels - 1)
+    shapes = [(step * 2,) * 3, (step * 6,) * 3]
+    times = []
+    for shape in shapes:
+        run_time = []
+        for repeat in range(3):
+            input = torch.randn((1, 1) + shape, device=device)
+            start = time.time()
+            if train:
+                with autocast(device, precision):
+                    output = model(input)
+                    loss = output.float().abs().mean()
+                loss.backward()
+            else:
+                with torch.no_grad():
+                    model(input.to(PRECISION_DTYPES[precision]))
+            if device == 'cuda':
+                torch.cuda.synchronize()
+            run_time.append(time.time() - start)
+        times.append(min(run_time[1:]))  # the first run includes the warm up
+    flops = [network_flops(shape, fmap, num_levels) * (3 if train else 1) for shape in shapes]
+    seconds_per_flop = max((times[1] - times[0]) / (flops[1] - flops[0]), 1e-15)
+    overhead = max(times[0] - seconds_per_flop * flops[0], 0)
+    return overhead, seconds_per_flop
+
+
+def plan_patch_size(fmap=16, device='auto', budget=None, train=False, precision='fp32', overlap_factor=0.5,
+                    patch_xy=(64, 96, 128, 160, 192, 256), patch_t=(32, 64, 96, 128, 160, 192, 256),
+                    max_batch=64, num_levels=4, checkpoint_levels=(), verbose=True):
+    """
+    Predict the peak memory and the throughput of the candidate patch shapes and rank them by voxels per second.
+    For every shape, the largest batch fitting in the memory budget (up to max_batch) is used. The throughput of
+    inference counts the voxels kept after stitching (the patch minus the overlap), training counts the voxels of
+    the input patches.
+    Args:
+        fmap : the number of feature maps of the first level of UNet3D
+        device : 'auto', 'cuda' or 'cpu'
+        budget : the memory budget in GB, GPU memory on 'cuda' and RAM on 'cpu' (None for the free memory)
+        train : plan training (forward and backward) or inference
+        precision : 'fp32', 'fp16' or 'bf16'
+        overlap_factor : the overlap factor of the inference patches
+        patch_xy : the candidate lateral sizes of the patches
+        patch_t : the candidate temporal sizes of the patches (patch_t of training, the input is patch_t frames)
+        max_batch : the largest batch size considered
+        num_levels : the number of levels of UNet3D
+        checkpoint_levels : the levels using activation checkpointing in training (list or 'all'), their encoders
+                            and decoders are run twice
+        verbose : print the ranked plans
+    Return:
+        plans : the candidate configurations sorted by decreasing voxels per second, every plan is a dict with
+                patch_t, patch_xy, batch_size, memory (predicted peak, bytes) and voxels_per_second
+    """
+    device = get_device(device)
+    budget = memory_budget(device, budget)
+    step = 2 ** (num_levels - 1)
+    overhead, seconds_per_flop = calibrate(fmap, device, train, precision, num_levels)
+
+    plans = []
+    for t in patch_t:
+        for xy in patch_xy:
+            if t % step or xy % step:
+                # the patches must be halved exactly by every pooling level
+                continue
+            shape = (t, xy, xy)
+            batch_size = min(max_batch, max_batch_size(shape, fmap, budget, train, precision, num_levels, device,
+                                                       checkpoint_levels if train else ()))
+            if batch_size == 0:
+                continue
+            flops = network_flops(shape, fmap, num_levels) * (3 if train else 1)
+            if train and checkpoint_levels:
+                # the checkpointed blocks are run again in the backward pass
+                flops += network_flops(shape, fmap, num_levels, _checkpoint_levels(checkpoint_levels, num_levels))
+            step_time = overhead + seconds_per_flop * flops * batch_size
+            if train:
+                voxels = t * xy * xy
+            else:
+                voxels = int(t * (1 - overlap_factor)) * int(xy * (1 - overlap_factor)) ** 2
+            plans.append({'patch_t': t, 'patch_xy': xy, 'batch_size': batch_size,
+                          'memory': parameter_memory(fmap, train, precision, num_levels) +
+                                    batch_size * activation_memory(shape, fmap, train, precision, num_levels, device,
+                                                                   checkpoint_levels if train else ()),
+                          'voxels_per_second': voxels * batch_size / step_time})
+    plans.sort(key=lambda plan: -plan['voxels_per_second'])
+
+    if verbose:
+        print('\033[1;31mPatch planner ({}, {}, {}, memory budget {:.1f} GB) -----> \033[0m'.format(
+            'training' if train else 'inference', device, precision, budget / 1024 ** 3))
+        for plan in plans[:10]:
+            print('patch_t %4d, patch_xy %4d, batch_size %3d, memory %6.2f GB, %.3g voxels/s'
+                  % (plan['patch_t'], plan['patch_xy'], plan['batch_size'], plan['memory'] / 1024 ** 3,
+                     plan['voxels_per_second']))
+    return plans
@@ -0,0 +1,118 @@
+"""
+Post-training static int8 quantization of Network_3D_Unet for CPU inference.
+
+The network is quantized with the FX graph mode of pytorch: the ReLU is fused into the convolutions, observers
+record the range of the activations while calibration patches go through the float network, and the convolutions
+are converted to int8 kernels (fbgemm/x86 on Intel and AMD CPUs, qnnpack on ARM). The max pooling, the nearest
+upsampling and the concatenation of the decoders run on the quantized tensors as well, the patches are quantized
+at the input of the network and the output is dequantized, so the network is called with float32 patches as
+before. Quantized kernels only exist on CPU.
+"""
+import copy
+import inspect
+
+import numpy as np
+import torch
+
+try:
+    from torch.ao.quantization import get_default_qconfig
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+except ImportError:
+    # pytorch < 1.10
+    from torch.quantization import get_default_qconfig
+    from torch.quantization.quantize_fx import prepare_fx, convert_fx
+
+
+def quantized_engine():
+    """
+    The quantized engine of the CPU: 'x86' (pytorch >= 2.0) or 'fbgemm' on x86 CPUs, 'qnnpack' otherwise (ARM).
+    """
+    engines = torch.backends.quantized.supported_engines
+    for engine in ('x86', 'fbgemm', 'qnnpack'):
+        if engine in engines:
+            return engine
+    raise RuntimeError('no quantized engine is available in this pytorch build')
+
+
+def quantize_network(model, calibration_batches):
+    """
+    Quantize a float network to int8 with post-training static quantization.
+    Args:
+        model : the float network (on CPU), it is not modified
+        calibration_batches : the batches of patches calibrating the ranges of the activations, an iterable of
+                              (batch, 1, t, y, x) float32 tensors
+    Return:
+        the int8 network (a GraphModule called with float32 patches)
+    """
+    engine = quantized_engine()
+    torch.backends.quantized.engine = engine
+    model = copy.deepcopy(model).cpu().float().eval()
+    qconfig_dict = {'': get_default_qconfig(engine)}
+    batches = iter(calibration_batches)
+    first = next(batches)
+    if 'example_inputs' in inspect.signature(prepare_fx).parameters:
+        prepared = prepare_fx(model, qconfig_dict, (first,))
+    else:
+        prepared = prepare_fx(model, qconfig_dict)
+    with torch.no_grad():
+        prepared(first)
+        for batch in batches:
+            prepared(batch)
+    return convert_fx(prepared)
+
+
+class int8_network():
+    """
+    An int8 network, used by testing_class in place of Network_3D_Unet: the float weights are loaded into
+    float_model and quantized, the int8 network is called with a batch of float32 patches and returns the
+    denoised batch.
+
+    Args:
+        float_model : the float network (Network_3D_Unet)
+        calibration_batches : a function returning the batches of patches calibrating the int8 network (see
+                              quantize_network), called for every model loaded, so that the patches are read
+                              again instead of being kept in memory
+    """
+
+    def __init__(self, float_model, calibration_batches):
+        self.float_model = float_model
+        self.calibration_batches = calibration_batches
+        self.quantized_model = None
+
+    def load(self, model_name):
+        """
+        Load the weights of a model file and quantize the network.
+        """
+        self.float_model.load_state_dict(torch.load(model_name, map_location='cpu'))
+        self.float_model.eval()
+        self.quantized_model = quantize_network(self.float_model, self.calibration_batches())
+
+    def __call__(self, x):
+        if self.quantized_model is None:
+            raise RuntimeError('no model is loaded, see int8_network.load')
+        return self.quantized_model(x.float())
+
+    def __deepcopy__(self, memo):
+        # a copy of the network (see testing_class.test) shares the calibration patches
+        return int8_network(copy.deepcopy(self.float_model, memo), self.calibration_batches)
+
+
+def drift_report(reference, output):
+    """
+    The fidelity of a stack denoised by a network (the int8 network, a distilled network) to the same stack
+    denoised by a reference network (the float network, the teacher).
+    Args:
+        reference : the stack denoised by the reference network (t, y, x)
+        output : the stack denoised by the network
+    Return:
+        psnr, ssim : the PSNR (dB, the peak is the range of the reference) and the mean SSIM of the frames
+    """
+    from skimage.metrics import structural_similarity
+    data_range = float(reference.max() - reference.min())
+    mse = float(np.mean((output.astype(np.float64) - reference) ** 2))
+    psnr = 10 * np.log10(data_range ** 2 / mse) if mse > 0 else float('inf')
+    # frame by frame, so that the temporary arrays of the SSIM stay small on long stacks
+    # in float64, the variances of float32 frames with a large mean lose their precision
+    ssim = np.mean([structural_similarity(reference[t].astype(np.float64), output[t].astype(np.float64),
+                                          data_range=data_range) for t in range(reference.shape[0])])
+    return psnr, float(ssim)
@@ -1,5 +1,7 @@
 import os
+import copy
 import numpy as np
+import tifffile as tiff
 import yaml
 from .network import Network_3D_Unet
 import torch
@@ -8,7 +10,13 @@ from torch.autograd import Variable
 from torch.utils.data import DataLoader
 import time
 import datetime
-from .data_process import test_preprocess_chooseOne, testset, multibatch_test_save, singlebatch_test_save
+from .utils import get_device, set_cpu_threads, probe_batch_size, compile_network, PRECISION_DTYPES
+from .data_process import test_preprocess_chooseOne, test_preprocess_stream, testset, memmap_stack, stack_store, \
+    batch_stitcher, device_prefetcher, stack_scheduler
+from .planner import memory_budget, max_batch_size
+from .cache import preprocess_cache
+from .onnx_backend import onnx_network
+from .quantize import int8_network, drift_report
 from skimage import io
 from deepcad.movie_display import test_img_display
 
@@ -32,9 +40,10 @@ class testing_class():
         self.overlap_factor = 0.5
         self.datasets_path = ''
         self.fmap = 16
+        self.num_levels = 4  # the number of levels of U-Net 3D, the same as in training
         self.output_dir = './results'
         self.pth_dir = ''
-        self.batch_size = 1
+        self.batch_size = None  # patches per step (None for one patch per GPU, 'auto' for the largest batch fitting in GPU memory)
         self.patch_t = 150
         self.patch_x = 150
         self.patch_y = 150
@@ -42,11 +51,29 @@ class testing_class():
         self.gap_x = 115
         self.gap_t = 115
         self.GPU = '0'
+        self.device = 'auto'  # 'auto' (CUDA if available), 'cuda' or 'cpu'
+        self.num_threads = 0  # intra-op threads on CPU (0 for the number of cores available to the process)
+        self.num_interop_threads = 0  # inter-op threads on CPU (0 for one thread)
+        self.precision = 'fp32'  # 'fp32', 'fp16' or 'bf16', the precision of the network weights and patches
+        self.compile_mode = 'none'  # 'none' (eager), 'compile' (torch.compile, pytorch >= 2.0) or 'script' (TorchScript) execution of the network, compiled once per patch shape
+        self.compile_cache_dir = ''  # the folder of the kernels compiled by compile_mode 'compile', reused by later runs ('' for the default folder)
+        self.quantize = False  # run an int8 network on CPU, quantized after training (post-training static quantization) from every .pth model
+        self.calibration_size = 256  # the number of patches, drawn from all the stacks, calibrating the int8 network
+        self.quantize_report = True  # also denoise the stacks with the fp32 network and report the PSNR/SSIM and the speed of the int8 network against it
         self.ngpu = 1
         self.num_workers = 0
         self.scale_factor = 1
         self.test_datasize = 400
         self.denoise_model = ''
+        self.backend = 'pytorch'  # 'pytorch' runs the .pth models in pth_dir/denoise_model, 'onnxruntime' the .onnx models exported by training_class (pth_dir set to onnx_dir)
+        self.streaming = False  # process the stacks slab by slab and append the results to the output file
+        self.sweep = False  # read and partition every stack once and denoise it with all the models
+        self.sweep_models = 1  # the number of models resident on the device at a time in a sweep
+        self.prefetch_stacks = 0  # stacks read ahead in the background, their patches are mixed in the batches (0 to test the stacks one by one)
+        self.store_backend = 'shm'  # the stack is shared with the DataLoader workers through 'shm' or a 'file' cache
+        self.cache_dir = ''  # the folder of the on-disk cache of preprocessed stacks and patch tables ('' to disable)
+        self.cache_size = 20  # the size limit of the cache in GB, the least recently used entries are evicted beyond it
+        self.cache_dtype = 'float32'  # the dtype of the cached stacks, 'float32' or 'float16' (half the size, rounded)
         self.visualize_images_per_epoch = False
         self.save_test_images_per_epoch = False
         self.colab_display = False
@@ -61,16 +88,18 @@ class testing_class():
         """
         # create some essential file for result storage
         self.prepare_file()
+        self.cache = preprocess_cache(self.cache_dir, self.cache_size, self.cache_dtype) if self.cache_dir else None
+        self.patch_sources = {}  # the preprocessed streaming stacks (see patch_source), one entry per stack
         # get models for processing
         self.read_modellist()
         # get stacks for processing
         self.read_imglist()
-        # save some essential testing parameters in para.yaml
-        self.save_yaml_test()
         # initialize denoise network with testing parameters.
         self.initialize_network()
         # specifies the GPU for the testing program.
         self.distribute_GPU()
+        # save some essential testing parameters in para.yaml
+        self.save_yaml_test()
         # start testing and result visualization during testing period (optional)
         self.test()
 
@@ -112,7 +141,11 @@ class testing_class():
         self.gap_y = int(self.patch_y * (1 - self.overlap_factor))  # patch gap in y
         self.gap_t = int(self.patch_t * (1 - self.overlap_factor))  # patch gap in t
         self.ngpu = str(self.GPU).count(',') + 1  # check the number of GPU used for testing
-        self.batch_size = self.ngpu  # By default, the batch size is equal to the number of GPU for minimal memory consumption
+        if self.batch_size is None:
+            self.batch_size = self.ngpu  # By default, the batch size is equal to the number of GPU for minimal memory consumption
+        if self.backend not in ('pytorch', 'onnxruntime'):
+            raise ValueError("backend must be 'pytorch' or 'onnxruntime', got '{}'".format(self.backend))
+        self.model_suffix = '.onnx' if self.backend == 'onnxruntime' else '.pth'  # the extension of the model files
         print('\033[1;31mTesting parameters -----> \033[0m')
         print(self.__dict__)
 
@@ -134,7 +167,7 @@ class testing_class():
         count_pth = 0
         for i in range(len(model_list)):
             aaa = model_list[i]
-            if '.pth' in aaa:
+            if aaa.endswith(self.model_suffix):
                 count_pth = count_pth + 1
         self.model_list = model_list
         self.model_list_length = count_pth
@@ -145,14 +178,22 @@ class testing_class():
 
         Important Fields:
            self.fmap: the number of the feature map in U-Net 3D network.
-           self.local_model: the denoise network
+           self.num_levels: the number of levels of U-Net 3D.
+           self.local_model: the denoise network (an onnx_network with the onnxruntime backend, an int8_network
+                             with self.quantize)
 
         """
+        if self.backend == 'onnxruntime':
+            self.local_model = onnx_network(self.device, self.num_threads)
+            return
         denoise_generator = Network_3D_Unet(in_channels=1,
                                             out_channels=1,
                                             f_maps=self.fmap,
-                                            final_sigmoid=True)
+                                            final_sigmoid=True,
+                                            num_levels=self.num_levels)
         self.local_model = denoise_generator
+        if self.quantize:
+            self.local_model = int8_network(denoise_generator, self.calibration_batches)
 
     def save_yaml_test(self):
         """
@@ -161,15 +202,17 @@ class testing_class():
         """
         yaml_name = self.output_path + '//para.yaml'
         para = {'datasets_path': 0, 'test_datasize': 0, 'denoise_model': 0,
-                'output_dir': 0, 'pth_dir': 0, 'GPU': 0, 'batch_size': 0,
+                'output_dir': 0, 'pth_dir': 0, 'GPU': 0, 'device': 0, 'batch_size': 0,
                 'patch_x': 0, 'patch_y': 0, 'patch_t': 0, 'gap_y': 0, 'gap_x': 0,
-                'gap_t': 0, 'fmap': 0, 'scale_factor': 0, 'overlap_factor': 0}
+                'gap_t': 0, 'fmap': 0, 'num_levels': 0, 'scale_factor': 0, 'overlap_factor': 0, 'precision': 0, 'backend': 0,
+                'quantize': 0}
         para["datasets_path"] = self.datasets_path
         para["denoise_model"] = self.denoise_model
         para["test_datasize"] = self.test_datasize
         para["output_dir"] = self.output_dir
         para["pth_dir"] = self.pth_dir
         para["GPU"] = self.GPU
+        para["device"] = self.device
         para["batch_size"] = self.batch_size
         para["patch_x"] = self.patch_x
         para["patch_y"] = self.patch_y
@@ -178,163 +221,543 @@ class testing_class():
         para["gap_y"] = self.gap_y
         para["gap_t"] = self.gap_t
         para["fmap"] = self.fmap
+        para["num_levels"] = self.num_levels
         para["scale_factor"] = self.scale_factor
         para["overlap_factor"] = self.overlap_factor
+        para["precision"] = self.precision
+        para["backend"] = self.backend
+        para["quantize"] = self.quantize
         with open(yaml_name, 'w') as f:
             yaml.dump(para, f)
 
     def distribute_GPU(self):
         """
         Allocate the GPU for the testing program. Print the using GPU information to the screen.
-        For acceleration, multiple GPUs parallel testing is recommended.
+        For acceleration, multiple GPUs parallel testing is recommended. If self.device is 'cpu' (or 'auto' without
+        any CUDA device), the network runs on CPU with self.num_threads intra-op threads.
+
+        Important Fields:
+           self.device : the device the network and the patches are placed on ('cuda' or 'cpu').
 
         """
-        os.environ["CUDA_VISIBLE_DEVICES"] = str(self.GPU)
-        if torch.cuda.is_available():
+        if self.precision not in PRECISION_DTYPES:
+            raise ValueError("precision must be one of 'fp32', 'fp16' and 'bf16', got '{}'".format(self.precision))
+        self.dtype = PRECISION_DTYPES[self.precision]
+        if self.quantize:
+            if self.device == 'cuda' or self.precision != 'fp32' or self.backend != 'pytorch':
+                raise ValueError("quantize runs an int8 network on CPU with the pytorch backend, set device to 'cpu' "
+                                 "(or 'auto') and precision to 'fp32'")
+            self.device = 'cpu'
+        if self.device != 'cpu':
+            os.environ["CUDA_VISIBLE_DEVICES"] = str(self.GPU)
+        if self.backend == 'onnxruntime':
+            if self.precision != 'fp32':
+                raise ValueError("the onnxruntime backend runs the fp32 ONNX models, set precision to 'fp32'")
+            # the patches stay on the host, ONNX Runtime copies them to the device of its execution provider
+            self.device = 'cpu'
+            if self.batch_size == 'auto':
+                self.batch_size = self.auto_batch_size()
+            print('\033[1;31mUsing ONNX Runtime for testing -----> \033[0m', ', '.join(self.local_model.providers))
+            return
+        self.device = get_device(self.device)
+        if self.batch_size == 'auto':
+            self.batch_size = self.auto_batch_size()
+        if self.device == 'cuda':
             self.local_model = self.local_model.cuda()
             self.local_model = nn.DataParallel(self.local_model, device_ids=range(self.ngpu))
             print('\033[1;31mUsing {} GPU(s) for testing -----> \033[0m'.format(torch.cuda.device_count()))
-        cuda = True if torch.cuda.is_available() else False
-        Tensor = torch.cuda.FloatTensor if cuda else torch.FloatTensor
+        else:
+            num_threads, num_interop_threads = set_cpu_threads(self.num_threads, self.num_interop_threads)
+            print('\033[1;31mUsing CPU for testing -----> \033[0m', num_threads, 'intra-op thread(s),',
+                  num_interop_threads, 'inter-op thread(s)')
+
+    def auto_batch_size(self):
+        """
+        Resolve batch_size='auto'. On GPU, the largest inference batch (in self.precision) fitting in the memory of
+        one GPU is probed and multiplied by the number of GPUs. Running out of RAM on CPU is not recoverable, so the
+        batch is predicted by the memory model of the planner from the available RAM instead, leaving room for the
+        noisy and the denoised stack (float32) of the largest stack.
+        Return:
+           batch_size : the number of patches per inference step
+        """
+        if self.device != 'cuda':
+            budget = memory_budget('cpu')
+            if not self.streaming:
+                # only the shapes are needed, the mean of the stacks is not computed
+                stack_voxels = max(np.prod(memmap_stack(self.datasets_path + '//' + name, self.test_datasize,
+                                                        mean=0).shape) for name in self.img_list)
+                budget = budget - 2 * 4 * int(stack_voxels)
+            batch_size = max_batch_size((self.patch_t, self.patch_y, self.patch_x), self.fmap, budget, train=False,
+                                        precision=self.precision, num_levels=self.num_levels,
+                                        device='cpu')
+            batch_size = min(max(batch_size, 1), 64)
+            print('\033[1;31mBatch size -----> \033[0m', batch_size,
+                  '({:.1f} GB RAM budget)'.format(max(budget, 0) / 1024 ** 3))
+            return batch_size
+        self.local_model = self.local_model.to(self.device, self.dtype)
+        batch_size = probe_batch_size(self.local_model, (self.patch_t, self.patch_y, self.patch_x), self.device,
+                                      train=False)
+        self.local_model.float()
+        print('\033[1;31mBatch size -----> \033[0m', batch_size * self.ngpu, '({} patch(es) per GPU)'.format(batch_size))
+        return batch_size * self.ngpu
 
     def test(self):
         """
         Pytorch testing workflow
+        Every stack is denoised by every model. By default the models are tested one by one and every stack is read
+        and partitioned again for each of them. If self.sweep is set, every stack is read and partitioned once and
+        denoised by all the models, self.sweep_models of them being resident on the device at a time so that each
+        batch of patches is read and uploaded once for all of them (the streaming workflow reads the frames on
+        demand and is not affected). If self.prefetch_stacks is set, the stacks are read in the background and
+        their patches are mixed in the batches (see denoise_stacks).
 
         """
-        pth_count=0
-        for pth_index in range(len(self.model_list)):
-            aaa = self.model_list[pth_index]
-            if '.pth' in aaa:
-                pth_count=pth_count+1
-                pth_name = self.model_list[pth_index]
-                output_path_name = self.output_path + '//' + pth_name.replace('.pth', '')
-                if not os.path.exists(output_path_name):
-                    os.mkdir(output_path_name)
-
-                # load model
-                model_name = self.pth_dir + '//' + self.denoise_model + '//' + pth_name
-                if isinstance(self.local_model, nn.DataParallel):
-                    self.local_model.module.load_state_dict(torch.load(model_name))  # parallel
-                    self.local_model.eval()
-                else:
-                    self.local_model.load_state_dict(torch.load(model_name))  # not parallel
-                    self.local_model.eval()
-                self.local_model.cuda()
-                self.print_img_name = False
+        pth_names = [pth_name for pth_name in self.model_list if pth_name.endswith(self.model_suffix)]
+        for pth_name in pth_names:
+            output_path_name = self.output_path + '//' + pth_name.replace(self.model_suffix, '')
+            if not os.path.exists(output_path_name):
+                os.mkdir(output_path_name)
+        self.print_img_name = False
+        self.sample_patch = self.get_sample_patch() if self.precision != 'fp32' else None
+
+        if self.sweep and not self.streaming:
+            # the extra models share the architecture (and the DataParallel wrapper) of self.local_model
+            models = [self.local_model] + [copy.deepcopy(self.local_model)
+                                           for _ in range(min(max(self.sweep_models, 1), len(pth_names)) - 1)]
+            for model in models:
+                self.compile_model(model)
+            if self.prefetch_stacks > 0:
+                # the stacks are read once for each group of resident models
+                for first in range(0, len(pth_names), len(models)):
+                    group = pth_names[first:first + len(models)]
+                    for model, pth_name in zip(models, group):
+                        self.load_model(model, pth_name)
+                    self.denoise_stacks(models[:len(group)], group, first + 1)
+            else:
+                loaded = [None] * len(models)  # the model file in each network, kept across stacks if all models fit
+                for N in range(len(self.img_list)):
+                    coordinate_table, noise_img, test_im_name, img_mean, input_data_type = test_preprocess_chooseOne(self, N)
+                    test_data, test_store = self.test_dataset(coordinate_table, noise_img)
+                    for first in range(0, len(pth_names), len(models)):
+                        group = pth_names[first:first + len(models)]
+                        for k, pth_name in enumerate(group):
+                            if loaded[k] != pth_name:
+                                self.load_model(models[k], pth_name)
+                                loaded[k] = pth_name
+                        denoise_imgs = self.denoise_stack(models[:len(group)], group, first + 1, test_data,
+                                                          noise_img.shape, img_mean, N)
+                        for pth_count, (pth_name, denoise_img) in enumerate(zip(group, denoise_imgs), first + 1):
+                            self.save_result(denoise_img, input_data_type, N, pth_count, pth_name)
+                    if test_store is not None:
+                        test_store.close()
+                    del noise_img, test_data
+        else:
+            self.compile_model(self.local_model)
+            for pth_count, pth_name in enumerate(pth_names, 1):
+                self.load_model(self.local_model, pth_name)
+                if self.prefetch_stacks > 0 and not self.streaming:
+                    self.denoise_stacks([self.local_model], [pth_name], pth_count)
+                    continue
                 # test all stacks
                 for N in range(len(self.img_list)):
-                    name_list, noise_img, coordinate_list,test_im_name, img_mean, input_data_type = test_preprocess_chooseOne(self, N)
-                    # print(len(name_list))
-                    prev_time = time.time()
-                    time_start = time.time()
-                    denoise_img = np.zeros(noise_img.shape)
-                    input_img = np.zeros(noise_img.shape)
-
-                    test_data = testset(name_list, coordinate_list, noise_img)
-                    testloader = DataLoader(test_data, batch_size=self.batch_size, shuffle=False,
-                                            num_workers=self.num_workers)
-                    for iteration, (noise_patch, single_coordinate) in enumerate(testloader):
-                        noise_patch = noise_patch.cuda()
-                        real_A = noise_patch
-
-                        real_A = Variable(real_A)
-                        fake_B = self.local_model(real_A)
-
-                        # Determine approximate time left
-                        batches_done = iteration
-                        batches_left = 1 * len(testloader) - batches_done
-                        time_left_seconds = int(batches_left * (time.time() - prev_time))
-                        time_left = datetime.timedelta(seconds=time_left_seconds)
-                        prev_time = time.time()
-
-                        if iteration % 1 == 0:
-                            time_end = time.time()
-                            time_cost = time_end - time_start  # datetime.timedelta(seconds= (time_end - time_start))
-                            print(
-                                '\r[Model %d/%d, %s] [Stack %d/%d, %s] [Patch %d/%d] [Time Cost: %.0d s] [ETA: %s s]     '
-                                % (
-                                    pth_count,
-                                    self.model_list_length,
-                                    pth_name,
-                                    N + 1,
-                                    len(self.img_list),
-                                    self.img_list[N],
-                                    iteration + 1,
-                                    len(testloader),
-                                    time_cost,
-                                    time_left_seconds
-                                ), end=' ')
-
-                        if (iteration + 1) % len(testloader) == 0:
-                            print('\n', end=' ')
-
-                        # Enhanced sub-stacks are sequentially output from the network
-                        output_image = np.squeeze(fake_B.cpu().detach().numpy())
-                        raw_image = np.squeeze(real_A.cpu().detach().numpy())
-                        if (output_image.ndim == 3):
-                            postprocess_turn = 1
-                        else:
-                            postprocess_turn = output_image.shape[0]
-
-                        # The final enhanced stack can be obtained by stitching all sub-stacks.
-                        if (postprocess_turn > 1):
-                            for id in range(postprocess_turn):
-                                output_patch, raw_patch, stack_start_w, stack_end_w, stack_start_h, stack_end_h, stack_start_s, stack_end_s = multibatch_test_save(
-                                    single_coordinate, id, output_image, raw_image)
-                                output_patch=output_patch+img_mean
-                                raw_patch=raw_patch+img_mean
-                                denoise_img[stack_start_s:stack_end_s, stack_start_h:stack_end_h,
-                                stack_start_w:stack_end_w] \
-                                    = output_patch * (np.sum(raw_patch) / np.sum(output_patch)) ** 0.5
-                                input_img[stack_start_s:stack_end_s, stack_start_h:stack_end_h,
-                                stack_start_w:stack_end_w] \
-                                    = raw_patch
-                        else:
-                            output_patch, raw_patch, stack_start_w, stack_end_w, stack_start_h, stack_end_h, stack_start_s, stack_end_s = singlebatch_test_save(
-                                single_coordinate, output_image, raw_image)
-                            output_patch=output_patch+img_mean
-                            raw_patch=raw_patch+img_mean
-                            denoise_img[stack_start_s:stack_end_s, stack_start_h:stack_end_h, stack_start_w:stack_end_w] \
-                                = output_patch * (np.sum(raw_patch) / np.sum(output_patch)) ** 0.5
-                            input_img[stack_start_s:stack_end_s, stack_start_h:stack_end_h, stack_start_w:stack_end_w] \
-                                = raw_patch
-
-                    # Stitching finish
-                    output_img = denoise_img.squeeze().astype(np.float32) * self.scale_factor
-                    del denoise_img
-
-
-                    # Normalize and display inference image
-                    if (self.visualize_images_per_epoch):
-                        print('Displaying the denoised file ----->')
-                        display_length = 200
-                        test_img_display(output_img, display_length=display_length, norm_min_percent=1,
-                                         norm_max_percent=99)
-
-                    # Save inference image
-                    if (self.save_test_images_per_epoch):
-                        if input_data_type == 'uint16':
-                            output_img=np.clip(output_img, 0, 65535)
-                            output_img = output_img.astype('uint16')
-
-                        elif input_data_type == 'int16':
-                            output_img=np.clip(output_img, -32767, 32767)
-                            output_img = output_img.astype('int16')
-
-                        else:
-                            output_img = output_img.astype('int32')
-
-
-
-                        result_name = output_path_name + '//' + self.img_list[N].replace('.tif','') + '_' + pth_name.replace(
-                            '.pth', '') + '_output.tif'
-                        io.imsave(result_name, output_img, check_contrast=False)
-
-                    if pth_count == self.model_list_length:
-                        if self.colab_display:
-                            self.result_display = output_path_name + '//' + self.img_list[N].replace('.tif','') + '_' + pth_name.replace(
-                            '.pth', '') + '_output.tif'
-
+                    if self.streaming:
+                        result_name = self.result_name(N, pth_name)
+                        self.stream_test(N, result_name, pth_count, pth_name)
+                        if pth_count == self.model_list_length and self.colab_display:
+                            self.result_display = result_name
+                        continue
+                    coordinate_table, noise_img, test_im_name, img_mean, input_data_type = test_preprocess_chooseOne(self, N)
+                    test_data, test_store = self.test_dataset(coordinate_table, noise_img)
+                    denoise_img, = self.denoise_stack([self.local_model], [pth_name], pth_count, test_data,
+                                                      noise_img.shape, img_mean, N)
+                    if test_store is not None:
+                        test_store.close()
+                    del noise_img, test_data
+                    self.save_result(denoise_img, input_data_type, N, pth_count, pth_name)
 
         print('Test finished. Save all results to disk.')
+
+    def compile_model(self, model):
+        """
+        Switch a network to the compiled execution of self.compile_mode (see utils.compile_network). The weights
+        loaded afterwards by load_model are used by the compiled network.
+        Args:
+            model : the network (self.local_model or a copy of it)
+        """
+        if self.compile_mode == 'none' or self.backend == 'onnxruntime' or self.quantize:
+            return
+        if isinstance(model, nn.DataParallel):
+            if len(model.device_ids) > 1:
+                # the replicas of DataParallel would all run the compiled network of the first GPU
+                print('\033[1;31mcompile_mode is not supported with several GPUs, running in eager mode \033[0m')
+                return
+            model = model.module
+        compile_network(model, self.compile_mode, self.compile_cache_dir)
+
+    def load_model(self, model, pth_name):
+        """
+        Load the weights of a model file into a network and move it to the device. The weights are loaded in fp32
+        and cast to self.precision once.
+        Args:
+            model : the network (self.local_model or a copy of it)
+            pth_name : the file name of the model
+        """
+        model_name = self.pth_dir + '//' + self.denoise_model + '//' + pth_name
+        if isinstance(model, (onnx_network, int8_network)):
+            model.load(model_name)
+            return
+        model.float()
+        if isinstance(model, nn.DataParallel):
+            model.module.load_state_dict(torch.load(model_name, map_location=self.device))  # parallel
+        else:
+            model.load_state_dict(torch.load(model_name, map_location=self.device))  # not parallel
+        model.eval()
+        model.to(self.device)
+        if self.precision != 'fp32':
+            self.precision_report(model, self.sample_patch, pth_name)
+
+    def test_dataset(self, coordinate_table, noise_img):
+        """
+        The testset of a stack. With DataLoader workers, the workers read the patches from a shared stack_store
+        instead of receiving a copy of the stack.
+        Return:
+            test_data : the testset
+            test_store : the stack_store holding the stack (to be closed after testing), or None
+        """
+        if self.num_workers > 0:
+            test_store = stack_store(self.store_backend)
+            return testset(coordinate_table, test_store, test_store.append(noise_img)), test_store
+        return testset(coordinate_table, noise_img), None
+
+    def denoise_stack(self, models, pth_names, pth_count, test_data, shape, img_mean, img_id):
+        """
+        Denoise a stack with one or several models. The patches are read and uploaded to the device once, each
+        batch goes through all the models.
+        Args:
+            models : the networks
+            pth_names : the file names of the models
+            pth_count : the index of the first model in the model list
+            test_data : the testset of the stack
+            shape : the shape of the stack
+            img_mean : the mean of the raw noisy stack
+            img_id : the index of the stack in self.img_list
+        Return:
+            denoise_imgs : the stitched float32 stack of each model
+        """
+        prev_time = time.time()
+        time_start = time.time()
+        # the fp32 networks of the int8 networks denoise the stack as well for the drift report
+        references = [model.float_model for model in models] if self.quantize and self.quantize_report else []
+        model_time = [0] * len(models + references)
+        denoise_imgs = [np.zeros(shape, dtype=np.float32) for _ in models + references]
+        testloader = DataLoader(test_data, batch_size=self.batch_size, shuffle=False,
+                                num_workers=self.num_workers, pin_memory=self.device == 'cuda')
+        # the next batch is uploaded and the previous output downloaded while the current one is computed
+        stitchers = [batch_stitcher(denoise_img, img_mean) for denoise_img in denoise_imgs]
+        test_batches = device_prefetcher(testloader, self.device, self.dtype)
+        for iteration, (noise_patch, single_coordinate) in enumerate(test_batches):
+            real_A = noise_patch
+
+            real_A = Variable(real_A)
+            for k, (model, stitcher) in enumerate(zip(models + references, stitchers)):
+                model_start = time.time()
+                with torch.no_grad():
+                    fake_B = model(real_A)
+                model_time[k] += time.time() - model_start
+                # The final enhanced stack can be obtained by stitching all sub-stacks.
+                stitcher.submit(fake_B, real_A, single_coordinate)
+
+            # Determine approximate time left
+            batches_done = iteration
+            batches_left = 1 * len(testloader) - batches_done
+            time_left_seconds = int(batches_left * (time.time() - prev_time))
+            time_left = datetime.timedelta(seconds=time_left_seconds)
+            prev_time = time.time()
+
+            if iteration % 1 == 0:
+                time_end = time.time()
+                time_cost = time_end - time_start  # datetime.timedelta(seconds= (time_end - time_start))
+                print(
+                    '\r[Model %d/%d, %s] [Stack %d/%d, %s] [Patch %d/%d] [Time Cost: %.0d s] [ETA: %s s]     '
+                    % (
+                        pth_count,
+                        self.model_list_length,
+                        ','.join(pth_names),
+                        img_id + 1,
+                        len(self.img_list),
+                        self.img_list[img_id],
+                        iteration + 1,
+                        len(testloader),
+                        time_cost,
+                        time_left_seconds
+                    ), end=' ')
+
+            if (iteration + 1) % len(testloader) == 0:
+                print('\n', end=' ')
+        for stitcher in stitchers:
+            stitcher.flush()
+        for k, pth_name in enumerate(pth_names[:len(references)]):
+            psnr, ssim = drift_report(denoise_imgs[len(models) + k], denoise_imgs[k])
+            print('\033[1;31mint8 inference drift from fp32 ({}, {}) -----> \033[0m'.format(pth_name,
+                                                                                         self.img_list[img_id]))
+            print('PSNR: %.2f dB, SSIM: %.4f, int8 speedup: %.2fx'
+                  % (psnr, ssim, model_time[len(models) + k] / max(model_time[k], 1e-9)))
+        return denoise_imgs[:len(models)]
+
+    def denoise_stacks(self, models, pth_names, pth_count):
+        """
+        Denoise all the stacks with one or several models through a stack_scheduler: the next
+        self.prefetch_stacks stacks are read and partitioned in the background while the current one is denoised,
+        and the batches mix the patches of consecutive stacks. The outputs are routed to the stitcher of their
+        stack, and a stack is saved as soon as all its patches are stitched.
+        Args:
+            models : the networks
+            pth_names : the file names of the models
+            pth_count : the index of the first model in the model list
+        """
+        time_start = time.time()
+        scheduler = stack_scheduler(lambda img_id: test_preprocess_chooseOne(self, img_id), range(len(self.img_list)),
+                                    self.batch_size, self.prefetch_stacks, pin_memory=self.device == 'cuda')
+        stacks = {}  # img_id : [denoised stacks, stitchers, input_data_type, patches left]
+        for item in scheduler:
+            if item[0] == 'stack':
+                _, img_id, shape, img_mean, input_data_type, patch_num = item
+                denoise_imgs = [np.zeros(shape, dtype=np.float32) for _ in models]
+                stacks[img_id] = [denoise_imgs, [batch_stitcher(denoise_img, img_mean) for denoise_img in denoise_imgs],
+                                  input_data_type, patch_num]
+                continue
+            _, noise_patch, single_coordinate, stack_index = item
+            real_A = noise_patch.to(self.device, self.dtype, non_blocking=True)
+            single_coordinate = single_coordinate.to(self.device, non_blocking=True)
+            with torch.no_grad():
+                fake_Bs = [model(real_A) for model in models]
+
+            # route the outputs to the stitchers of their stacks
+            for img_id in stack_index.unique().tolist():
+                index = (stack_index == img_id).nonzero().squeeze(1)
+                whole_batch = len(index) == len(stack_index)
+                if not whole_batch:
+                    index = index.to(self.device)
+                for fake_B, stitcher in zip(fake_Bs, stacks[img_id][1]):
+                    if whole_batch:
+                        stitcher.submit(fake_B, real_A, single_coordinate)
+                    else:
+                        stitcher.submit(fake_B[index], real_A[index], single_coordinate[index])
+                stacks[img_id][3] -= len(index)
+                if stacks[img_id][3] > 0:
+                    continue
+
+                denoise_imgs, stitchers, input_data_type, _ = stacks.pop(img_id)
+                for stitcher in stitchers:
+                    stitcher.flush()
+                print('\r[Model %d/%d, %s] [Stack %d/%d, %s] [Time Cost: %.0d s]     '
+                      % (pth_count, self.model_list_length, ','.join(pth_names), img_id + 1, len(self.img_list),
+                         self.img_list[img_id], time.time() - time_start), end=' ')
+                for model_index, (pth_name, denoise_img) in enumerate(zip(pth_names, denoise_imgs)):
+                    self.save_result(denoise_img, input_data_type, img_id, pth_count + model_index, pth_name)
+                del denoise_imgs
+        print('\n', end=' ')
+
+    def result_name(self, img_id, pth_name):
+        return self.output_path + '//' + pth_name.replace(self.model_suffix, '') + '//' \
+               + self.img_list[img_id].replace('.tif', '') + '_' + pth_name.replace(self.model_suffix, '') + '_output.tif'
+
+    def save_result(self, denoise_img, input_data_type, img_id, pth_count, pth_name):
+        """
+        Rescale a stitched stack, display and save it.
+        """
+        # Stitching finish
+        output_img = denoise_img.squeeze() * self.scale_factor
+        del denoise_img
+
+        # Normalize and display inference image
+        if (self.visualize_images_per_epoch):
+            print('Displaying the denoised file ----->')
+            display_length = 200
+            test_img_display(output_img, display_length=display_length, norm_min_percent=1,
+                             norm_max_percent=99)
+
+        # Save inference image
+        if (self.save_test_images_per_epoch):
+            output_img = self.convert_output_type(output_img, input_data_type)
+            io.imsave(self.result_name(img_id, pth_name), output_img, check_contrast=False)
+
+        if pth_count == self.model_list_length:
+            if self.colab_display:
+                self.result_display = self.result_name(img_id, pth_name)
+
+    def patch_source(self, img_id):
+        """
+        The streaming stack (see test_preprocess_stream), kept for the whole run: the mean of the stack is a pass
+        over the whole file (unless it is in self.cache), which is done once per stack instead of once per model.
+        Return:
+            coordinate_table, noise_im, im_name, img_mean, input_data_type (see test_preprocess_stream)
+        """
+        if img_id not in self.patch_sources:
+            self.patch_sources[img_id] = test_preprocess_stream(self, img_id)
+        return self.patch_sources[img_id]
+
+    def calibration_batches(self):
+        """
+        The batches of patches calibrating the int8 network (see quantize.int8_network): self.calibration_size
+        patches evenly spread over the patches of all the stacks, drawn through testset. The mean of every stack is
+        computed by the first calibration (see patch_source), then only the frames of these patches are read.
+        """
+        per_stack = int(np.ceil(self.calibration_size / len(self.img_list)))
+        batch = []
+        for img_id in range(len(self.img_list)):
+            coordinate_table, noise_im, _, _, _ = self.patch_source(img_id)
+            calibration_data = testset(coordinate_table, noise_im)
+            for index in np.unique(np.linspace(0, len(calibration_data) - 1, per_stack).astype(int)):
+                batch.append(calibration_data[index][0])
+                if len(batch) == self.batch_size:
+                    yield torch.stack(batch)
+                    batch = []
+        if batch:
+            yield torch.stack(batch)
+
+    def get_sample_patch(self):
+        """
+        Read the first patch of the first stack, which is used to compare the reduced precision network with fp32.
+        The mean of the stack is computed (see patch_source), then only the frames of this patch are read.
+        """
+        coordinate_table, noise_im, _, _, _ = self.patch_source(0)
+        sample_patch, _ = testset(coordinate_table, noise_im)[0]
+        return sample_patch.unsqueeze(0)
+
+    def precision_report(self, model, sample_patch, pth_name):
+        """
+        Run the sample patch through the fp32 network and through the network in self.precision, and print the
+        deviation of the reduced precision output (the maximum and mean absolute error, the maximum error relative
+        to the output range and the PSNR against the fp32 output). The network is passed in fp32 and left in
+        self.precision.
+        """
+        with torch.no_grad():
+            reference = model(sample_patch.to(self.device)).float()
+            model.to(self.dtype)
+            output = model(sample_patch.to(self.device, self.dtype)).float()
+        error = (output - reference).abs()
+        output_range = (reference.max() - reference.min()).item()
+        mse = (error ** 2).mean().item()
+        psnr = 10 * np.log10(output_range ** 2 / mse) if mse > 0 else float('inf')
+        print('\033[1;31m{} inference deviation from fp32 on a sample patch ({}) -----> \033[0m'.format(
+            self.precision, pth_name))
+        print('max abs error: %.4g, mean abs error: %.4g, max error / output range: %.4g, PSNR: %.2f dB'
+              % (error.max().item(), error.mean().item(), error.max().item() / max(output_range, 1e-12), psnr))
+
+    def convert_output_type(self, output_img, input_data_type):
+        """
+        Clip the denoised stack to the range of the data type of the noisy stack and convert it.
+        """
+        if input_data_type == 'uint16':
+            output_img=np.clip(output_img, 0, 65535)
+            output_img = output_img.astype('uint16')
+
+        elif input_data_type == 'int16':
+            output_img=np.clip(output_img, -32767, 32767)
+            output_img = output_img.astype('int16')
+
+        else:
+            output_img = output_img.astype('int32')
+        return output_img
+
+    def stream_test(self, img_id, result_name, pth_count, pth_name):
+        """
+        Streaming inference workflow. The stack is processed in temporal slabs (all patches sharing the same
+        frames, i.e. patch_t frames including the overlap). Only the frames of the current slab are read from
+        disk and the frames which are finished are appended to the output tif file, so the memory consumption
+        is bounded by the slab size instead of the recording length. As in save_result, the output file is only
+        written if self.save_test_images_per_epoch is set.
+        Args:
+            img_id : the index of the stack in self.img_list
+            result_name : the file name of the denoised stack
+            pth_count : the index of the model being tested
+            pth_name : the file name of the model being tested
+        """
+        coordinate_table, noise_im, test_im_name, img_mean, input_data_type = self.patch_source(img_id)
+        output_data_type = self.convert_output_type(np.zeros(1, dtype=np.float32), input_data_type).dtype
+        denoise_frames = self.stream_denoise(noise_im, coordinate_table, img_mean, input_data_type,
+                                             img_id, pth_count, pth_name)
+        if self.save_test_images_per_epoch:
+            # the frames are written page by page as soon as they are yielded
+            tiff.imwrite(result_name, denoise_frames, shape=noise_im.shape, dtype=output_data_type)
+        else:
+            for _ in denoise_frames:
+                pass
+        print('\n', end=' ')
+
+    def stream_denoise(self, noise_im, coordinate_table, img_mean, input_data_type, img_id, pth_count, pth_name):
+        """
+        Denoise the stack slab by slab and yield the finished output frames in order.
+        """
+        whole_t = noise_im.shape[0]
+        frame_shape = noise_im.shape[1:]
+
+        # the coordinate table is sorted by time, patches sharing the same frames form a temporal slab
+        slab_init_s, slab_index = np.unique(coordinate_table[:, 0], return_index=True)
+        slab_list = np.split(coordinate_table, slab_index[1:])
+
+        time_start = time.time()
+        buffer_start = 0
+        denoise_buffer = np.zeros((0,) + frame_shape, dtype=np.float32)
+        for slab_id, slab_table in enumerate(slab_list):
+            init_s, end_s = slab_table[0, 0:2]
+            slab_start = slab_table[:, 6].min()
+            slab_end = slab_table[:, 7].max()
+
+            # frames before this slab will not be touched anymore, hand them to the writer
+            yield from self.finished_frames(denoise_buffer, slab_start - buffer_start, input_data_type)
+            keep_buffer = denoise_buffer[slab_start - buffer_start:]
+            denoise_buffer = np.zeros((max(slab_end - slab_start, len(keep_buffer)),) + frame_shape, dtype=np.float32)
+            denoise_buffer[:len(keep_buffer)] = keep_buffer
+            buffer_start = slab_start
+
+            # coordinates relative to the slab and to the output buffer
+            slab_table = slab_table.copy()
+            slab_table[:, 0:2] -= init_s
+            slab_table[:, 6:8] -= buffer_start
+
+            noise_slab = noise_im[init_s:end_s]
+            test_data = testset(slab_table, noise_slab)
+            testloader = DataLoader(test_data, batch_size=self.batch_size, shuffle=False,
+                                    num_workers=self.num_workers, pin_memory=self.device == 'cuda')
+            stitcher = batch_stitcher(denoise_buffer, img_mean)
+            for iteration, (real_A, single_coordinate) in enumerate(device_prefetcher(testloader, self.device, self.dtype)):
+                with torch.no_grad():
+                    fake_B = self.local_model(real_A)
+                stitcher.submit(fake_B, real_A, single_coordinate)
+            stitcher.flush()
+
+            time_cost = time.time() - time_start
+            time_left_seconds = int(time_cost / (slab_id + 1) * (len(slab_list) - slab_id - 1))
+            print(
+                '\r[Model %d/%d, %s] [Stack %d/%d, %s] [Slab %d/%d] [Time Cost: %.0d s] [ETA: %s s]     '
+                % (
+                    pth_count,
+                    self.model_list_length,
+                    pth_name,
+                    img_id + 1,
+                    len(self.img_list),
+                    self.img_list[img_id],
+                    slab_id + 1,
+                    len(slab_list),
+                    time_cost,
+                    time_left_seconds
+                ), end=' ')
+
+        # the remaining frames of the last slab
+        yield from self.finished_frames(denoise_buffer, whole_t - buffer_start, input_data_type)
+
+    def finished_frames(self, denoise_buffer, frame_num, input_data_type):
+        """
+        Convert the first frame_num frames of the stitched buffer to the output data type and yield them one by one.
+        Frames which are not covered by any patch are zeros, the same as in the non-streaming workflow.
+        """
+        if frame_num <= 0:
+            return
+        output_img = np.zeros((frame_num,) + denoise_buffer.shape[1:], dtype=np.float32)
+        covered = min(frame_num, len(denoise_buffer))
+        output_img[:covered] = denoise_buffer[:covered]
+        output_img = self.convert_output_type(output_img * self.scale_factor, input_data_type)
+        for frame in output_img:
+            yield frame
@@ -1,4 +1,8 @@
 import os
+import sys
+import glob
+import json
+import subprocess
 import datetime
 
 import numpy as np
@@ -9,17 +13,56 @@ import tifffile as tiff
 import random
 import math
 import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
 from torch.utils.data import Dataset
 import torch.nn as nn
 from torch.autograd import Variable
 from torch.utils.data import DataLoader
 import time
 import datetime
-from .data_process import trainset, test_preprocess_chooseOne, testset, multibatch_test_save, singlebatch_test_save
+from .utils import get_device, set_cpu_threads, autocast, grad_scaler, find_free_port, probe_batch_size, \
+    background_writer, to_host, get_rng_state, set_rng_state, compile_network
+from .planner import memory_budget, max_batch_size
+from .cache import preprocess_cache
+from .quantize import drift_report
+from .data_process import trainset, resumable_sampler, random_transform_batch, memmap_stack, stack_store, train_partition, test_preprocess_chooseOne, testset, \
+    batch_stitcher, device_prefetcher, stack_raw_mean
 from skimage import io
 from .movie_display import test_img_display,display_img
 
 
+CHECKPOINT_NAME = 'train_state.ckpt'  # not a .pth file, the model folders are searched for .pth files by testing_class
+
+
+def export_onnx(model_name, onnx_save_name, fmap, num_levels, patch_shape, previous_onnx=None):
+    """
+    Export a model file to ONNX from a network on the CPU.
+    Args:
+       model_name : the .pth file of the weights
+       onnx_save_name : the file name of the ONNX model
+       fmap, num_levels : the feature maps and the levels of the network
+       patch_shape : the (t, y, x) shape of the example patch
+       previous_onnx : the file name of an ONNX model removed after the export, or None
+    """
+    export_model = Network_3D_Unet(in_channels=1, out_channels=1, f_maps=fmap, final_sigmoid=True,
+                                   num_levels=num_levels)
+    export_model.load_state_dict(torch.load(model_name, map_location='cpu'))
+    export_model.eval()
+    input_name = ['input']
+    output_name = ['output']
+
+    # the batch and the patch axes are dynamic, the model runs on any batch size and patch shape (see onnx_backend)
+    dynamic_axes = {0: 'batch', 2: 'patch_t', 3: 'patch_y', 4: 'patch_x'}
+    input = torch.randn(1, 1, *patch_shape, requires_grad=True)
+    torch.onnx.export(export_model, input, onnx_save_name, export_params=True,input_names=input_name, output_names=output_name,opset_version=11, verbose=False,
+                      dynamic_axes={'input': dynamic_axes, 'output': dynamic_axes})
+    # the weights may be stored in an external data file next to the ONNX model
+    for file_name in ([previous_onnx, previous_onnx + '.data'] if previous_onnx is not None else []):
+        if os.path.exists(file_name):
+            os.remove(file_name)
+
+
 class training_class():
     """
     Class implementing training process
@@ -41,10 +84,16 @@ class training_class():
         self.datasets_path = ''
         self.n_epochs = 20
         self.fmap = 16
+        self.num_levels = 4  # the number of levels of U-Net 3D (the feature maps double at every level)
+        self.teacher_model = ''  # a trained .pth model whose outputs the network learns to reproduce, to distill it into a thinner (fmap) or shallower (num_levels) network ('' to disable)
+        self.teacher_fmap = 16  # the number of feature maps of the teacher model
+        self.teacher_levels = 4  # the number of levels of the teacher model
+        self.distillation_weight = 1.0  # the weight of the loss against the teacher outputs, the self-supervised loss against the next frames gets the rest
+        self.checkpoint_levels = []  # the U-Net levels (0 for full resolution, or 'all') recomputing their activations in the backward pass to save memory
         self.output_dir = './results'
         self.pth_dir = './pth'
         self.onnx_dir = './onnx'
-        self.batch_size = 1
+        self.batch_size = None  # patches per step (None for one patch per GPU, 'auto' for the largest batch fitting in GPU memory)
         self.patch_t = 150
         self.patch_x = 150
         self.patch_y = 150
@@ -55,12 +104,34 @@ class training_class():
         self.b1 = 0.5
         self.b2 = 0.999
         self.GPU = '0'
+        self.device = 'auto'  # 'auto' (CUDA if available), 'cuda' or 'cpu'
+        self.num_threads = 0  # intra-op threads on CPU (0 for the number of cores available to the process)
+        self.num_interop_threads = 0  # inter-op threads on CPU (0 for one thread)
+        self.precision = 'fp32'  # 'fp32', or 'fp16'/'bf16' for automatic mixed precision training
+        self.compile_mode = 'none'  # 'none' (eager), 'compile' (torch.compile, pytorch >= 2.0) or 'script' (TorchScript) execution of the network, compiled once per patch shape
+        self.compile_cache_dir = ''  # the folder of the kernels compiled by compile_mode 'compile', reused by later runs ('' for the default folder)
+        self.distributed = False  # one training process per device with DistributedDataParallel
+        self.world_size = 0  # the number of training processes (0 for one process per GPU in self.GPU)
+        self.dist_backend = 'auto'  # 'auto' (nccl on CUDA, gloo on CPU), 'nccl' or 'gloo'
         self.ngpu = 1
         self.num_workers = 0
         self.scale_factor = 1
         self.train_datasets_size = 2000
         self.select_img_num = 1000
         self.test_datasize = 400  # how many slices to be tested (use the first image in the folder by default)
+        self.memory_map = False  # read patches from memory-mapped tif files instead of loading all stacks into RAM
+        self.device_augmentation = True  # rotate/flip/swap whole batches on the training device instead of in the workers
+        self.store_backend = 'shm'  # the stacks in RAM are shared with the DataLoader workers through 'shm' or a 'file' cache
+        self.cache_dir = ''  # the folder of the on-disk cache of preprocessed stacks and patch tables ('' to disable)
+        self.cache_size = 20  # the size limit of the cache in GB, the least recently used entries are evicted beyond it
+        self.cache_dtype = 'float32'  # the dtype of the cached stacks, 'float32' or 'float16' (half the size, rounded)
+        self.async_save = True  # write the checkpoints in a background thread and export the ONNX models in a child process started by it
+        self.resume = ''  # resume an interrupted training from a training checkpoint (.ckpt) or the newest one in a folder
+        self.checkpoint_interval = 0  # iterations between training checkpoints (0 for one at the end of every epoch only)
+        self.validation_size = 0  # the number of patches held out of training for validation (0 to disable validation)
+        self.validation_interval = 0  # iterations between validations (0 for one at the end of every epoch)
+        self.early_stopping = 0  # stop after this number of validations without improvement (0 to train all epochs)
+        self.onnx_export = 'epoch'  # export the ONNX model every 'epoch', at the 'best' epoch (lowest validation or training loss), at the 'final' epoch or 'none'
         self.visualize_images_per_epoch = False
         self.save_test_images_per_epoch = False
         self.colab_display = False
@@ -69,21 +140,77 @@ class training_class():
     def run(self):
         """
         General function for training DeepCAD network.
+        If self.distributed is set, the function is run by every training process. Processes started by torchrun
+        (or any launcher setting RANK and WORLD_SIZE) join the process group directly, otherwise one process per
+        device is spawned here. With the spawn launcher, the calling script must be guarded by
+        if __name__ == '__main__'.
 
         """
+        if self.distributed and 'RANK' not in os.environ:
+            self.spawn_workers()
+            return
+        # join the process group of distributed training (rank 0 and a single process otherwise)
+        self.init_distributed()
+        # load the state of the interrupted training to resume (optional)
+        self.read_checkpoint()
         # create some essential file for result storage
         self.prepare_file()
+        self.cache = preprocess_cache(self.cache_dir, self.cache_size, self.cache_dtype) if self.cache_dir else None
         # crop input tiff file into 3D patches
         self.train_preprocess_lessMemoryMulStacks()
-        # save some essential training parameters in para.yaml
-        self.save_yaml_train()
         # initialize denoise network with training parameters.
         self.initialize_network()
         # specifies the GPU for the training program.
         self.distribute_GPU()
+        # save some essential training parameters in para.yaml
+        if self.rank == 0:
+            self.save_yaml_train()
         # start training and result visualization during training period (optional)
         self.train()
+        if self.distributed:
+            dist.destroy_process_group()
+
+    def spawn_workers(self):
+        """
+        Start one training process per device on this node and wait for them to finish.
 
+        """
+        world_size = self.world_size if self.world_size > 0 else self.ngpu
+        os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+        os.environ.setdefault('MASTER_PORT', str(find_free_port()))
+        print('\033[1;31mStarting {} training processes -----> \033[0m'.format(world_size))
+        mp.spawn(distributed_worker, args=(self, world_size), nprocs=world_size, join=True)
+
+    def init_distributed(self):
+        """
+        Join the process group of distributed training. Only rank 0 prints logs, saves the checkpoints and exports
+        the onnx models.
+
+        Important Fields:
+           self.rank : the global rank of the process (0 without distributed training)
+           self.local_rank : the rank of the process on this node, which is also the index of its GPU
+           self.world_size : the number of training processes (1 without distributed training)
+           self.local_world_size : the number of training processes on this node
+
+        """
+        if not self.distributed:
+            self.rank, self.local_rank, self.world_size, self.local_world_size = 0, 0, 1, 1
+            return
+        self.rank = int(os.environ['RANK'])
+        self.world_size = int(os.environ['WORLD_SIZE'])
+        self.local_rank = int(os.environ.get('LOCAL_RANK', self.rank))
+        self.local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', self.world_size))
+        if self.device != 'cpu':
+            os.environ["CUDA_VISIBLE_DEVICES"] = str(self.GPU)
+        self.device = get_device(self.device)
+        backend = self.dist_backend
+        if backend == 'auto':
+            backend = 'nccl' if self.device == 'cuda' else 'gloo'
+        if self.device == 'cuda':
+            torch.cuda.set_device(self.local_rank)
+        dist.init_process_group(backend=backend, init_method='env://')
+        if self.rank != 0:
+            sys.stdout = open(os.devnull, 'w')
 
     def prepare_file(self):
         """
@@ -101,6 +228,17 @@ class training_class():
         pth_name = self.datasets_name + '_' + datetime.datetime.now().strftime("%Y%m%d%H%M")
         self.pth_path = self.pth_dir + '/' + pth_name
         self.onnx_path = self.onnx_dir + '/' + pth_name
+        if self.resume_state is not None:
+            # the interrupted training goes on in its folders
+            self.pth_path = self.resume_state['pth_path']
+            self.onnx_path = self.resume_state['onnx_path']
+        if self.distributed:
+            # the folder name is taken from rank 0, the processes may not start in the same minute
+            paths = [self.pth_path, self.onnx_path]
+            dist.broadcast_object_list(paths, src=0)
+            self.pth_path, self.onnx_path = paths
+            if self.rank != 0:
+                return
         if not os.path.exists(self.pth_path):
             os.makedirs(self.pth_path)
         if not os.path.exists(self.onnx_path):
@@ -108,6 +246,34 @@ class training_class():
         if not os.path.exists(self.output_dir):
             os.mkdir(self.output_dir)
 
+    def read_checkpoint(self):
+        """
+        Find and load the training checkpoint to resume from. self.resume is a training checkpoint (.ckpt) or a
+        folder searched for the newest one, the training starts from scratch if there is none or if the newest one
+        is the end of a finished training (so that a preempted job can be submitted again with the same parameters).
+        Important Fields:
+            self.resume_state : the content of the training checkpoint, or None to train from scratch
+
+        """
+        self.resume_state = None
+        if not self.resume:
+            return
+        if os.path.isdir(self.resume):
+            checkpoint_list = glob.glob(os.path.join(self.resume, '**', '*.ckpt'), recursive=True)
+            checkpoint_name = max(checkpoint_list, key=os.path.getmtime) if checkpoint_list else None
+        else:
+            checkpoint_name = self.resume if os.path.exists(self.resume) else None
+        if checkpoint_name is None:
+            print('No training checkpoint found in {}, training from scratch'.format(self.resume))
+            return
+        state = torch.load(checkpoint_name, map_location='cpu')
+        if os.path.isdir(self.resume) and state['finished']:
+            # the newest training in the folder is complete, a finished training is only continued if named
+            print('The training of {} is finished, training from scratch'.format(checkpoint_name))
+            return
+        print('\033[1;31mResume training from -----> \033[0m', checkpoint_name)
+        self.resume_state = state
+
     def set_params(self, params_dict):
         """
         Set the params set by user to the training class object and calculate some default parameters for training
@@ -121,7 +287,8 @@ class training_class():
         self.gap_y = int(self.patch_y * (1 - self.overlap_factor))  # patch gap in y
         self.gap_t = int(self.patch_t * (1 - self.overlap_factor))  # patch gap in t
         self.ngpu = str(self.GPU).count(',') + 1                    # check the number of GPU used for training
-        self.batch_size = self.ngpu                                 # By default, the batch size is equal to the number of GPU for minimal memory consumption
+        if self.batch_size is None:
+            self.batch_size = self.ngpu                             # By default, the batch size is equal to the number of GPU for minimal memory consumption
         print('\033[1;31mTraining parameters -----> \033[0m')
         print(self.__dict__)
 
@@ -132,14 +299,31 @@ class training_class():
 
         Important Fields:
            self.fmap: the number of the feature map in U-Net 3D network.
+           self.num_levels: the number of levels of U-Net 3D.
+           self.checkpoint_levels: the levels of U-Net 3D using activation checkpointing.
            self.local_model: the denoise network
+           self.teacher: the teacher network of the distillation (None without self.teacher_model)
 
         """
         denoise_generator = Network_3D_Unet(in_channels=1,
                                             out_channels=1,
                                             f_maps=self.fmap,
-                                            final_sigmoid=True)
+                                            final_sigmoid=True,
+                                            num_levels=self.num_levels,
+                                            checkpoint_levels=self.checkpoint_levels)
         self.local_model = denoise_generator
+        self.teacher = None
+        if self.teacher_model:
+            self.teacher = Network_3D_Unet(in_channels=1, out_channels=1, f_maps=self.teacher_fmap, final_sigmoid=True,
+                                           num_levels=self.teacher_levels)
+            self.teacher.load_state_dict(torch.load(self.teacher_model, map_location='cpu'))
+            self.teacher.eval()
+            for parameter in self.teacher.parameters():
+                parameter.requires_grad = False
+            if self.rank == 0:
+                print('\033[1;31mDistilling the teacher model -----> \033[0m', self.teacher_model,
+                      '(fmap {}, {} levels) into fmap {}, {} levels'.format(self.teacher_fmap, self.teacher_levels,
+                                                                           self.fmap, self.num_levels))
 
     def get_gap_t(self):
         """
@@ -160,16 +344,17 @@ class training_class():
         overlap factor in each dimension.
 
         Important Fields:
-           self.name_list : the coordinates of 3D patch are indexed by the patch name in name_list.
-           self.coordinate_list : record the coordinate of 3D patch preparing for partition in whole stack.
-           self.stack_index : the index of the noisy stacks.
-           self.noise_im_all : the collection of all noisy stacks.
+           self.coordinate_table : record the index of the noisy stack and the coordinate of 3D patch preparing for
+                                   partition in whole stack (one row per patch, see TRAIN_COLUMNS).
+           self.noise_im_all : the collection of all noisy stacks, a stack_store holding the float32 stacks shared
+                               with the DataLoader workers (a list of the stacks without workers). If
+                               self.memory_map is set, it is a list of memmap_stack objects which only read the
+                               frames of a patch when it is requested.
 
         """
-        self.name_list = []
-        self.coordinate_list = {}
-        self.stack_index = []
-        self.noise_im_all = []
+        coordinate_table = []
+        # the stacks are only copied to the shared store when DataLoader workers read them (as in test)
+        self.noise_im_all = [] if self.memory_map or self.num_workers == 0 else stack_store(self.store_backend)
         ind = 0
         print('\033[1;31mImage list for training -----> \033[0m')
         self.stack_num = len(list(os.walk(self.datasets_path, topdown=False))[-1][-1])
@@ -178,45 +363,78 @@ class training_class():
         for im_name in list(os.walk(self.datasets_path, topdown=False))[-1][-1]:
             print('Noise image name -----> ', im_name)
             im_dir = self.datasets_path + '//' + im_name
-            noise_im = tiff.imread(im_dir)
-            if noise_im.shape[0] > self.select_img_num:
-                noise_im = noise_im[0:self.select_img_num, :, :]
+            if self.memory_map:
+                # Scaling and minus mean are applied on the fly when a patch is read
+                noise_im = memmap_stack(im_dir, frame_num=self.select_img_num, scale_factor=self.scale_factor, mean=0)
+                # the mean pass over the stack is skipped when the mean is in the preprocessing cache
+                noise_im.mean = np.float32(stack_raw_mean(self.cache, noise_im, noise_im.shape[0]) / self.scale_factor)
+            else:
+                noise_im = self.read_stack(im_dir)
             self.whole_x = noise_im.shape[2]
             self.whole_y = noise_im.shape[1]
             self.whole_t = noise_im.shape[0]
             print('Noise image shape -----> ', noise_im.shape)
             # Calculate real gap_t
             self.get_gap_t()
-            # No preprocessing
-            # noise_im = noise_im.astype(np.float32) / self.scale_factor
-            # Minus mean before training
-            noise_im = noise_im.astype(np.float32)/self.scale_factor
-            noise_im = noise_im-noise_im.mean()
 
             self.noise_im_all.append(noise_im)
-            patch_t2 = self.patch_t * 2
-            for x in range(0, int((self.whole_y - self.patch_y + self.gap_y) / self.gap_y)):
-                for y in range(0, int((self.whole_x - self.patch_x + self.gap_x) / self.gap_x)):
-                    for z in range(0, int((self.whole_t - patch_t2 + self.gap_t) / self.gap_t)):
-                        single_coordinate = {'init_h': 0, 'end_h': 0, 'init_w': 0, 'end_w': 0, 'init_s': 0, 'end_s': 0}
-                        init_h = self.gap_y * x
-                        end_h = self.gap_y * x + self.patch_y
-                        init_w = self.gap_x * y
-                        end_w = self.gap_x * y + self.patch_x
-                        init_s = self.gap_t * z
-                        end_s = self.gap_t * z + patch_t2
-                        single_coordinate['init_h'] = init_h
-                        single_coordinate['end_h'] = end_h
-                        single_coordinate['init_w'] = init_w
-                        single_coordinate['end_w'] = end_w
-                        single_coordinate['init_s'] = init_s
-                        single_coordinate['end_s'] = end_s
-                        patch_name = self.datasets_name + '_' + im_name.replace('.tif', '') + '_x' + str(
-                            x) + '_y' + str(y) + '_z' + str(z)
-                        self.name_list.append(patch_name)
-                        self.coordinate_list[patch_name] = single_coordinate
-                        self.stack_index.append(ind)
+            coordinate_table.append(self.read_table(im_dir, ind))
             ind = ind + 1
+        self.coordinate_table = np.concatenate(coordinate_table)
+
+    def read_stack(self, im_dir):
+        """
+        Read a noisy stack and preprocess it (the first self.select_img_num frames, scaled and minus mean). The
+        preprocessed stack is read from the on-disk cache if it is there, and stored in it otherwise.
+
+        Args:
+            im_dir : the path of the noisy stack
+        Return:
+            noise_im : the preprocessed float32 stack
+        """
+        if self.cache is not None:
+            key = self.cache.key(im_dir, stack='train', scale_factor=self.scale_factor,
+                                 select_img_num=self.select_img_num)
+            entry = self.cache.get(key)
+            if entry is not None:
+                return entry[0]['stack']
+        noise_im = tiff.imread(im_dir)
+        if noise_im.shape[0] > self.select_img_num:
+            noise_im = noise_im[0:self.select_img_num, :, :]
+        # No preprocessing
+        # noise_im = noise_im.astype(np.float32) / self.scale_factor
+        # Minus mean before training
+        noise_im = noise_im.astype(np.float32)/self.scale_factor
+        noise_im = noise_im-noise_im.mean()
+        if self.cache is not None and self.rank == 0:
+            self.cache.put(key, {'stack': noise_im}, {})
+        return noise_im
+
+    def read_table(self, im_dir, stack_index):
+        """
+        Partition a noisy stack with the current patch geometry. The patch table is read from the on-disk cache
+        if it is there, and stored in it otherwise.
+
+        Args:
+            im_dir : the path of the noisy stack
+            stack_index : the index of the noisy stack in self.noise_im_all
+        Return:
+            coordinate_table : the patch table of the stack (see TRAIN_COLUMNS)
+        """
+        geometry = dict(whole=[self.whole_t, self.whole_y, self.whole_x],
+                        patch=[self.patch_t * 2, self.patch_y, self.patch_x], gap=[self.gap_t, self.gap_y, self.gap_x])
+        if self.cache is not None:
+            key = self.cache.key(im_dir, table='train', select_img_num=self.select_img_num, **geometry)
+            entry = self.cache.get(key)
+            if entry is not None:
+                coordinate_table = np.array(entry[0]['table'])
+                coordinate_table[:, 0] = stack_index
+                return coordinate_table
+        coordinate_table = train_partition(stack_index, self.whole_t, self.whole_y, self.whole_x, self.patch_t * 2,
+                                           self.patch_y, self.patch_x, self.gap_t, self.gap_y, self.gap_x)
+        if self.cache is not None and self.rank == 0:
+            self.cache.put(key, {'table': coordinate_table}, {})
+        return coordinate_table
 
     def save_yaml_train(self):
         """
@@ -225,15 +443,18 @@ class training_class():
         """
         yaml_name = self.pth_path + '//para.yaml'
         para = {'n_epochs': 0, 'datasets_path': 0, 'overlap_factor': 0,
-                'output_dir': 0, 'pth_path': 0, 'GPU': 0, 'batch_size': 0,
+                'output_dir': 0, 'pth_path': 0, 'GPU': 0, 'device': 0, 'precision': 0, 'world_size': 0, 'batch_size': 0,
                 'patch_x': 0, 'patch_y': 0, 'patch_t': 0, 'gap_y': 0, 'gap_x': 0,
-                'gap_t': 0, 'lr': 0, 'b1': 0, 'b2': 0, 'fmap': 0, 'scale_factor': 0,
+                'gap_t': 0, 'lr': 0, 'b1': 0, 'b2': 0, 'fmap': 0, 'num_levels': 0, 'teacher_model': 0, 'scale_factor': 0,
                 'select_img_num': 0, 'train_datasets_size': 0}
         para["n_epochs"] = self.n_epochs
         para["datasets_path"] = self.datasets_path
         para["output_dir"] = self.output_dir
         para["pth_path"] = self.pth_path
         para["GPU"] = self.GPU
+        para["device"] = self.device
+        para["precision"] = self.precision
+        para["world_size"] = self.world_size
         para["batch_size"] = self.batch_size
         para["patch_x"] = self.patch_x
         para["patch_y"] = self.patch_y
@@ -245,6 +466,8 @@ class training_class():
         para["b1"] = self.b1
         para["b2"] = self.b2
         para["fmap"] = self.fmap
+        para["num_levels"] = self.num_levels
+        para["teacher_model"] = self.teacher_model
         para["scale_factor"] = self.scale_factor
         para["select_img_num"] = self.select_img_num
         para["train_datasets_size"] = self.train_datasets_size
@@ -255,14 +478,86 @@ class training_class():
     def distribute_GPU(self):
         """
         Allocate the GPU for the training program. Print the using GPU information to the screen.
-        For acceleration, multiple GPUs parallel training is recommended.
+        For acceleration, multiple GPUs parallel training is recommended. If self.device is 'cpu' (or 'auto' without
+        any CUDA device), the network runs on CPU with self.num_threads intra-op threads. With self.distributed,
+        every process wraps its replica in DistributedDataParallel (gradients are all-reduced during the backward
+        pass), otherwise the GPUs are used through DataParallel.
+
+        Important Fields:
+           self.device : the device the network and the patches are placed on ('cuda' or 'cpu').
 
         """
-        os.environ["CUDA_VISIBLE_DEVICES"] = str(self.GPU)
-        if torch.cuda.is_available():
+        if self.device != 'cpu':
+            os.environ["CUDA_VISIBLE_DEVICES"] = str(self.GPU)
+        self.device = get_device(self.device)
+        if self.batch_size == 'auto':
+            self.batch_size = self.auto_batch_size()
+        if self.compile_mode != 'none':
+            if self.device == 'cuda' and not self.distributed and self.ngpu > 1:
+                # the replicas of DataParallel would all run the compiled network of the first GPU
+                print('\033[1;31mcompile_mode is not supported with DataParallel, running in eager mode \033[0m')
+            else:
+                # the network is compiled before it is wrapped, the state dict keeps the keys of the eager network
+                compile_network(self.local_model, self.compile_mode, self.compile_cache_dir)
+                if self.compile_mode == 'script' and self.checkpoint_levels:
+                    # the traces would drop the activation checkpointing that the batch size was planned with
+                    print('\033[1;31mcompile_mode script does not keep the activation checkpointing, the training steps '
+                          'run in eager mode (validation and testing are traced) \033[0m')
+        if self.teacher is not None and self.device == 'cuda':
+            self.teacher = self.teacher.cuda()
+        if self.device == 'cuda':
             self.local_model = self.local_model.cuda()
-            self.local_model = nn.DataParallel(self.local_model, device_ids=range(self.ngpu))
-            print('\033[1;31mUsing {} GPU(s) for training -----> \033[0m'.format(torch.cuda.device_count()))
+            if self.distributed:
+                self.local_model = nn.parallel.DistributedDataParallel(self.local_model, device_ids=[self.local_rank])
+                print('\033[1;31mUsing {} GPU process(es) for distributed training -----> \033[0m'.format(self.world_size))
+            else:
+                self.local_model = nn.DataParallel(self.local_model, device_ids=range(self.ngpu))
+                print('\033[1;31mUsing {} GPU(s) for training -----> \033[0m'.format(torch.cuda.device_count()))
+        else:
+            # the cores of the node are shared by the training processes running on it
+            num_threads, num_interop_threads = set_cpu_threads(self.num_threads, self.num_interop_threads,
+                                                               self.local_world_size)
+            if self.distributed:
+                self.local_model = nn.parallel.DistributedDataParallel(self.local_model)
+            print('\033[1;31mUsing CPU for training -----> \033[0m', self.world_size, 'process(es),', num_threads,
+                  'intra-op thread(s),', num_interop_threads, 'inter-op thread(s)')
+
+    def auto_batch_size(self):
+        """
+        Resolve batch_size='auto'. On GPU, the largest training batch fitting in the memory of one GPU is probed
+        and multiplied by the number of GPUs (or processes) sharing the batch. Running out of RAM on CPU is not
+        recoverable, so the batch is predicted by the memory model of the planner from the available RAM (shared by
+        the processes of the node) instead.
+        Return:
+           batch_size : the number of patches per training step
+        """
+        if self.device != 'cuda':
+            budget = memory_budget('cpu') // self.local_world_size
+            batch_size = max_batch_size((self.patch_t, self.patch_y, self.patch_x), self.fmap, budget, train=True,
+                                        precision=self.precision, num_levels=self.num_levels, device='cpu',
+                                        checkpoint_levels=self.checkpoint_levels)
+            batch_size = min(max(batch_size, 1), max(1, len(self.coordinate_table) // self.world_size))
+            if self.distributed:
+                # the RAM is read while the other processes are still loading their stacks, every process uses the
+                # smallest batch so that they all run the same number of iterations
+                batch_size = torch.tensor(batch_size)
+                dist.all_reduce(batch_size, op=dist.ReduceOp.MIN)
+                batch_size = int(batch_size.item())
+            print('\033[1;31mBatch size -----> \033[0m', batch_size * self.world_size,
+                  '({} patch(es) per process, {:.1f} GB RAM budget)'.format(batch_size, budget / 1024 ** 3))
+            return batch_size * self.world_size
+        replicas = self.world_size if self.distributed else self.ngpu
+        self.local_model = self.local_model.cuda()
+        batch_size = probe_batch_size(self.local_model, (self.patch_t, self.patch_y, self.patch_x), self.device,
+                                      train=True, precision=self.precision,
+                                      max_batch_size=max(1, len(self.coordinate_table) // replicas))
+        if self.distributed:
+            # every process uses the batch fitting in the smallest GPU
+            batch_size = torch.tensor(batch_size, device=self.device)
+            dist.all_reduce(batch_size, op=dist.ReduceOp.MIN)
+            batch_size = int(batch_size.item())
+        print('\033[1;31mBatch size -----> \033[0m', batch_size * replicas, '({} patch(es) per GPU)'.format(batch_size))
+        return batch_size * replicas
 
     def train(self):
         """
@@ -274,36 +569,87 @@ class training_class():
         Tensor = torch.cuda.FloatTensor if cuda else torch.FloatTensor
         prev_time = time.time()
         time_start = time.time()
-        L1_pixelwise = torch.nn.L1Loss()
-        L2_pixelwise = torch.nn.MSELoss()
-        L2_pixelwise.cuda()
-        L1_pixelwise.cuda()
-
-        for epoch in range(0, self.n_epochs):
-            train_data = trainset(self.name_list, self.coordinate_list, self.noise_im_all, self.stack_index)
-            trainloader = DataLoader(train_data, batch_size=self.batch_size, shuffle=True, num_workers=self.num_workers)
-            for iteration, (input, target) in enumerate(trainloader):
+        # the loss scale of fp16 mixed precision training, saved alongside the checkpoints
+        self.scaler = grad_scaler(self.device, self.precision)
+        # with distributed training, every process takes its share of the patches (and of the batch)
+        batch_size = max(1, self.batch_size // self.world_size)
+        coordinate_table = self.coordinate_table
+        if self.validation_size > 0:
+            if self.validation_size >= len(coordinate_table):
+                raise ValueError('validation_size ({}) must be smaller than the number of patches ({})'.format(
+                    self.validation_size, len(coordinate_table)))
+            # the validation patches are the same in every process and when training is resumed
+            order = np.random.RandomState(0).permutation(len(coordinate_table))
+            valid_table = coordinate_table[order[:self.validation_size]]
+            coordinate_table = coordinate_table[np.sort(order[self.validation_size:])]
+            # every process validates its share of the patches
+            valid_data = trainset(valid_table[self.rank::self.world_size], self.noise_im_all, augment=False)
+            validloader = DataLoader(valid_data, batch_size=batch_size, shuffle=False, num_workers=self.num_workers,
+                                     persistent_workers=self.num_workers > 0, pin_memory=self.device == 'cuda')
+        if self.teacher is not None:
+            # without testing at the end of the epochs, the distillation report is made on the validation patches
+            # (or on the first training patches), denoised by the network and by the teacher
+            report_table = valid_table if self.validation_size > 0 else coordinate_table[:max(16, batch_size)]
+            reportloader = DataLoader(trainset(report_table, self.noise_im_all, augment=False), batch_size=batch_size,
+                                      shuffle=False, num_workers=0, pin_memory=self.device == 'cuda')
+        # the data set and the workers are created once and reused by every epoch
+        train_data = trainset(coordinate_table, self.noise_im_all, augment=not self.device_augmentation)
+        # the patch order only depends on the seed and the epoch, so that it is the same when training is resumed
+        seed = 0 if self.distributed else random.randrange(2 ** 31)
+        sampler = resumable_sampler(train_data, num_replicas=self.world_size, rank=self.rank, shuffle=True, seed=seed)
+        # the seed of the workers is drawn from a generator of the loader, not from the global random numbers
+        generator = torch.Generator()
+        trainloader = DataLoader(train_data, batch_size=batch_size, sampler=sampler, generator=generator,
+                                 num_workers=self.num_workers, persistent_workers=self.num_workers > 0,
+                                 pin_memory=self.device == 'cuda')
+        iterations = math.ceil(sampler.num_samples / batch_size)  # the number of iterations of a whole epoch
+        # the next batch is uploaded while the current one is computed
+        train_batches = device_prefetcher(trainloader, self.device)
+        # the checkpoints are written while the next epoch is trained
+        self.writer = background_writer() if self.async_save else None
+        self.best_loss = None
+        self.best_onnx = None
+        self.best_model = None
+        self.improved = False
+        self.bad_validations = 0
+        self.stop = False
+
+        start_epoch, start_iteration, start_loss = 0, 0, 0
+        if self.resume_state is not None:
+            start_epoch, start_iteration, start_loss, seed = self.load_checkpoint(optimizer_G, iterations)
+            sampler.seed = seed
+
+        for epoch in range(start_epoch, self.n_epochs):
+            sampler.set_epoch(epoch)
+            generator.manual_seed(sampler.seed + epoch)
+            # a resumed epoch starts after the patches which were already trained on
+            first_iteration = start_iteration if epoch == start_epoch else 0
+            sampler.set_start(first_iteration * batch_size)
+            epoch_loss = start_loss if epoch == start_epoch else 0
+            for iteration, (input, target) in enumerate(train_batches, first_iteration):
                 # The input volume and corresponding target volume from data loader to train the deep neural network
-                input = input.cuda()
-                target = target.cuda()
+                if self.device_augmentation:
+                    input, target = random_transform_batch(input, target)
                 real_A = input
                 real_B = target
                 real_A = Variable(real_A)
-                fake_B = self.local_model(real_A)
-                L1_loss = L1_pixelwise(fake_B, real_B)
-                L2_loss = L2_pixelwise(fake_B, real_B)
+                with autocast(self.device, self.precision):
+                    fake_B = self.local_model(real_A)
+                    L1_loss, L2_loss = self.pixelwise_losses(fake_B, real_A, real_B)
+                    # Calculate total loss
+                    Total_loss = 0.5 * L1_loss + 0.5 * L2_loss
                 optimizer_G.zero_grad()
-
-                # Calculate total loss
-                Total_loss = 0.5 * L1_loss + 0.5 * L2_loss
-                Total_loss.backward()
-                optimizer_G.step()
+                self.scaler.scale(Total_loss).backward()
+                self.scaler.step(optimizer_G)
+                self.scaler.update()
                 # Record and estimate the remaining time
-                batches_done = epoch * len(trainloader) + iteration
-                batches_left = self.n_epochs * len(trainloader) - batches_done
+                batches_done = epoch * iterations + iteration
+                batches_left = self.n_epochs * iterations - batches_done
                 time_left = datetime.timedelta(seconds=int(batches_left * (time.time() - prev_time)))
                 prev_time = time.time()
 
+                epoch_loss += Total_loss.item()
+
                 if iteration % 1 == 0:
                     time_end = time.time()
                     print(
@@ -312,7 +658,7 @@ class training_class():
                             epoch + 1,
                             self.n_epochs,
                             iteration + 1,
-                            len(trainloader),
+                            iterations,
                             Total_loss.item(),
                             L1_loss.item(),
                             L2_loss.item(),
@@ -322,17 +668,55 @@ class training_class():
 
 
 
-                if (iteration + 1) % (len(trainloader)) == 0:
+                if self.validation_size > 0:
+                    if self.validation_interval > 0:
+                        validate = (epoch * iterations + iteration + 1) % self.validation_interval == 0
+                    else:
+                        validate = iteration + 1 == iterations
+                    if validate:
+                        self.validate(validloader, epoch, iteration)
+                        if self.improved and iteration + 1 < iterations and not self.stop and self.rank == 0:
+                            # the best model so far, the model is saved at the end of the epoch anyway
+                            self.epoch_loss = epoch_loss / (iteration + 1)
+                            self.save_model(epoch, iteration, end_of_epoch=False)
+
+                if self.checkpoint_interval > 0 and (iteration + 1) % self.checkpoint_interval == 0 \
+                        and iteration + 1 < iterations and not self.stop:
+                    self.save_checkpoint(epoch, iteration, optimizer_G, sampler.seed, epoch_loss)
+
+                if iteration + 1 == iterations or self.stop:
                     print('\n', end=' ')
-                    # Save model at the end of every epoch
-                    self.save_model(epoch, iteration)
-                    # Start inference using the denoise model at the end of every epoch (optional)
-                    if (self.visualize_images_per_epoch | self.save_test_images_per_epoch):
-                        print('Testing model of epoch {} on the first noisy file ----->'.format(epoch + 1))
-                        self.test(epoch, iteration)
-                        print('\n', end=' ')
+                    if self.rank == 0:
+                        # Save model at the end of every epoch
+                        self.epoch_loss = epoch_loss / (iteration + 1)
+                        self.save_model(epoch, iteration)
+                        # Start inference using the denoise model at the end of every epoch (optional)
+                        if (self.visualize_images_per_epoch | self.save_test_images_per_epoch):
+                            print('Testing model of epoch {} on the first noisy file ----->'.format(epoch + 1))
+                            self.test(epoch, iteration)
+                            print('\n', end=' ')
+                        elif self.teacher is not None:
+                            self.distill_patches(reportloader, epoch)
+                    self.save_checkpoint(epoch, iteration, optimizer_G, sampler.seed, epoch_loss,
+                                         finished=epoch == self.n_epochs - 1 or self.stop)
+                    if self.distributed:
+                        # the other processes wait until rank 0 has saved and tested this epoch
+                        dist.barrier()
+                    if self.stop:
+                        break
+            if self.stop:
+                print('Early stopping: no improvement of the validation loss in the last {} validations'.format(
+                    self.early_stopping))
+                break
+        if self.writer is not None:
+            self.writer.flush()
         print('Train finished. Save all models to disk.')
-        if self.colab_display:
+        if self.best_model is not None:
+            print('Best model -----> ', self.best_model, '(validation loss: %.4f)' % self.best_loss
+                  if self.validation_size > 0 else '(training loss: %.4f)' % self.best_loss)
+        if isinstance(self.noise_im_all, stack_store):
+            self.noise_im_all.close()
+        if self.colab_display and self.rank == 0:
             result_img_list = []
             results_path = self.pth_path
             results_list = list(os.walk(results_path, topdown=False))[-1][-1]
@@ -344,28 +728,232 @@ class training_class():
             self.result_display = results_path+'/'+result_img_list[-1]
 
 
-    def save_model(self, epoch, iteration):
+    def save_model(self, epoch, iteration, end_of_epoch=True):
         """
-        Model storage.
+        Model storage. The weights are copied to the host and the copy is written by the background writer if
+        self.async_save is set, so that training goes on while the files are written. The written model is then
+        exported to ONNX (according to self.onnx_export) in a separate process started by the writer (see
+        export_model), the exporter of pytorch is not thread-safe.
         Args:
            train_epoch : current train epoch number
            train_iteration : current train_iteration number
+           end_of_epoch : False for the best model so far saved in the middle of an epoch, which is exported to
+                          ONNX with self.onnx_export == 'best' only
         """
         model_save_name = self.pth_path + '//E_' + str(epoch + 1).zfill(2) + '_Iter_' + str(iteration + 1).zfill(
             4) + '.pth'
-        if isinstance(self.local_model, nn.DataParallel):
-            torch.save(self.local_model.module.state_dict(), model_save_name)  # parallel
+        if isinstance(self.local_model, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
+            model = self.local_model.module  # parallel
         else:
-            torch.save(self.local_model.state_dict(), model_save_name)  # not parallel
+            model = self.local_model  # not parallel
+        state_dict = {key: value.detach().to('cpu', copy=True) for key, value in model.state_dict().items()}
+        scaler_state = self.scaler.state_dict() if self.scaler.is_enabled() else None
         # covert pth to onnx
-        onnx_save_name = self.onnx_path + '//E_' + str(epoch + 1).zfill(2) + '_Iter_' + str(iteration + 1).zfill(
-            4) + '_Patch_'+ str(self.patch_x) + '_' + str(self.patch_y) + '_' + str(self.patch_t) + '.onnx'
-        input_name = ['input']
-        output_name = ['output']
+        onnx_save_name = None
+        if self.validation_size > 0:
+            # the best model is the one with the lowest validation loss (see validate)
+            best, self.improved = self.improved, False
+        else:
+            best = self.best_loss is None or self.epoch_loss < self.best_loss
+            if best:
+                self.best_loss = self.epoch_loss
+        if best:
+            self.best_model = os.path.basename(model_save_name)
+        if (self.onnx_export == 'epoch' and end_of_epoch) or (self.onnx_export == 'best' and best) or \
+                (self.onnx_export == 'final' and end_of_epoch and (epoch == self.n_epochs - 1 or self.stop)):
+            onnx_save_name = self.onnx_path + '//E_' + str(epoch + 1).zfill(2) + '_Iter_' + str(iteration + 1).zfill(
+                4) + '_Patch_'+ str(self.patch_x) + '_' + str(self.patch_y) + '_' + str(self.patch_t) + '.onnx'
+        if self.writer is not None:
+            self.writer.submit(self.write_model, state_dict, scaler_state, model_save_name)
+        else:
+            self.write_model(state_dict, scaler_state, model_save_name)
+        if onnx_save_name is not None:
+            # with self.onnx_export == 'best', the ONNX model of the previous best epoch is replaced
+            previous_onnx = self.best_onnx if self.onnx_export == 'best' else None
+            if self.writer is not None:
+                self.writer.submit(self.export_model, model_save_name, onnx_save_name, previous_onnx)
+            else:
+                self.export_model(model_save_name, onnx_save_name, previous_onnx)
+            if self.onnx_export == 'best':
+                self.best_onnx = onnx_save_name
 
-        input = torch.randn(1, 1, self.patch_t, self.patch_x,  self.patch_y, requires_grad=True).cuda()
-        torch.onnx.export(self.local_model.module, input, onnx_save_name, export_params=True,input_names=input_name, output_names=output_name,opset_version=11, verbose=False)
+    def write_model(self, state_dict, scaler_state, model_save_name):
+        """
+        Write a checkpoint.
+        Args:
+           state_dict : the weights of the network (on the host)
+           scaler_state : the state of the gradient scaler, or None if it is not enabled
+           model_save_name : the file name of the checkpoint
+        """
+        torch.save(state_dict, model_save_name)
+        if scaler_state is not None:
+            torch.save(scaler_state, model_save_name.replace('.pth', '_scaler.pt'))
+
+    def export_model(self, model_save_name, onnx_save_name, previous_onnx=None):
+        """
+        Export a written model to ONNX (see export_onnx). With the background writer, the export runs in a child
+        python process, so that neither the training loop nor its threads run the exporter. The failure of an
+        export is reported, it does not stop the training.
+        Args:
+           model_save_name : the .pth file of the model
+           onnx_save_name : the file name of the ONNX model
+           previous_onnx : the file name of an ONNX model removed after the export, or None
+        """
+        arguments = {'model_name': model_save_name, 'onnx_save_name': onnx_save_name, 'fmap': self.fmap,
+                     'num_levels': self.num_levels, 'patch_shape': [self.patch_t, self.patch_y, self.patch_x],
+                     'previous_onnx': previous_onnx}
+        if self.writer is None:
+            export_onnx(**arguments)
+            return
+        # the child imports this package from the same folder as the training process
+        env = dict(os.environ)
+        package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env['PYTHONPATH'] = os.pathsep.join([package_root] + ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+        command = 'import sys, json; from deepcad.train_collection import export_onnx; export_onnx(**json.loads(sys.argv[1]))'
+        result = subprocess.run([sys.executable, '-c', command, json.dumps(arguments)], env=env,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+        if result.returncode != 0:
+            print('\033[1;31mONNX export of {} failed \033[0m\n{}'.format(os.path.basename(model_save_name),
+                                                                      result.stderr[-2000:]))
+
+    def pixelwise_losses(self, output, input, target):
+        """
+        The L1 and L2 losses of the network output. Without a teacher model, the target is the next frames of the
+        input (self-supervised). With a teacher model, the output is compared with the output of the teacher on
+        the same input as well, weighted by self.distillation_weight.
+        Args:
+           output : the output of the network
+           input : the input of the network
+           target : the self-supervised target of the input
+        Return:
+           L1_loss, L2_loss : the losses
+        """
+        L1_loss = torch.nn.functional.l1_loss(output, target)
+        L2_loss = torch.nn.functional.mse_loss(output, target)
+        if self.teacher is None:
+            return L1_loss, L2_loss
+        with torch.no_grad():
+            teacher_output = self.teacher(input).to(output.dtype)
+        weight = self.distillation_weight
+        L1_loss = weight * torch.nn.functional.l1_loss(output, teacher_output) + (1 - weight) * L1_loss
+        L2_loss = weight * torch.nn.functional.mse_loss(output, teacher_output) + (1 - weight) * L2_loss
+        return L1_loss, L2_loss
+
+    def validate(self, validloader, epoch, iteration):
+        """
+        Compute the training loss (see pixelwise_losses, without augmentation) of the network on the patches
+        held out of training. The validation loss selects the best model and stops the training when it has not
+        improved for self.early_stopping validations. With distributed training, every process validates its share
+        of the patches and the losses are summed over the processes.
+        Args:
+           validloader : the DataLoader of the validation patches
+           epoch : current train epoch number
+           iteration : current train_iteration number
+        Important Fields:
+           self.improved : whether the validation loss is the lowest so far
+           self.stop : whether the training stops early
+        """
+        if isinstance(self.local_model, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
+            model = self.local_model.module  # parallel
+        else:
+            model = self.local_model  # not parallel
+        valid_loss = torch.zeros(2, dtype=torch.float64, device=self.device)  # the sum of the losses, the patch number
+        with torch.no_grad():
+            for input, target in device_prefetcher(validloader, self.device):
+                with autocast(self.device, self.precision):
+                    output = model(input).float()
+                    L1_loss, L2_loss = self.pixelwise_losses(output, input, target)
+                loss = 0.5 * L1_loss + 0.5 * L2_loss
+                valid_loss[0] += loss * len(input)
+                valid_loss[1] += len(input)
+        if self.distributed:
+            dist.all_reduce(valid_loss)
+        valid_loss = (valid_loss[0] / valid_loss[1]).item()
+        self.improved = self.best_loss is None or valid_loss < self.best_loss
+        if self.improved:
+            self.best_loss = valid_loss
+            self.bad_validations = 0
+        else:
+            self.bad_validations = self.bad_validations + 1
+        self.stop = self.early_stopping > 0 and self.bad_validations >= self.early_stopping
+        print('\n[Epoch %d/%d] [Batch %d] [Validation loss: %.4f, best: %.4f]' % (
+            epoch + 1, self.n_epochs, iteration + 1, valid_loss, self.best_loss), end=' ')
+
+    def save_checkpoint(self, epoch, iteration, optimizer, seed, epoch_loss, finished=False):
+        """
+        Save a training checkpoint (self.pth_path//CHECKPOINT_NAME, replaced by every checkpoint) from which an
+        interrupted training can be resumed: the weights, the states of the optimizer and of the gradient scaler,
+        the position in the training (epoch, iteration and the seed of the patch order) and the states of the
+        random number generators of every process. With distributed training, it is called by every process.
+        Args:
+           epoch : current train epoch number
+           iteration : the last iteration done in the epoch
+           optimizer : the optimizer of the network
+           seed : the seed of the patch order (see resumable_sampler)
+           epoch_loss : the sum of the losses of the epoch so far
+           finished : whether it is the end of the last epoch
+        """
+        rng_states = [get_rng_state()]
+        if self.distributed:
+            rng_states = [None] * self.world_size
+            dist.all_gather_object(rng_states, get_rng_state())
+        if self.rank != 0:
+            return
+        if isinstance(self.local_model, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
+            model = self.local_model.module  # parallel
+        else:
+            model = self.local_model  # not parallel
+        state = {'epoch': epoch, 'iteration': iteration, 'seed': seed, 'epoch_loss': epoch_loss, 'finished': finished,
+                 'model': model.state_dict(), 'optimizer': optimizer.state_dict(), 'scaler': self.scaler.state_dict(),
+                 'rng': rng_states, 'best_loss': self.best_loss, 'best_onnx': self.best_onnx,
+                 'best_model': self.best_model, 'bad_validations': self.bad_validations,
+                 'pth_path': self.pth_path, 'onnx_path': self.onnx_path}
+        state = to_host(state)
+        if self.writer is not None:
+            self.writer.submit(self.write_checkpoint, state)
+        else:
+            self.write_checkpoint(state)
+
+    def write_checkpoint(self, state):
+        """
+        Write a training checkpoint. The previous one is replaced once the new one is complete, so that an
+        interruption while writing leaves the previous checkpoint intact.
+        """
+        checkpoint_name = self.pth_path + '//' + CHECKPOINT_NAME
+        torch.save(state, checkpoint_name + '.tmp')
+        os.replace(checkpoint_name + '.tmp', checkpoint_name)
 
+    def load_checkpoint(self, optimizer, iterations):
+        """
+        Restore the state of the training from self.resume_state.
+        Args:
+           optimizer : the optimizer of the network
+           iterations : the number of iterations of an epoch
+        Return:
+           start_epoch, start_iteration : the position the training is resumed from
+           start_loss : the sum of the losses of the resumed epoch so far
+           seed : the seed of the patch order
+        """
+        state = self.resume_state
+        if isinstance(self.local_model, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
+            model = self.local_model.module  # parallel
+        else:
+            model = self.local_model  # not parallel
+        model.load_state_dict(state['model'])
+        optimizer.load_state_dict(state['optimizer'])
+        if state['scaler']:
+            self.scaler.load_state_dict(state['scaler'])
+        self.best_loss = state['best_loss']
+        self.best_onnx = state['best_onnx']
+        self.best_model = state['best_model']
+        self.bad_validations = state['bad_validations']
+        # every process continues with its own random number generators (those of rank 0 if there are more processes)
+        set_rng_state(state['rng'][self.rank if self.rank < len(state['rng']) else 0])
+        start_epoch, start_iteration, start_loss = state['epoch'], state['iteration'] + 1, state['epoch_loss']
+        if start_iteration >= iterations:
+            start_epoch, start_iteration, start_loss = start_epoch + 1, 0, 0
+        print('Resume training at epoch {}, iteration {}'.format(start_epoch + 1, start_iteration + 1))
+        return start_epoch, start_iteration, start_loss, state['seed']
 
     def test(self, train_epoch, train_iteration):
         """
@@ -374,22 +962,47 @@ class training_class():
             train_epoch : current train epoch number
             train_iteration : current train_iteration number
         """
+        # Only rank 0 tests, the replica is used without the DistributedDataParallel wrapper
+        if isinstance(self.local_model, nn.parallel.DistributedDataParallel):
+            model = self.local_model.module
+        else:
+            model = self.local_model
         # Crop test file into 3D patches for inference
         self.print_img_name = True
-        name_list, noise_img, coordinate_list, test_im_name, img_mean, input_data_type = test_preprocess_chooseOne(self, img_id=0)
+        coordinate_table, noise_img, test_im_name, img_mean, input_data_type = test_preprocess_chooseOne(self, img_id=0)
         # Record the inference time
         prev_time = time.time()
         time_start = time.time()
         denoise_img = np.zeros(noise_img.shape)
-        input_img = np.zeros(noise_img.shape)
-        test_data = testset(name_list, coordinate_list, noise_img)
-        testloader = DataLoader(test_data, batch_size=self.batch_size, shuffle=False, num_workers=self.num_workers)
-        for iteration, (noise_patch, single_coordinate) in enumerate(testloader):
+        # the teacher denoises the stack as well for the distillation report, the networks are timed
+        teacher_img = np.zeros(noise_img.shape) if self.teacher is not None else None
+        teacher_stitcher = batch_stitcher(teacher_img, img_mean) if self.teacher is not None else None
+        model_time = [0, 0]
+        if self.num_workers > 0:
+            # the workers read the patches from the shared store instead of receiving a copy of the stack
+            test_store = stack_store(self.store_backend)
+            test_data = testset(coordinate_table, test_store, test_store.append(noise_img))
+            del noise_img
+        else:
+            test_data = testset(coordinate_table, noise_img)
+        testloader = DataLoader(test_data, batch_size=self.batch_size, shuffle=False, num_workers=self.num_workers,
+                                pin_memory=self.device == 'cuda')
+        stitcher = batch_stitcher(denoise_img, img_mean)
+        for iteration, (noise_patch, single_coordinate) in enumerate(device_prefetcher(testloader, self.device)):
             # Pre-trained models are loaded into memory and the sub-stacks are directly fed into the model.
-            noise_patch = noise_patch.cuda()
             real_A = noise_patch
             real_A = Variable(real_A)
-            fake_B = self.local_model(real_A)
+            for k, network in enumerate([model, self.teacher] if self.teacher is not None else [model]):
+                network_start = time.time()
+                with torch.no_grad():
+                    output = network(real_A)
+                if self.device == 'cuda':
+                    torch.cuda.synchronize()
+                model_time[k] += time.time() - network_start
+                if k == 0:
+                    fake_B = output
+                else:
+                    teacher_stitcher.submit(output, real_A, single_coordinate)
 
             # Determine approximate time left
             batches_done = iteration
@@ -412,42 +1025,20 @@ class training_class():
             if (iteration + 1) % len(testloader) == 0:
                 print('\n', end=' ')
 
-            # Enhanced sub-stacks are sequentially output from the network
-            output_image = np.squeeze(fake_B.cpu().detach().numpy())
-            raw_image = np.squeeze(real_A.cpu().detach().numpy())
-            if (output_image.ndim == 3):
-                postprocess_turn = 1
-            else:
-                postprocess_turn = output_image.shape[0]
-
             # The final enhanced stack can be obtained by stitching all sub-stacks.
-            if (postprocess_turn > 1):
-                for id in range(postprocess_turn):
-                    output_patch, raw_patch, stack_start_w, stack_end_w, stack_start_h, stack_end_h, stack_start_s, stack_end_s = multibatch_test_save(
-                        single_coordinate, id, output_image, raw_image)
-
-                    output_patch=output_patch+img_mean
-                    raw_patch=raw_patch+img_mean
-
-                    denoise_img[stack_start_s:stack_end_s, stack_start_h:stack_end_h, stack_start_w:stack_end_w] \
-                        = output_patch * (np.sum(raw_patch) / np.sum(output_patch)) ** 0.5
-                    input_img[stack_start_s:stack_end_s, stack_start_h:stack_end_h, stack_start_w:stack_end_w] \
-                        = raw_patch
-            else:
-                output_patch, raw_patch, stack_start_w, stack_end_w, stack_start_h, stack_end_h, stack_start_s, stack_end_s = singlebatch_test_save(
-                    single_coordinate, output_image, raw_image)
-
-                output_patch=output_patch+img_mean
-                raw_patch=raw_patch+img_mean
-
-                denoise_img[stack_start_s:stack_end_s, stack_start_h:stack_end_h, stack_start_w:stack_end_w] \
-                    = output_patch * (np.sum(raw_patch) / np.sum(output_patch)) ** 0.5
-                input_img[stack_start_s:stack_end_s, stack_start_h:stack_end_h, stack_start_w:stack_end_w] \
-                    = raw_patch
+            stitcher.submit(fake_B, real_A, single_coordinate)
+        stitcher.flush()
+        if self.num_workers > 0:
+            test_store.close()
 
         # Stitching finish
         output_img = denoise_img.squeeze().astype(np.float32) * self.scale_factor
         del denoise_img
+        if self.teacher is not None:
+            teacher_stitcher.flush()
+            self.distillation_report(output_img, teacher_img.squeeze().astype(np.float32) * self.scale_factor,
+                                     model_time, train_epoch)
+            del teacher_img
 
         # Normalize and display inference image
         if (self.visualize_images_per_epoch):
@@ -473,3 +1064,66 @@ class training_class():
             result_name = self.pth_path + '//' + test_im_name.replace('.tif', '') + '_' + 'E_' + str(
                 train_epoch + 1).zfill(2) + '_Iter_' + str(train_iteration + 1).zfill(4) + '.tif'
             io.imsave(result_name, output_img, check_contrast=False)
+
+    def distill_patches(self, loader, train_epoch):
+        """
+        The distillation report on patches, when the test stack is not denoised at the end of the epoch: the
+        patches are denoised by the network and by the teacher, the frames of the patches are compared.
+        Args:
+            loader : the DataLoader of the patches (the validation patches or the first training patches)
+            train_epoch : current train epoch number
+        """
+        if isinstance(self.local_model, nn.parallel.DistributedDataParallel):
+            model = self.local_model.module
+        else:
+            model = self.local_model
+        outputs = [[], []]
+        model_time = [0, 0]
+        for input, _ in device_prefetcher(loader, self.device):
+            for k, network in enumerate([model, self.teacher]):
+                network_start = time.time()
+                with torch.no_grad():
+                    output = network(input)
+                if self.device == 'cuda':
+                    torch.cuda.synchronize()
+                model_time[k] += time.time() - network_start
+                outputs[k].append(output.float().cpu().numpy().reshape(-1, *output.shape[-2:]))
+        output_img, teacher_img = (np.concatenate(output, axis=0) for output in outputs)
+        self.distillation_report(output_img, teacher_img, model_time, train_epoch,
+                                 count=len(loader.dataset), unit='patches')
+
+    def distillation_report(self, output_img, teacher_img, model_time, train_epoch, count=None, unit='frames'):
+        """
+        Print the throughput of the network and of the teacher on the test stack (the frames denoised per second,
+        to be compared with the frame rate of the acquisition) and the fidelity of the network to the teacher
+        (the PSNR and the SSIM of the denoised stack against the stack denoised by the teacher).
+        Args:
+            output_img : the test stack denoised by the network
+            teacher_img : the test stack denoised by the teacher
+            model_time : the time spent in the network and in the teacher
+            train_epoch : current train epoch number
+            count : the number of units denoised in model_time (the frames of the stack by default)
+            unit : the unit of the throughput, 'frames' of the test stack or 'patches' (see distill_patches)
+        """
+        psnr, ssim = drift_report(teacher_img, output_img)
+        if count is None:
+            count = output_img.shape[0]
+        print('\033[1;31mDistillation report of epoch {} -----> \033[0m'.format(train_epoch + 1))
+        print('network (fmap %d, %d levels): %.1f %s/s, teacher (fmap %d, %d levels): %.1f %s/s, '
+              'speedup: %.2fx, PSNR: %.2f dB, SSIM: %.4f against the teacher'
+              % (self.fmap, self.num_levels, count / max(model_time[0], 1e-9), unit, self.teacher_fmap,
+                 self.teacher_levels, count / max(model_time[1], 1e-9), unit,
+                 model_time[1] / max(model_time[0], 1e-9), psnr, ssim))
+
+
+def distributed_worker(local_rank, trainer, world_size):
+    """
+    Entry of the training processes started by training_class.spawn_workers (single node).
+    Args:
+        local_rank : the index of the process, given by torch.multiprocessing.spawn
+        trainer : the training_class object
+        world_size : the number of training processes
+    """
+    os.environ['RANK'] = os.environ['LOCAL_RANK'] = str(local_rank)
+    os.environ['WORLD_SIZE'] = os.environ['LOCAL_WORLD_SIZE'] = str(world_size)
+    trainer.run()
@@ -1,5 +1,12 @@
 import os
+import socket
+import contextlib
+import queue
+import random
+import threading
 
+import numpy as np
+import torch
 import matplotlib.pyplot as plt
 import yaml
 import gdown
@@ -14,6 +21,323 @@ def create_feature_maps(init_channel_number, number_of_fmaps):
     return [init_channel_number * 2 ** k for k in range(number_of_fmaps)]
 
 
+def get_device(device):
+    """
+    Resolve the device option of the training/testing class.
+    Args:
+         device : 'auto' (use CUDA if available, otherwise CPU), 'cuda' or 'cpu'
+    Return:
+         device : 'cuda' or 'cpu'
+    """
+    if device == 'auto':
+        return 'cuda' if torch.cuda.is_available() else 'cpu'
+    if device == 'cuda' and not torch.cuda.is_available():
+        raise RuntimeError('device is set to cuda but no CUDA device is available, set device to cpu or auto')
+    return device
+
+
+def set_cpu_threads(num_threads=0, num_interop_threads=0, num_processes=1):
+    """
+    Set the number of threads used by pytorch on CPU.
+    By default the intra-op thread number is the number of cores this process is allowed to run on, so jobs bound
+    to a NUMA node or a SLURM cpuset (e.g. numactl --cpunodebind, --cpus-per-task) do not oversubscribe the cores
+    of the node. The network is a single chain of operators, so one inter-op thread is used by default.
+    Args:
+         num_threads : the number of intra-op threads (0 for the number of available cores)
+         num_interop_threads : the number of inter-op threads (0 for one thread)
+         num_processes : the number of processes sharing the available cores (distributed training on one node),
+                         the default intra-op thread number is divided between them
+    Return:
+         num_threads, num_interop_threads : the thread numbers in use
+    """
+    if num_threads <= 0:
+        if hasattr(os, 'sched_getaffinity'):
+            num_threads = len(os.sched_getaffinity(0))
+        else:
+            num_threads = os.cpu_count()
+        num_threads = max(1, num_threads // num_processes)
+    if num_interop_threads <= 0:
+        num_interop_threads = 1
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(num_interop_threads)
+    except RuntimeError:
+        # the inter-op thread number can only be set once, before any inter-op parallel work has started
+        pass
+    return torch.get_num_threads(), torch.get_num_interop_threads()
+
+
+def find_free_port():
+    """
+    Ask the OS for a free TCP port, used for the rendezvous of the distributed training processes on one node.
+    """
+    with contextlib.closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as s:
+        s.bind(('', 0))
+        return s.getsockname()[1]
+
+
+PRECISION_DTYPES = {'fp32': torch.float32, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+
+def autocast(device, precision):
+    """
+    Create the automatic mixed precision context for the forward pass and the loss.
+    Args:
+         device : 'cuda' or 'cpu'
+         precision : 'fp32' (no autocast), 'fp16' or 'bf16'
+    Return:
+         the autocast context manager
+    """
+    if precision not in PRECISION_DTYPES:
+        raise ValueError("precision must be one of 'fp32', 'fp16' and 'bf16', got '{}'".format(precision))
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+    if hasattr(torch, 'autocast'):
+        return torch.autocast(device_type=device, dtype=PRECISION_DTYPES[precision])
+    # pytorch < 1.10 only provides fp16 autocast on CUDA
+    if device != 'cuda' or precision != 'fp16':
+        raise RuntimeError('{} autocast on {} requires pytorch >= 1.10'.format(precision, device))
+    return torch.cuda.amp.autocast()
+
+
+def grad_scaler(device, precision):
+    """
+    Create the gradient scaler for mixed precision training. Loss scaling is only needed (and only enabled)
+    for fp16, bf16 has the same exponent range as fp32.
+    """
+    enabled = precision == 'fp16'
+    if hasattr(torch, 'amp') and hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler(device, enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled and device == 'cuda')
+
+
+def probe_batch_size(model, patch_shape, device, train=True, precision='fp32', max_batch_size=64):
+    """
+    Find the largest batch of patches which fits in GPU memory by doubling the batch size until CUDA runs out of
+    memory. A training step (forward, loss and backward) is probed for training and a forward pass without
+    gradients for inference, in which case the patches are cast to the dtype of the network.
+    Args:
+         model : the network (not wrapped in DataParallel), already on the device
+         patch_shape : the shape of a patch (t, y, x)
+         device : 'cuda' or 'cpu'
+         train : probe a training step (True) or an inference step (False)
+         precision : the autocast precision of the training step
+         max_batch_size : the largest batch size tried
+    Return:
+         batch_size : the largest power of 2 batch size which fits (at least 1)
+    """
+    dtype = next(model.parameters()).dtype
+    batch_size = 1
+    while batch_size * 2 <= max_batch_size:
+        try:
+            _probe_step(model, (batch_size * 2, 1) + tuple(patch_shape), device, train, precision, dtype)
+        except RuntimeError as e:
+            if 'out of memory' not in str(e):
+                raise
+            break
+        finally:
+            model.zero_grad()
+            if device == 'cuda':
+                torch.cuda.empty_cache()
+        batch_size = batch_size * 2
+    return batch_size
+
+
+def _probe_step(model, input_shape, device, train, precision, dtype):
+    if train:
+        input = torch.randn(input_shape, device=device)
+        with autocast(device, precision):
+            output = model(input)
+            loss = torch.nn.functional.mse_loss(output, input)
+        loss.backward()
+    else:
+        input = torch.randn(input_shape, device=device, dtype=dtype)
+        with torch.no_grad():
+            model(input)
+    if device == 'cuda':
+        torch.cuda.synchronize()
+
+
+COMPILE_MODES = ('none', 'compile', 'script')
+
+
+def compile_network(model, mode='none', cache_dir=''):
+    """
+    Switch a network to compiled execution, in place, so that the parameters and the keys of the state dict do not
+    change (the model files are the same as in eager mode). The graph of the network is captured once per patch
+    shape, the first batch of every new shape waits for the compilation.
+    'compile' uses torch.compile (pytorch >= 2.0) with static shapes. Its inductor backend generates fused
+    kernels on CUDA and on CPU (the ReLU is fused into the convolution epilogue, the nearest upsampling into the
+    concatenation of the decoders) and the compiled kernels are kept in cache_dir, so that later runs skip most
+    of the warm-up. 'script' traces the network with TorchScript (any pytorch version) and runs the traced graph,
+    whose elementwise operations are fused by the TorchScript fuser, the traces are not kept on disk.
+    Args:
+         model : the network (not wrapped in DataParallel), on its device
+         mode : 'none' (eager), 'compile' or 'script'
+         cache_dir : the folder of the compiled kernels of 'compile' ('' for the default folder of pytorch)
+    Return:
+         model : the network
+    """
+    if mode not in COMPILE_MODES:
+        raise ValueError("compile_mode must be one of 'none', 'compile' and 'script', got '{}'".format(mode))
+    if mode == 'compile':
+        if not hasattr(torch, 'compile'):
+            raise RuntimeError("compile_mode 'compile' requires pytorch >= 2.0, use 'script' instead")
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            os.environ['TORCHINDUCTOR_CACHE_DIR'] = os.path.abspath(cache_dir)
+            os.environ['TRITON_CACHE_DIR'] = os.path.abspath(os.path.join(cache_dir, 'triton'))
+        import torch._inductor.config as inductor_config
+        if hasattr(inductor_config, 'fx_graph_cache'):
+            inductor_config.fx_graph_cache = True  # reuse the compiled graphs of the previous runs
+        if hasattr(model, 'compile'):
+            model.compile(dynamic=False)
+        else:
+            # pytorch < 2.2, the bound forward is compiled instead of the module call
+            model.forward = torch.compile(model.forward, dynamic=False)
+    elif mode == 'script':
+        model.forward = traced_forward(model)
+    return model
+
+
+def autocast_state(device_type):
+    """
+    Whether autocast is enabled for a device type ('cuda' or 'cpu') and the dtype it casts to.
+    """
+    if hasattr(torch, 'get_autocast_dtype'):
+        # pytorch >= 2.4
+        return torch.is_autocast_enabled(device_type), torch.get_autocast_dtype(device_type)
+    if device_type == 'cuda':
+        return torch.is_autocast_enabled(), getattr(torch, 'get_autocast_gpu_dtype', lambda: torch.float16)()
+    if hasattr(torch, 'is_autocast_cpu_enabled'):
+        return torch.is_autocast_cpu_enabled(), torch.get_autocast_cpu_dtype()
+    return False, None
+
+
+class traced_forward():
+    """
+    The forward pass of a network run through TorchScript traces, one per input shape, dtype and device, per
+    training/evaluation mode and per autocast state. The traces share the parameters of the network, so they follow
+    the training steps and the weights loaded in the network.
+    A trace only records the operations of the network, not the activation checkpointing of its modules (see
+    checkpoint_forward), so a network with checkpointed modules runs in eager mode while gradients are computed.
+    """
+
+    def __init__(self, model, checkpointed=None):
+        self.model = model
+        self.traces = {}
+        if checkpointed is None:
+            checkpointed = any(getattr(module, 'checkpoint', False) is True for module in model.modules())
+        self.checkpointed = checkpointed
+
+    def __call__(self, x):
+        if self.checkpointed and torch.is_grad_enabled():
+            return type(self.model).forward(self.model, x)
+        key = (tuple(x.shape), x.dtype, x.device, self.model.training, next(self.model.parameters()).dtype,
+               autocast_state(x.device.type))
+        trace = self.traces.get(key)
+        if trace is None:
+            # trace the forward of the class, not this instance attribute
+            del self.model.forward
+            try:
+                with torch.no_grad():
+                    trace = torch.jit.trace(self.model, x, check_trace=False)
+            finally:
+                self.model.forward = self
+            self.traces[key] = trace
+        return trace(x)
+
+    def __deepcopy__(self, memo):
+        # a copy of the network (see testing_class.test) gets its own traces
+        model = memo.get(id(self.model))
+        # the copy of the network is not filled in yet, its modules are those of this network
+        return traced_forward(model, self.checkpointed) if model is not None else self
+
+
+def to_host(state):
+    """
+    Copy the tensors of a (nested) state dict to the host, so that the copy can be written while training goes on.
+    """
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {key: to_host(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(to_host(value) for value in state)
+    return state
+
+
+def get_rng_state():
+    """
+    The states of the random number generators of python, numpy and pytorch (CPU and CUDA). The states are stored
+    as tensors and plain python types, so that they can be loaded by torch.load with weights_only.
+    """
+    python_state = random.getstate()
+    numpy_state = np.random.get_state()
+    state = {'python': [python_state[0], torch.tensor(python_state[1], dtype=torch.int64), python_state[2]],
+             'numpy': [numpy_state[0], torch.from_numpy(numpy_state[1].astype(np.int64))] + list(numpy_state[2:]),
+             'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    """
+    Restore the states of the random number generators saved by get_rng_state.
+    """
+    python_state = state['python']
+    random.setstate((python_state[0], tuple(python_state[1].tolist()), python_state[2]))
+    numpy_state = state['numpy']
+    np.random.set_state((numpy_state[0], numpy_state[1].numpy().astype(np.uint32)) + tuple(numpy_state[2:]))
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available() and len(state['cuda']) == torch.cuda.device_count():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class background_writer():
+    """
+    Run jobs (saving checkpoints, exporting models) one after another in a background thread, so that the training
+    loop does not wait for them. An exception raised by a job is raised again by the next call to submit or flush.
+    Args:
+        max_pending : the number of jobs waiting in the queue, submit blocks beyond it (which bounds the memory
+                      held by the snapshots handed to the jobs)
+    """
+
+    def __init__(self, max_pending=2):
+        self.jobs = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, job, *args):
+        self._raise()
+        self.jobs.put((job, args))
+
+    def flush(self):
+        """
+        Wait until all the submitted jobs are done.
+        """
+        self.jobs.join()
+        self._raise()
+
+    def _run(self):
+        while True:
+            job, args = self.jobs.get()
+            try:
+                if self.error is None:
+                    job(*args)
+            except BaseException as error:
+                self.error = error
+            finally:
+                self.jobs.task_done()
+
+    def _raise(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
 def save_yaml_train(opt, yaml_name):
     para = {'n_epochs': 0,
             'datasets_folder': 0,
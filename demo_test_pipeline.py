@@ -38,12 +38,24 @@ test_dict = {
     'scale_factor': 1,                   # the factor for image intensity scaling
     'test_datasize': test_datasize,
     'datasets_path': datasets_path,
+    'streaming': False,                  # denoise the stacks slab by slab to bound the memory usage (for long recordings)
+    'sweep': False,                      # read every stack once and denoise it with all the models in the model folder
+    'prefetch_stacks': 0,                # read the next stacks in the background and mix their patches in the batches (many short recordings)
+    'cache_dir': '',                     # folder caching the preprocessed stacks between runs ('' to disable)
+    'precision': 'fp32',                 # 'fp32', or 'fp16'/'bf16' for faster inference with a small deviation
+    'compile_mode': 'none',              # 'compile' (torch.compile) or 'script' (TorchScript) for a compiled network, 'none' for eager
+    'quantize': False,                   # int8 network for CPU inference, calibrated on the stacks, with a PSNR/SSIM report against fp32
     'pth_dir': './pth',                 # pth file root path
     'denoise_model' : denoise_model,
+    'backend': 'pytorch',                # 'onnxruntime' to run the .onnx models with ONNX Runtime (pth_dir set to the onnx_dir of training)
     'output_dir' : '/home/zoez/projects/def-cbrown/zoez/10ms/results',         # result file root path
     # network related parameters
     'fmap': 16,                          # the number of feature maps
+    'num_levels': 4,                     # the number of levels of U-Net 3D, the same as in training
     'GPU': GPU,
+    'batch_size': None,                  # patches per step (None for one per GPU, 'auto' for the largest batch fitting in GPU memory)
+    'device': 'auto',                    # 'auto' (use GPU if available), 'cuda' or 'cpu'
+    'num_threads': 0,                    # CPU threads when running on CPU (0 for all cores available to the job)
     'num_workers': num_workers,
     'visualize_images_per_epoch': visualize_images_per_epoch,
     'save_test_images_per_epoch': save_test_images_per_epoch
@@ -44,6 +44,8 @@ train_dict = {
     'select_img_num': 150000,           # select the number of images used for training (use all frames by default)
     'train_datasets_size': train_datasets_size,
     'datasets_path': datasets_path,
+    'memory_map': False,                # read patches from the tif files on demand instead of loading all stacks into RAM
+    'cache_dir': '',                    # folder caching the preprocessed stacks between runs ('' to disable)
     'pth_dir': pth_dir,
     # network related parameters
     'n_epochs': n_epochs,
@@ -51,13 +53,31 @@ train_dict = {
     'b1': 0.5,                           # Adam: bata1
     'b2': 0.999,                         # Adam: bata2
     'fmap': 16,                          # the number of feature maps
+    'num_levels': 4,                     # the number of levels of U-Net 3D (fewer for a faster network)
+    'teacher_model': '',                 # a trained .pth model (fmap teacher_fmap) distilled into this thinner/shallower network ('' to disable)
+    'teacher_fmap': 16,                  # the number of feature maps of the teacher model
+    'teacher_levels': 4,                 # the number of levels of the teacher model
+    'checkpoint_levels': [],             # the U-Net levels recomputing their activations in the backward pass to save memory (e.g. [0, 1] or 'all')
+    'precision': 'fp32',                 # 'fp32', or 'fp16'/'bf16' for mixed precision training (less GPU memory)
+    'compile_mode': 'none',              # 'compile' (torch.compile) or 'script' (TorchScript) for a compiled network, 'none' for eager
     'GPU': GPU,
+    'batch_size': None,                  # patches per step (None for one per GPU, 'auto' for the largest batch fitting in GPU memory)
+    'distributed': False,                # one training process per GPU (DistributedDataParallel) instead of DataParallel
+    'device': 'auto',                    # 'auto' (use GPU if available), 'cuda' or 'cpu'
+    'num_threads': 0,                    # CPU threads when running on CPU (0 for all cores available to the job)
     'num_workers': num_workers,
+    'onnx_export': 'epoch',              # export the ONNX model every 'epoch', at the 'best' or 'final' epoch, or 'none'
+    'resume': '',                        # a training checkpoint (.ckpt) to resume, or pth_dir to resume the newest interrupted training
+    'checkpoint_interval': 0,            # iterations between training checkpoints (0 for the end of every epoch only)
+    'validation_size': 0,                # patches held out for validation, selecting the best model (0 to disable)
+    'early_stopping': 0,                 # stop after this number of validations without improvement (0 to train all epochs)
     'visualize_images_per_epoch': visualize_images_per_epoch,
     'save_test_images_per_epoch': save_test_images_per_epoch
 }
 # %%% Training preparation
-# first we create a training class object with the specified parameters
-tc = training_class(train_dict)
-# start the training process
-tc.run()
+# the guard is required by distributed training, which starts the training processes from this script
+if __name__ == '__main__':
+    # first we create a training class object with the specified parameters
+    tc = training_class(train_dict)
+    # start the training process
+    tc.run()